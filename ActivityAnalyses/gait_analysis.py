@@ -22,6 +22,7 @@
 import sys
 sys.path.append('../')
 
+import os
 import numpy as np
 import copy
 import pandas as pd
@@ -29,8 +30,20 @@ from scipy.signal import find_peaks
 from matplotlib import pyplot as plt
 
 from utilsKinematics import kinematics
+from utilsProcessing import lowPassFilterWindows
+from utilsTRC import iter_trc_windows
 
 class gait_analysis(kinematics):
+    
+    # Markers used by the gait analyses. With load_all_markers=False, only
+    # these markers are loaded (faster, less memory), and markerDict only
+    # contains these markers.
+    gaitMarkerNames = [
+        'r.ASIS_study', 'L.ASIS_study', 'r.PSIS_study', 'L.PSIS_study',
+        'r_knee_study', 'L_knee_study', 'r_mknee_study', 'L_mknee_study',
+        'r_ankle_study', 'L_ankle_study', 'r_mankle_study', 'L_mankle_study',
+        'r_calc_study', 'L_calc_study', 'r_toe_study', 'L_toe_study',
+        'RHJC_study', 'LHJC_study']
 
     def print_gait_cycle_times(self):
         """
@@ -93,7 +106,8 @@ class gait_analysis(kinematics):
     def __init__(self, session_dir, trial_name, leg='auto',
                  lowpass_cutoff_frequency_for_coordinate_values=-1,
                  n_gait_cycles=-1, gait_style='auto', trimming_start=0, 
-                 trimming_end=0):
+                 trimming_end=0, load_all_markers=True, 
+                 marker_window_size=None, marker_window_overlap=100):
         
         # Inherit init from kinematics class.
         super().__init__(
@@ -109,46 +123,123 @@ class gait_analysis(kinematics):
         # manually trim the start and end of the trial.
         self.trimming_start = trimming_start
         self.trimming_end = trimming_end
-                        
-        # Marker data load and filter.
-        self.markerDict = self.get_marker_dict(session_dir, trial_name, 
-            lowpass_cutoff_frequency = lowpass_cutoff_frequency_for_coordinate_values)
-
+        
+        self.session_dir = session_dir
+        self.trial_name = trial_name
+        self.load_all_markers = load_all_markers
+        self.gait_style = gait_style
+        
+        # Initialize variables to be lazy loaded.
+        self._comValues = None
+        self._R_world_to_gait = None
+        self._leg_length = None
+        
         # Coordinate values.
         self.coordinateValues = self.get_coordinate_values()
         
-        # Trim marker data and coordinate values.
+        if marker_window_size is None:
+            # Marker data load, filter, and trim.
+            self.load_marker_dict()
+            self.trim_coordinate_values()
+            
+            # Rotate marker data so x is forward (not using for now, but could be useful for some analyses).
+            self.rotation_about_y, self.markerDictRotated = self.rotate_x_forward()
+    
+            # Segment gait cycles.
+            self.gaitEvents = self.segment_walking(n_gait_cycles=n_gait_cycles,leg=leg)
+            self.nGaitCycles = np.shape(self.gaitEvents['ipsilateralIdx'])[0]
+            
+            # Determine treadmill speed (0 if overground).
+            self.treadmillSpeed,_ = self.compute_treadmill_speed(gait_style=gait_style)
+    
+            # Rotate marker data with a per gait cycle rotation
+            self.markerDictRotatedPerGaitCycle = self.rotate_vector_into_gait_frame()
+            
+        else:
+            # Long recordings: the gait cycles are segmented from the marker
+            # data read window by window (filtered and trimmed as markerDict),
+            # and the full marker data (markerDict and the attributes derived
+            # from it, see markerAttributes) is only loaded if used.
+            self.gaitEvents = self.segment_walking(
+                n_gait_cycles=n_gait_cycles, leg=leg,
+                marker_windows=self.iter_marker_windows(marker_window_size,
+                                                        marker_window_overlap),
+                marker_window_overlap=marker_window_overlap)
+            self.nGaitCycles = np.shape(self.gaitEvents['ipsilateralIdx'])[0]
+            self.trim_coordinate_values()
+            self._markersNotLoaded = True
+            
+    # Attributes derived from the marker data, loaded on first use if the
+    # gait cycles were segmented window by window (see __init__).
+    markerAttributes = ['markerDict', 'rotation_about_y', 'markerDictRotated',
+                        'treadmillSpeed', 'markerDictRotatedPerGaitCycle']
+    
+    def __getattr__(self, name):
+        # Only called for attributes that are not set.
+        if (name in self.markerAttributes and 
+                self.__dict__.pop('_markersNotLoaded', False)):
+            self.load_marker_dict()
+            self.rotation_about_y, self.markerDictRotated = self.rotate_x_forward()
+            self.treadmillSpeed,_ = self.compute_treadmill_speed(gait_style=self.gait_style)
+            self.markerDictRotatedPerGaitCycle = self.rotate_vector_into_gait_frame()
+            return getattr(self, name)
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+    
+    def get_trim_indices(self, time):
+        # Indices of the trimming of the trial (trimming_start, trimming_end):
+        # frames before idx_trim_start are removed, and then frames from
+        # idx_trim_end on. Indices are None if there is no trimming.
+        idx_trim_start, idx_trim_end = None, None
+        if self.trimming_start > 0:
+            idx_trim_start = np.where(np.round(time - self.trimming_start,6) <= 0)[0][-1]
+            time = time[idx_trim_start:,]
+        if self.trimming_end > 0:
+            idx_trim_end = np.where(np.round(time,6) <= np.round(time[-1] - self.trimming_end,6))[0][-1] + 1
+        
+        return idx_trim_start, idx_trim_end
+    
+    def set_trim_indices(self, time):
+        idx_trim_start, idx_trim_end = self.get_trim_indices(time)
+        if idx_trim_start is not None:
+            self.idx_trim_start = idx_trim_start
+        if idx_trim_end is not None:
+            self.idx_trim_end = idx_trim_end
+    
+    def load_marker_dict(self):
+        
+        # Marker data load and filter.
+        self.markerDict = self.get_marker_dict(self.session_dir, self.trial_name, 
+            lowpass_cutoff_frequency = self.lowpass_cutoff_frequency_for_coordinate_values,
+            marker_names = None if self.load_all_markers else self.gaitMarkerNames)
+        
+        # Trim marker data.
+        self.set_trim_indices(self.markerDict['time'])
         if self.trimming_start > 0:
-            self.idx_trim_start = np.where(np.round(self.markerDict['time'] - self.trimming_start,6) <= 0)[0][-1]
             self.markerDict['time'] = self.markerDict['time'][self.idx_trim_start:,]
             for marker in self.markerDict['markers']:
                 self.markerDict['markers'][marker] = self.markerDict['markers'][marker][self.idx_trim_start:,:]
-            self.coordinateValues = self.coordinateValues.iloc[self.idx_trim_start:]
         
         if self.trimming_end > 0:
-            self.idx_trim_end = np.where(np.round(self.markerDict['time'],6) <= np.round(self.markerDict['time'][-1] - self.trimming_end,6))[0][-1] + 1
             self.markerDict['time'] = self.markerDict['time'][:self.idx_trim_end,]
             for marker in self.markerDict['markers']:
                 self.markerDict['markers'][marker] = self.markerDict['markers'][marker][:self.idx_trim_end,:]
-            self.coordinateValues = self.coordinateValues.iloc[:self.idx_trim_end]
-        
-        # Rotate marker data so x is forward (not using for now, but could be useful for some analyses).
-        self.rotation_about_y, self.markerDictRotated = self.rotate_x_forward()
-
-        # Segment gait cycles.
-        self.gaitEvents = self.segment_walking(n_gait_cycles=n_gait_cycles,leg=leg)
-        self.nGaitCycles = np.shape(self.gaitEvents['ipsilateralIdx'])[0]
-        
-        # Determine treadmill speed (0 if overground).
-        self.treadmillSpeed,_ = self.compute_treadmill_speed(gait_style=gait_style)
+                
+    def trim_coordinate_values(self):
         
-        # Initialize variables to be lazy loaded.
-        self._comValues = None
-        self._R_world_to_gait = None
-        self._leg_length = None
-
-        # Rotate marker data with a per gait cycle rotation
-        self.markerDictRotatedPerGaitCycle = self.rotate_vector_into_gait_frame()
+        if self.trimming_start > 0:
+            self.coordinateValues = self.coordinateValues.iloc[self.idx_trim_start:]
+        if self.trimming_end > 0:
+            self.coordinateValues = self.coordinateValues.iloc[:self.idx_trim_end]
+            
+    def iter_marker_windows(self, window_size, overlap=0):
+        # Windows of the marker data (gait markers only) read from the trc
+        # file, see utilsTRC.iter_trc_windows.
+        trcFilePath = os.path.join(self.session_dir, 'MarkerData',
+                                   '{}.trc'.format(self.trial_name))
+        
+        return iter_trc_windows(trcFilePath, window_size, overlap=overlap,
+                                marker_names=self.gaitMarkerNames)
     
     # Compute COM trajectory.
     def comValues(self,rotate=None,filt_freq=-1):
@@ -863,7 +954,46 @@ class gait_analysis(kinematics):
         return coordinateValuesTimeNormalized
 
 
-    def segment_walking(self, n_gait_cycles=-1, leg='auto', visualize=False):
+    def compute_gait_peak_signals(self, markers):
+        # Position of the calcaneus and toe markers relative to the PSIS
+        # markers, projected onto the walking direction. markers is a dict
+        # with the same format as markerDict['markers'].
+        
+        # Subtract sacrum from foot.
+        # It looks like the position-based approach will be more robust.        
+        r_calc_rel = (
+            markers['r_calc_study'] - 
+            markers['r.PSIS_study'])
+        
+        r_toe_rel = (
+            markers['r_toe_study'] - 
+            markers['r.PSIS_study'])
+        # Repeat for left.
+        l_calc_rel = (
+            markers['L_calc_study'] - 
+            markers['L.PSIS_study'])
+        l_toe_rel = (
+            markers['L_toe_study'] - 
+            markers['L.PSIS_study'])
+        
+        # Identify which direction the subject is walking.
+        mid_psis = (markers['r.PSIS_study'] + markers['L.PSIS_study'])/2
+        mid_asis = (markers['r.ASIS_study'] + markers['L.ASIS_study'])/2
+        mid_dir = mid_asis - mid_psis
+        mid_dir_floor = np.copy(mid_dir)
+        mid_dir_floor[:,1] = 0
+        mid_dir_floor = mid_dir_floor / np.linalg.norm(mid_dir_floor,axis=1,keepdims=True)
+        
+        # Dot product projections   
+        r_calc_rel_x = np.einsum('ij,ij->i', mid_dir_floor,r_calc_rel)
+        l_calc_rel_x = np.einsum('ij,ij->i', mid_dir_floor,l_calc_rel)
+        r_toe_rel_x = np.einsum('ij,ij->i', mid_dir_floor,r_toe_rel)
+        l_toe_rel_x = np.einsum('ij,ij->i', mid_dir_floor,l_toe_rel)
+        
+        return r_calc_rel_x, l_calc_rel_x, r_toe_rel_x, l_toe_rel_x
+
+    def segment_walking(self, n_gait_cycles=-1, leg='auto', visualize=False,
+                        marker_windows=None, marker_window_overlap=0):
 
         # n_gait_cycles = -1 finds all accessible gait cycles. Otherwise, it 
         # finds that many gait cycles, working backwards from end of trial.
@@ -927,37 +1057,43 @@ class gait_analysis(kinematics):
         
             return True
         
-        # Subtract sacrum from foot.
-        # It looks like the position-based approach will be more robust.        
-        r_calc_rel = (
-            self.markerDict['markers']['r_calc_study'] - 
-            self.markerDict['markers']['r.PSIS_study'])
-        
-        r_toe_rel = (
-            self.markerDict['markers']['r_toe_study'] - 
-            self.markerDict['markers']['r.PSIS_study'])
-        r_toe_rel_x = r_toe_rel[:,0]
-        # Repeat for left.
-        l_calc_rel = (
-            self.markerDict['markers']['L_calc_study'] - 
-            self.markerDict['markers']['L.PSIS_study'])
-        l_toe_rel = (
-            self.markerDict['markers']['L_toe_study'] - 
-            self.markerDict['markers']['L.PSIS_study'])
-        
-        # Identify which direction the subject is walking.
-        mid_psis = (self.markerDict['markers']['r.PSIS_study'] + self.markerDict['markers']['L.PSIS_study'])/2
-        mid_asis = (self.markerDict['markers']['r.ASIS_study'] + self.markerDict['markers']['L.ASIS_study'])/2
-        mid_dir = mid_asis - mid_psis
-        mid_dir_floor = np.copy(mid_dir)
-        mid_dir_floor[:,1] = 0
-        mid_dir_floor = mid_dir_floor / np.linalg.norm(mid_dir_floor,axis=1,keepdims=True)
-        
-        # Dot product projections   
-        r_calc_rel_x = np.einsum('ij,ij->i', mid_dir_floor,r_calc_rel)
-        l_calc_rel_x = np.einsum('ij,ij->i', mid_dir_floor,l_calc_rel)
-        r_toe_rel_x = np.einsum('ij,ij->i', mid_dir_floor,r_toe_rel)
-        l_toe_rel_x = np.einsum('ij,ij->i', mid_dir_floor,l_toe_rel)
+        if marker_windows is None:
+            time = self.markerDict['time']
+            r_calc_rel_x, l_calc_rel_x, r_toe_rel_x, l_toe_rel_x = (
+                self.compute_gait_peak_signals(self.markerDict['markers']))
+        else:
+            # Marker data is provided window by window (eg, from 
+            # iter_trc_windows for long recordings), consecutive windows
+            # sharing marker_window_overlap frames. Only the projected
+            # signals, ie 4 values per frame, are kept in memory. The marker
+            # data is filtered and the trial is trimmed like markerDict, such
+            # that the gait events index markerDict and the coordinate values.
+            if self.lowpass_cutoff_frequency_for_coordinate_values > 0:
+                marker_windows = lowPassFilterWindows(
+                    marker_windows, 
+                    self.lowpass_cutoff_frequency_for_coordinate_values,
+                    marker_window_overlap)
+            # Frames shared by consecutive windows are only used once.
+            time, signals = [], []
+            next_idx = 0
+            for window in marker_windows:
+                skip = next_idx - window['start_idx']
+                time.append(window['time'][skip:])
+                signals.append(np.stack(self.compute_gait_peak_signals(
+                    window['markers']), axis=1)[skip:])
+                next_idx = window['start_idx'] + len(window['time'])
+            time = np.concatenate(time)
+            signals = np.concatenate(signals)
+            
+            # Trim.
+            self.set_trim_indices(time)
+            if self.trimming_start > 0:
+                time = time[self.idx_trim_start:]
+                signals = signals[self.idx_trim_start:]
+            if self.trimming_end > 0:
+                time = time[:self.idx_trim_end]
+                signals = signals[:self.idx_trim_end]
+            r_calc_rel_x, l_calc_rel_x, r_toe_rel_x, l_toe_rel_x = signals.T
         
         # Old Approach that does not take the heading direction into account.
         # r_psis_x = self.markerDict['markers']['r.PSIS_study'][:,0]
@@ -993,17 +1129,17 @@ class gait_analysis(kinematics):
             import matplotlib.pyplot as plt
             plt.close('all')
             plt.figure(1)
-            plt.plot(self.markerDict['time'],r_toe_rel_x,label='toe')
-            plt.plot(self.markerDict['time'],r_calc_rel_x,label='calc')
-            plt.scatter(self.markerDict['time'][rHS], r_calc_rel_x[rHS], color='red', label='rHS')
-            plt.scatter(self.markerDict['time'][rTO], r_toe_rel_x[rTO], color='blue', label='rTO')
+            plt.plot(time,r_toe_rel_x,label='toe')
+            plt.plot(time,r_calc_rel_x,label='calc')
+            plt.scatter(time[rHS], r_calc_rel_x[rHS], color='red', label='rHS')
+            plt.scatter(time[rTO], r_toe_rel_x[rTO], color='blue', label='rTO')
             plt.legend()
 
             plt.figure(2)
-            plt.plot(self.markerDict['time'],l_toe_rel_x,label='toe')
-            plt.plot(self.markerDict['time'],l_calc_rel_x,label='calc')
-            plt.scatter(self.markerDict['time'][lHS], l_calc_rel_x[lHS], color='red', label='lHS')
-            plt.scatter(self.markerDict['time'][lTO], l_toe_rel_x[lTO], color='blue', label='lTO')
+            plt.plot(time,l_toe_rel_x,label='toe')
+            plt.plot(time,l_calc_rel_x,label='calc')
+            plt.scatter(time[lHS], l_calc_rel_x[lHS], color='red', label='lHS')
+            plt.scatter(time[lTO], l_toe_rel_x[lTO], color='blue', label='lTO')
             plt.legend()
 
         # Find the number of gait cycles for the foot of interest.
@@ -1085,9 +1221,9 @@ class gait_analysis(kinematics):
         gaitEvents_ips = gaitEvents_ips[~mask_ips]
         gaitEvents_cont = gaitEvents_cont[~mask_ips]
             
-        # Convert gaitEvents to times using self.markerDict['time'].
-        gaitEventTimes_ips = self.markerDict['time'][gaitEvents_ips]
-        gaitEventTimes_cont = self.markerDict['time'][gaitEvents_cont]
+        # Convert gaitEvents to times.
+        gaitEventTimes_ips = time[gaitEvents_ips]
+        gaitEventTimes_cont = time[gaitEvents_cont]
                             
         gaitEvents = {'ipsilateralIdx':gaitEvents_ips,
                       'contralateralIdx':gaitEvents_cont,
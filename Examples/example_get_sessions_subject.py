@@ -26,7 +26,7 @@
 import sys
 sys.path.append("../")
 
-from utils import get_user_subjects, get_subject_sessions
+from utils import get_user_subjects, get_session_index
 
 # Insert the name of the subject you are interested in.
 subject_name = 'my_subject_name'
@@ -38,7 +38,7 @@ subjects = get_user_subjects()
 subject_ids = [subject['id'] for subject in subjects if subject['name'] == subject_name]
 print ("We found {} subjects with the name {}".format(len(subject_ids), subject_name))
 
-# Get session IDs from subject(s).
-session_ids = []
-for subject_id in subject_ids:
-    session_ids.append(get_subject_sessions(subject_id))
+# Get session IDs from subject(s). The sessions of the subjects are queried
+# concurrently; use include_trials=True to also list the trials of each session.
+index = get_session_index(subject_ids=subject_ids, include_trials=False)
+session_ids = list(index['session_id'])
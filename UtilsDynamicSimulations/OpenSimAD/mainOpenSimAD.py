@@ -33,6 +33,8 @@ import platform
 import copy
 import pandas as pd
 
+from utilsResults import save_optimal_trajectory
+
 # %% Settings.
 def run_tracking(baseDir, dataDir, subject, settings, case='0',
                  solveProblem=True, analyzeResults=True, writeGUI=True,
@@ -2662,15 +2664,8 @@ def run_tracking(baseDir, dataDir, subject, settings, case='0',
                        * Qds_opt_nsc[idxPoweredJoints, :-1])  
             
         # %% Save optimal trajectories.
-        if not os.path.exists(os.path.join(pathResults,
-                                           'optimaltrajectories.npy')): 
-                optimaltrajectories = {}
-        else:  
-            optimaltrajectories = np.load(
-                    os.path.join(pathResults, 'optimaltrajectories.npy'),
-                    allow_pickle=True)   
-            optimaltrajectories = optimaltrajectories.item()
-        optimaltrajectories[case] = {
+        # Each case is saved in its own file, see utilsResults.
+        optimaltrajectory = {
             'coordinate_values_toTrack': refData_offset_nsc,
             'coordinate_values': Qs_opt_nsc,
             'coordinate_speeds_toTrack': refData_Qds_nsc,
@@ -2698,36 +2693,35 @@ def run_tracking(baseDir, dataDir, subject, settings, case='0',
             'muscle_driven_joints': muscleDrivenJoints,
             'limit_torques_joints': passiveTorqueJoints}             
         if computeKAM:
-            optimaltrajectories[case]['KAM'] = KAM
-            optimaltrajectories[case]['KAM_BWht'] = KAM_BWht
-            optimaltrajectories[case]['KAM_labels'] = KAM_labels
+            optimaltrajectory['KAM'] = KAM
+            optimaltrajectory['KAM_BWht'] = KAM_BWht
+            optimaltrajectory['KAM_labels'] = KAM_labels
         if computeMCF:
-            optimaltrajectories[case]['MCF'] = MCF
-            optimaltrajectories[case]['MCF_BW'] = MCF_BW
-            optimaltrajectories[case]['MCF_labels'] = MCF_labels
+            optimaltrajectory['MCF'] = MCF
+            optimaltrajectory['MCF_BW'] = MCF_BW
+            optimaltrajectory['MCF_labels'] = MCF_labels
         if experimental_force_data_available:
-            optimaltrajectories[case]['GRF_experimental'] = experimental_grf
-            optimaltrajectories[case]['GRF_BW_experimental'] = experimental_grf_BW
-            optimaltrajectories[case]['GRM_experimental'] = experimental_grm
-            optimaltrajectories[case]['GRM_BWht_experimental'] = experimental_grm_BWht
+            optimaltrajectory['GRF_experimental'] = experimental_grf
+            optimaltrajectory['GRF_BW_experimental'] = experimental_grf_BW
+            optimaltrajectory['GRM_experimental'] = experimental_grm
+            optimaltrajectory['GRM_BWht_experimental'] = experimental_grm_BWht
         if experimental_emg_data_available:
-            optimaltrajectories[case]['muscle_activations_emg'] = experimental_emg
+            optimaltrajectory['muscle_activations_emg'] = experimental_emg
         if mocap_ik_data_available:
-            optimaltrajectories[case]['coordinate_values_mocap'] = Qs_mocap_ref
-            optimaltrajectories[case]['coordinate_speeds_mocap'] = Qds_mocap_ref
-            optimaltrajectories[case]['coordinate_accelerations_mocap'] = Qdds_mocap_ref
+            optimaltrajectory['coordinate_values_mocap'] = Qs_mocap_ref
+            optimaltrajectory['coordinate_speeds_mocap'] = Qds_mocap_ref
+            optimaltrajectory['coordinate_accelerations_mocap'] = Qdds_mocap_ref
         if mocap_id_data_available:
-            optimaltrajectories[case]['torques_mocap'] = mocap_id
-            optimaltrajectories[case]['torques_BWht_mocap'] = mocap_id_BWht
-        optimaltrajectories[case]['iter'] = stats['iter_count']
+            optimaltrajectory['torques_mocap'] = mocap_id
+            optimaltrajectory['torques_BWht_mocap'] = mocap_id_BWht
+        optimaltrajectory['iter'] = stats['iter_count']
 
         if torque_driven_model:
-            optimaltrajectories[case]['coordinate_activations'] = aCoord_opt_nsc
+            optimaltrajectory['coordinate_activations'] = aCoord_opt_nsc
         else:
-            optimaltrajectories[case]['muscle_activations'] = a_opt
-            optimaltrajectories[case]['muscle_forces'] = Ft_opt  
-            optimaltrajectories[case]['passive_muscle_torques'] = pMT_opt
-            optimaltrajectories[case]['passive_muscle_torques'] = aMT_opt
+            optimaltrajectory['muscle_activations'] = a_opt
+            optimaltrajectory['muscle_forces'] = Ft_opt  
+            optimaltrajectory['passive_muscle_torques'] = pMT_opt
+            optimaltrajectory['passive_muscle_torques'] = aMT_opt
                 
-        np.save(os.path.join(pathResults, 'optimaltrajectories.npy'),
-                optimaltrajectories)
+        save_optimal_trajectory(pathResults, case, optimaltrajectory)
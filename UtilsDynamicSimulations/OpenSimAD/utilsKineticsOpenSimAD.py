@@ -22,6 +22,8 @@ import os
 import numpy as np
 import pandas as pd
 import utils
+import utilsColumnar
+import utilsResults
 import opensim
 
 class kineticsOpenSimAD:
@@ -63,15 +65,28 @@ class kineticsOpenSimAD:
                         Have you set the repetition index if simulating \
                             a sit to stand or a squat?')
 
-        optimal_results = np.load(
-            os.path.join(resultsDir, 'optimaltrajectories.npy'), 
-            allow_pickle=True).item()
+        # Read from the columnar export of the session if available and
+        # exported in double precision (see 
+        # utilsColumnar.export_session_columnar).
+        resultsName = trial_name + repetitionSuffix
+        if utilsColumnar.is_columnar_available(sessionDir, resultsName, 
+                                               'dynamics', lossless=True):
+            cases = utilsColumnar.get_dynamics_cases(sessionDir, resultsName)
+        else:
+            cases = utilsResults.get_results_cases(resultsDir)
 
-        if case is None and len(optimal_results) > 1:
+        if case is None and len(cases) > 1:
             raise Exception("Multiple cases found. Please specify a case.")
-        elif case is None and len(optimal_results) == 1:
-            case = list(optimal_results.keys())[0]
-        self.optimal_result = optimal_results[case]
+        elif case is None and len(cases) == 1:
+            case = cases[0]
+        if utilsColumnar.is_columnar_available(sessionDir, resultsName, 
+                                               'dynamics', lossless=True):
+            self.optimal_result = utilsColumnar.load_dynamics(
+                sessionDir, resultsName, case)
+        else:
+            # Arrays are only read from disk when accessed.
+            self.optimal_result = utilsResults.load_optimal_trajectory(
+                resultsDir, case)
 
         # Load OpenSim model.
         modelBasePath = os.path.join(opensimDir, 'Model')
@@ -41,6 +41,7 @@ from utils import (storage_to_numpy, storage_to_dataframe,
                    download_kinematics, import_metadata, numpy_to_storage)
 from utilsProcessing import (segment_squats, segment_STS, adjust_muscle_wrapping,
                              generate_model_with_contacts)
+from utilsResults import load_optimal_trajectories
 from settingsOpenSimAD import get_setup
 
 # %% Filter numpy array.
@@ -241,7 +242,7 @@ def checkQsWithinPolynomialBounds(data, bounds, model_bounds, coordinates):
 # %% Extract data frame from storage file.
 def getFromStorage(storage_file, headers):
     
-    data = storage_to_numpy(storage_file)
+    data = storage_to_numpy(storage_file, columns=['time'] + list(headers))
     out = pd.DataFrame(data=data['time'], columns=['time'])    
     for count, header in enumerate(headers):
         out.insert(count + 1, header, data[header])    
@@ -265,7 +266,10 @@ def getEMG(storage_file, headers):
 # %% Extract ID.
 def getID(storage_file, headers):
     
-    data = storage_to_numpy(storage_file)
+    columns = ['time'] + [
+        header + '_force' if header in ['pelvis_tx', 'pelvis_ty', 'pelvis_tz'] 
+        else header + '_moment' for header in headers]
+    data = storage_to_numpy(storage_file, columns=columns)
     out = pd.DataFrame(data=data['time'], columns=['time'])    
     for count, header in enumerate(headers):
         if ((header == 'pelvis_tx') or (header == 'pelvis_ty') or 
@@ -306,54 +310,58 @@ def getGRFAll(pathGRFFile, timeInterval, N):
                         'R_ground_torque_z', 'L_ground_torque_x', 
                         'L_ground_torque_y', 'L_ground_torque_z']}}}
     
-    # Here we extract the GRFs and compute the GRMs wrt the ground origin.        
-    GRF['df'] = {
-        'forces': {
-            'right':getGRF(pathGRFFile, GRF['headers']['forces']['right']),
-            'left': getGRF(pathGRFFile, GRF['headers']['forces']['left'])},
-        'torques_G': {
-            'right': getGRM_wrt_groundOrigin(
-                pathGRFFile, GRF['headers']['forces']['right'], 
-                GRF['headers']['COP']['right'], 
-                GRF['headers']['torques']['right']),
-            'left': getGRM_wrt_groundOrigin(
-                pathGRFFile, GRF['headers']['forces']['left'], 
-                GRF['headers']['COP']['left'], 
-                GRF['headers']['torques']['left'])}}
-    GRF['df_interp'] = {
-        'forces': {
-            'right': interpolateDataFrame(
-                GRF['df']['forces']['right'], timeInterval[0], 
-                timeInterval[1], N),
-            'left': interpolateDataFrame(
-                GRF['df']['forces']['left'], timeInterval[0], 
-                timeInterval[1], N)},
-        'torques_G': {
-            'right': interpolateDataFrame(
-                GRF['df']['torques_G']['right'], timeInterval[0], 
-                timeInterval[1], N),
-            'left': interpolateDataFrame(
-                GRF['df']['torques_G']['left'], timeInterval[0], 
-                timeInterval[1], N)}}
-    # Here we concatenate left and right, and remove the duplicated time.        
-    GRF['df_interp']['forces']['all'] = pd.concat(
-        [GRF['df_interp']['forces']['right'], 
-          GRF['df_interp']['forces']['left']], axis=1)
-    GRF['df_interp']['forces']['all'] = (
-        GRF['df_interp']['forces']['all'].loc[
-            :,~GRF['df_interp']['forces']['all'].columns.duplicated()])        
-    GRF['df_interp']['torques_G']['all'] = pd.concat(
-        [GRF['df_interp']['torques_G']['right'], 
-          GRF['df_interp']['torques_G']['left']], axis=1)
-    GRF['df_interp']['torques_G']['all'] = (
-        GRF['df_interp']['torques_G']['all'].loc[
-            :,~GRF['df_interp']['torques_G']['all'].columns.duplicated()])
+    # Here we parse the GRF file once, extract the GRFs, and compute the GRMs
+    # wrt the ground origin.
+    data = storage_to_numpy(
+        pathGRFFile, columns=(['time'] + GRF['headers']['forces']['all'] + 
+                              GRF['headers']['COP']['all'] + 
+                              GRF['headers']['torques']['all']))
+    time = np.asarray(data['time'])
+    GRF['df'] = {'forces': {}, 'torques_G': {}}
+    for side in ['right', 'left']:
+        forces = np.stack(
+            [data[h] for h in GRF['headers']['forces'][side]], axis=1)
+        PoAs = np.stack(
+            [data[h] for h in GRF['headers']['COP'][side]], axis=1)
+        torques = np.stack(
+            [data[h] for h in GRF['headers']['torques'][side]], axis=1)
+        GRF['df']['forces'][side] = pd.DataFrame(
+            data=np.concatenate((time[:, None], forces), axis=1),
+            columns=['time'] + GRF['headers']['forces'][side])
+        GRF['df']['torques_G'][side] = pd.DataFrame(
+            data=np.concatenate((time[:, None], computeGRM_wrt_groundOrigin(
+                forces, PoAs, torques)), axis=1),
+            columns=['time'] + GRF['headers']['torques'][side])
+    
+    # Interpolate all quantities at once: time, forces (right, left), and
+    # torques (right, left).
+    data_interp = interpolateNumpyArray_mesh(
+        np.concatenate((time[:, None], 
+                        GRF['df']['forces']['right'].to_numpy()[:, 1:],
+                        GRF['df']['forces']['left'].to_numpy()[:, 1:],
+                        GRF['df']['torques_G']['right'].to_numpy()[:, 1:],
+                        GRF['df']['torques_G']['left'].to_numpy()[:, 1:]),
+                       axis=1), time, timeInterval[0], timeInterval[1], N)
+    GRF['df_interp'] = {'forces': {}, 'torques_G': {}}
+    for i, key in enumerate(['forces', 'torques_G']):
+        c_headers = GRF['headers'][key if key == 'forces' else 'torques']
+        for j, side in enumerate(['right', 'left']):
+            idx = 1 + 6*i + 3*j
+            GRF['df_interp'][key][side] = pd.DataFrame(
+                data=np.concatenate((data_interp[:, :1], 
+                                     data_interp[:, idx:idx+3]), axis=1),
+                columns=['time'] + c_headers[side])
+        # Here we concatenate left and right, and remove the duplicated time.
+        GRF['df_interp'][key]['all'] = pd.DataFrame(
+            data=np.concatenate((data_interp[:, :1], 
+                                 data_interp[:, 1+6*i:7+6*i]), axis=1),
+            columns=['time'] + c_headers['all'])
 
     return GRF
 
 def getGRF(storage_file, headers):
 
-    data = storage_to_numpy(storage_file)
+    data = storage_to_numpy(storage_file, columns=['time'] + list(headers))
     GRFs = pd.DataFrame(data=data['time'], columns=['time'])    
     for count, header in enumerate(headers):
         GRFs.insert(count + 1, header, data[header])    
@@ -379,24 +387,28 @@ def getGRFPeaks(GRF, timeIntervals):
 # %% Compute GRM with respect to ground origin.
 def getGRM_wrt_groundOrigin(storage_file, fHeaders, pHeaders, mHeaders):
 
-    data = storage_to_numpy(storage_file)
-    GRFs = pd.DataFrame()    
-    for count, fheader in enumerate(fHeaders):
-        GRFs.insert(count, fheader, data[fheader])  
-    PoAs = pd.DataFrame()    
-    for count, pheader in enumerate(pHeaders):
-        PoAs.insert(count, pheader, data[pheader]) 
-    GRMs = pd.DataFrame()    
+    data = storage_to_numpy(
+        storage_file, columns=['time'] + fHeaders + pHeaders + mHeaders)
+    GRFs = np.stack([data[fheader] for fheader in fHeaders], axis=1)
+    PoAs = np.stack([data[pheader] for pheader in pHeaders], axis=1)
+    GRMs = np.stack([data[mheader] for mheader in mHeaders], axis=1)
+    
+    GRM_wrt_groundOrigin = pd.DataFrame(data=data['time'], columns=['time'])
+    GRM_wrt_groundOrigin_data = computeGRM_wrt_groundOrigin(GRFs, PoAs, GRMs)
     for count, mheader in enumerate(mHeaders):
-        GRMs.insert(count, mheader, data[mheader])  
-        
+        GRM_wrt_groundOrigin.insert(
+            count + 1, mheader, GRM_wrt_groundOrigin_data[:, count])
+    
+    return GRM_wrt_groundOrigin
+
+# GRFs, PoAs, and GRMs are (N x 3) arrays.
+def computeGRM_wrt_groundOrigin(GRFs, PoAs, GRMs):
+    
     # GRT_x = PoA_y*GRF_z - PoA_z*GRF_y
-    # GRT_y = PoA_z*GRF_x - PoA_z*GRF_z + T_y
+    # GRT_y = PoA_z*GRF_x - PoA_x*GRF_z + T_y
     # GRT_z = PoA_x*GRF_y - PoA_y*GRF_x
-    GRM_wrt_groundOrigin = pd.DataFrame(data=data['time'], columns=['time'])    
-    GRM_wrt_groundOrigin.insert(1, mHeaders[0], PoAs[pHeaders[1]] * GRFs[fHeaders[2]]  - PoAs[pHeaders[2]] * GRFs[fHeaders[1]])
-    GRM_wrt_groundOrigin.insert(2, mHeaders[1], PoAs[pHeaders[2]] * GRFs[fHeaders[0]]  - PoAs[pHeaders[0]] * GRFs[fHeaders[2]] + GRMs[mHeaders[1]])
-    GRM_wrt_groundOrigin.insert(3, mHeaders[2], PoAs[pHeaders[0]] * GRFs[fHeaders[1]]  - PoAs[pHeaders[1]] * GRFs[fHeaders[0]])        
+    GRM_wrt_groundOrigin = np.cross(PoAs, GRFs)
+    GRM_wrt_groundOrigin[:, 1] += GRMs[:, 1]
     
     return GRM_wrt_groundOrigin
 
@@ -434,14 +446,22 @@ def selectFromDataFrame(dataFrame, headers):
 # %% Interpolate data frame.
 def interpolateDataFrame(dataFrame, tIn, tEnd, N):
     
-    tOut = np.linspace(np.round(tIn,6), np.round(tEnd,6), N)    
-    dataInterp = pd.DataFrame() 
-    for i, col in enumerate(dataFrame.columns):
-        set_interp = interp1d(np.round(dataFrame['time'],6), dataFrame[col])        
-        dataInterp.insert(i, col, set_interp(tOut))
+    dataInterp = pd.DataFrame(
+        data=interpolateNumpyArray_mesh(
+            dataFrame.to_numpy(dtype=float), 
+            dataFrame['time'].to_numpy(), tIn, tEnd, N), 
+        columns=dataFrame.columns)
         
     return dataInterp
 
+# %% Interpolate all columns of numpy array to mesh (single batched call).
+def interpolateNumpyArray_mesh(data, time, tIn, tEnd, N):
+    
+    tOut = np.linspace(np.round(tIn,6), np.round(tEnd,6), N)
+    set_interp = interp1d(np.round(time,6), data, axis=0)
+    
+    return set_interp(tOut)
+
 # %% Scale data frame.
 def scaleDataFrame(dataFrame, scaling, headers):
     
@@ -481,7 +501,7 @@ def getIK(storage_file, joints, degrees=False):
     table = opensim.TimeSeriesTable(storage_file)
     inDegrees = table.getTableMetaDataString('inDegrees')    
     
-    data = storage_to_numpy(storage_file)
+    data = storage_to_numpy(storage_file, columns=['time'] + list(joints))
     Qs = pd.DataFrame(data=data['time'], columns=['time'])    
     for count, joint in enumerate(joints):  
         if ((joint == 'pelvis_tx') or (joint == 'pelvis_ty') or 
@@ -1894,11 +1914,7 @@ def plotResultsOpenSimAD(dataDir, subject, motion_filename, settings,
         suff_path = '_rep' + str(settings['repetition'])
     c_pathResults = os.path.join(pathOSData, 'Dynamics', 
                                  motion_filename + suff_path)    
-    c_tr = np.load(os.path.join(c_pathResults, 'optimaltrajectories.npy'),
-                   allow_pickle=True).item()    
-    optimaltrajectories = {}
-    for case in cases:
-        optimaltrajectories[case] = c_tr[case]
+    optimaltrajectories = load_optimal_trajectories(c_pathResults, cases)
         
     colors = sns.color_palette('colorblind', len(cases))
 
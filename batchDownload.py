@@ -18,7 +18,7 @@
     limitations under the License.
 '''
 
-from utils import download_session
+from utilsBatchDownload import download_sessions, read_session_list
 import os
 
 # List of sessions you'd like to download. They go to the Data folder in the 
@@ -28,16 +28,15 @@ sessionList = ['7272a71a-e70a-4794-a253-39e11cb7542c',
 
 
 # # alternatively, read list of session IDs from CSV column
-# from pathlib import Path
-# import pandas as pd
-# fpath = Path('~/Documents/paru/session_ids_fshd.csv')
-# df = pd.read_csv(fpath)
-# sessionList = df['sid'].dropna().unique()
+# sessionList = read_session_list(
+#     os.path.expanduser('~/Documents/paru/session_ids_fshd.csv'), column='sid')
 
              
 # base directory for downloads. Specify None if you want to go to os.path.join(os.getcwd(),'Data')
 downloadPath = os.path.join(os.getcwd(),'Data')
 
-for session_id in sessionList:
-    # If only interested in marker and OpenSim data, downladVideos=False will be faster
-    download_session(session_id,sessionBasePath=downloadPath,downloadVideos=True)
\ No newline at end of file
+# Sessions are downloaded concurrently (max_sessions at a time). A manifest
+# with the outcome of each session is saved in downloadPath.
+# If only interested in marker and OpenSim data, downladVideos=False will be faster
+download_sessions(sessionList, sessionBasePath=downloadPath,
+                  downloadVideos=True, max_sessions=4)
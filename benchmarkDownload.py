@@ -0,0 +1,167 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: benchmarkDownload.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Throughput of the download functions (download_session,
+# download_kinematics, and the batch download of utilsBatchDownload) against
+# a local stand-in for the OpenCap API (utilsMockAPI), such that changes of
+# the download path can be compared without api.opencap.ai.
+# Each run downloads into a new temporary folder, with an empty API cache and
+# an empty geometry cache.
+#
+# Usage:
+#   python benchmarkDownload.py --sessions 4 --latency 0.05 --workers 1 8
+#   python benchmarkDownload.py --failure-rate 0.05 --truncate-rate 0.1
+# Run python benchmarkDownload.py --help for all options.
+
+import os
+import io
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+from utilsAPI import set_api_url
+from utilsMockAPI import MockOpenCapAPI
+
+def get_folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+
+    return size
+
+def download_kinematics(sessionList, folder):
+    # download_kinematics raises on the first error of a session, which is
+    # counted as an error (as in the errors of download_session).
+    import utils
+
+    errors = []
+    for session_id in sessionList:
+        sessionFolder = os.path.join(folder, session_id)
+        try:
+            utils.download_kinematics(session_id, folder=sessionFolder)
+        except Exception as e:
+            errors.append({'step': 'download_kinematics', 'error': e,
+                           'path': sessionFolder})
+
+    return errors
+
+def run_benchmark(name, server, run, verbose=False):
+    # run(folder) downloads into folder, and returns the errors.
+    import utils
+
+    folder = tempfile.mkdtemp(prefix='opencap_benchmark_')
+    os.environ['GEOMETRY_CACHE_DIR'] = os.path.join(folder, 'geometries')
+    utils.clear_api_cache()
+    server.reset_stats()
+    output = io.StringIO()
+    start = time.time()
+    try:
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            errors = run(os.path.join(folder, 'Data'))
+        seconds = time.time() - start
+        nBytes = get_folder_size(os.path.join(folder, 'Data'))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    result = dict(name=name, seconds=seconds, bytes=nBytes,
+                  errors=len(errors or []), **server.stats)
+    print('{:<32} {:8.2f} s {:8.1f} MB {:8.1f} MB/s {:6d} requests '
+          '{:4d} errors'.format(
+              name, seconds, nBytes / 1e6, nBytes / 1e6 / max(seconds, 1e-6),
+              result['api_requests'] + result['media_requests'],
+              result['errors']))
+
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the download functions against a local '
+                    'stand-in for the OpenCap API.')
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--trials', type=int, default=3,
+                        help='Dynamic trials per session.')
+    parser.add_argument('--cameras', type=int, default=2)
+    parser.add_argument('--file-size', type=int, default=200000)
+    parser.add_argument('--video-size', type=int, default=2000000)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Delay before each response (s).')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Bytes/s per media response.')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--truncate-rate', type=float, default=0)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8],
+                        help='Values of n_workers to benchmark.')
+    parser.add_argument('--no-videos', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = MockOpenCapAPI(
+        latency=args.latency, bandwidth=args.bandwidth,
+        failure_rate=args.failure_rate, truncate_rate=args.truncate_rate,
+        n_sessions=args.sessions, n_trials=args.trials,
+        n_cameras=args.cameras, file_size=args.file_size,
+        video_size=args.video_size).start()
+    # The token is resolved on the first API call.
+    os.environ['API_TOKEN'] = 'mock'
+    set_api_url(server.url)
+    import utils
+    import utilsBatchDownload
+    utils.GEOMETRY_URL = server.geometry_url
+
+    sessionList = list(server.data.sessions)
+    downloadVideos = not args.no_videos
+    results = []
+    try:
+        for n_workers in args.workers:
+            results.append(run_benchmark(
+                'download_session n_workers={}'.format(n_workers), server,
+                lambda folder: [e for session_id in sessionList for e in
+                                utils.download_session(
+                                    session_id, sessionBasePath=folder,
+                                    downloadVideos=downloadVideos,
+                                    n_workers=n_workers)],
+                verbose=args.verbose))
+        results.append(run_benchmark(
+            'download_kinematics', server,
+            lambda folder: download_kinematics(sessionList, folder),
+            verbose=args.verbose))
+        for n_workers in args.workers:
+            results.append(run_benchmark(
+                'batch download n_workers={}'.format(n_workers), server,
+                lambda folder: [error for session in
+                                utilsBatchDownload.download_sessions(
+                                    sessionList, sessionBasePath=folder,
+                                    downloadVideos=downloadVideos,
+                                    max_sessions=len(sessionList),
+                                    n_workers_per_session=n_workers,
+                                    verbose=False)['sessions'].values()
+                                for error in session['errors']],
+                verbose=args.verbose))
+    finally:
+        server.stop()
+
+    return results
+
+if __name__ == '__main__':
+    main()
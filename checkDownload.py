@@ -0,0 +1,76 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: checkDownload.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Checks download_session and download_kinematics, with and without
+# incremental sync (run twice, such that the second run uses the manifest),
+# against a local stand-in for the OpenCap API (utilsMockAPI): for a session
+# with its own calibration and neutral trials, and for a session using the
+# calibration and neutral trials of another session (meta
+# sessionWithCalibration and neutral_trial).
+#
+# Usage:
+#   python checkDownload.py
+
+import os
+import shutil
+import tempfile
+
+from utilsMockAPI import MockOpenCapAPI
+from utilsAPI import set_api_url
+
+def check_session(utils, session_id, folder):
+    # Raises an AssertionError if a download fails.
+    for sync in [False, True, True]:
+        sessionFolder = os.path.join(folder, 'sync' if sync else 'full')
+        errors = utils.download_session(session_id,
+                                        sessionBasePath=sessionFolder,
+                                        n_workers=4, sync=sync)
+        assert not errors, 'download_session(sync={}): {}'.format(sync, errors)
+        sessionPath = os.path.join(sessionFolder, 'OpenCapData_' + session_id)
+        for path in [os.path.join('Videos', 'mappingCamDevice.pickle'),
+                     'sessionMetadata.yaml']:
+            assert os.path.exists(os.path.join(sessionPath, path)), (
+                'download_session(sync={}): no {}'.format(sync, path))
+
+        kinematicsFolder = os.path.join(folder, 'kinematics_{}'.format(sync))
+        trialNames, modelName = utils.download_kinematics(
+            session_id, folder=kinematicsFolder, sync=sync)
+        assert trialNames and modelName, (
+            'download_kinematics(sync={}): {}, {}'.format(
+                sync, trialNames, modelName))
+
+if __name__ == '__main__':
+    server = MockOpenCapAPI(n_sessions=1, n_linked_sessions=1, n_trials=2,
+                            n_cameras=2, file_size=2000,
+                            video_size=20000).start()
+    folder = tempfile.mkdtemp(prefix='opencap_check_')
+    # The token is resolved on the first API call.
+    os.environ['API_TOKEN'] = 'mock'
+    os.environ['GEOMETRY_CACHE_DIR'] = os.path.join(folder, 'geometries')
+    set_api_url(server.url)
+    import utils
+    utils.GEOMETRY_URL = server.geometry_url
+    try:
+        for session_id, session in server.data.sessions.items():
+            check_session(utils, session_id, os.path.join(folder, session_id))
+            print('{} ({}): ok'.format(session['name'], session_id))
+    finally:
+        server.stop()
+        shutil.rmtree(folder, ignore_errors=True)
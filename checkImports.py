@@ -0,0 +1,84 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: checkImports.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Checks that importing utils does not import the modules only needed to
+# access the API (requests, utilsAuthentication) or to plot (matplotlib), such
+# that scripts that only process local data do not need to be logged in, and
+# that the import stays within a time budget. utils is imported in a new
+# interpreter, since this script's own imports would otherwise be in
+# sys.modules; the import time is the fastest of several runs, and does not
+# include the start of the interpreter.
+#
+# Usage:
+#   python checkImports.py
+#   python checkImports.py --budget 3 --runs 5
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules that must not be imported by import utils.
+UNEXPECTED_MODULES = ['requests', 'utilsAuthentication', 'matplotlib']
+
+def get_import_stats(module, unexpected=UNEXPECTED_MODULES):
+    # Returns the time (s) to import module in a new interpreter, and the
+    # modules of unexpected that are in sys.modules afterwards.
+    code = ('import sys, json, time; start = time.perf_counter(); '
+            'import {}; seconds = time.perf_counter() - start; '
+            'print(json.dumps([seconds, [m for m in {} if m in sys.modules]]))'
+            ).format(module, json.dumps(unexpected))
+    repoDir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, '-c', code], cwd=repoDir,
+                            capture_output=True, text=True)
+    if output.returncode != 0:
+        raise Exception('Could not import {}:\n{}'.format(module,
+                                                          output.stderr))
+    seconds, importedModules = json.loads(
+        output.stdout.strip().splitlines()[-1])
+
+    return seconds, importedModules
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Checks the modules imported by import utils, and the '
+                    'time it takes.')
+    parser.add_argument('--module', default='utils')
+    parser.add_argument('--budget', type=float, default=3,
+                        help='Maximum import time (s).')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    times = []
+    for run in range(args.runs):
+        seconds, importedModules = get_import_stats(args.module)
+        assert not importedModules, 'import {} imported {}.'.format(
+            args.module, ', '.join(importedModules))
+        times.append(seconds)
+    assert min(times) <= args.budget, (
+        'import {} took {:.2f} s, more than the budget of {:.2f} s.'.format(
+            args.module, min(times), args.budget))
+    print('import {} took {:.2f} s (budget: {:.2f} s), without importing '
+          '{}.'.format(args.module, min(times), args.budget,
+                       ', '.join(UNEXPECTED_MODULES)))
+
+if __name__ == '__main__':
+    main()
@@ -19,41 +19,341 @@
 '''
 
 import os
-import requests
-import urllib.request
+import copy
+import json
+import time
+import hashlib
+import functools
+import threading
 import shutil
 import numpy as np
 import pandas as pd
 import yaml
 import pickle
 import glob
-import zipfile
-import platform
+import concurrent.futures
+import tempfile
 import opensim
 
-from utilsAPI import get_api_url
-from utilsAuthentication import get_token
-import matplotlib.pyplot as plt
+import utilsCache
+from utilsArchive import SessionArchive
+from utilsWindows import iter_array_windows
+from decouple import config
+from utilsAPI import get_api_url, get_http_config, http_request, http_slot
 from scipy.signal.windows import gaussian
 
+# %% Authentication.
+# The API url and token are resolved on the first API call, not when utils is
+# imported: scripts that only process local data (eg, storage_to_numpy) do not
+# need to be logged in, and never prompt for credentials or touch the network.
+def get_token():
+    from utilsAuthentication import get_token
+    
+    return get_token()
 
-API_URL = get_api_url()
-API_TOKEN = get_token()
+def get_auth_headers(user_token=None):
+    if user_token is None:
+        user_token = get_token()
+        
+    return {"Authorization": "Token {}".format(user_token)}
+
+def __getattr__(name):
+    # utils.API_URL and utils.API_TOKEN, for backward compatibility.
+    if name == 'API_URL':
+        return get_api_url()
+    elif name == 'API_TOKEN':
+        return get_token()
+    raise AttributeError("module 'utils' has no attribute '{}'".format(name))
+
+
+def download_file(url, file_name, downloads=None, checksum=None):
+    # If downloads (a list) is provided, the download is not done but added
+    # to the list as (url, file_name), eg to be done concurrently later on.
+    # The file is downloaded to <file_name>.part and renamed to file_name once
+    # complete and verified, such that file_name never is a truncated file.
+    # The size is verified against the size announced by the server, and
+    # the content against checksum if provided ('md5:<hex>' or
+    # 'sha256:<hex>'). An interrupted download is resumed from the end of the
+    # .part file (HTTP Range request), including from an earlier run.
+    # Connection errors and 429/5xx responses are retried by the HTTP session
+    # (see utilsAPI.get_http_session); the errors it does not cover 
+    # (interrupted transfers, size or checksum mismatch) are retried here.
+    if downloads is not None:
+        downloads.append((url, file_name))
+        return
+    from requests.exceptions import RequestException
+    
+    partPath = file_name + '.part'
+    httpConfig = get_http_config()
+    for attempt in range(httpConfig['retries'] + 1):
+        try:
+            expectedSize = download_file_part(url, partPath)
+            partSize = os.path.getsize(partPath)
+            if expectedSize is not None and partSize != expectedSize:
+                raise IOError('Incomplete download of {}: {} of {} bytes.'.format(
+                    file_name, partSize, expectedSize))
+            if checksum is not None:
+                algorithm, expectedDigest = checksum.split(':', 1)
+                if get_file_digest(partPath, algorithm) != expectedDigest.lower():
+                    os.remove(partPath)
+                    raise ValueError('Checksum mismatch for {}.'.format(
+                        file_name))
+            break
+        except RequestException:
+            # Already retried by the HTTP session.
+            raise
+        except (OSError, ValueError):
+            if attempt == httpConfig['retries']:
+                raise
+            time.sleep(httpConfig['backoff'] * 2**attempt)
+    
+    os.replace(partPath, file_name)
+
+def get_file_digest(file_name, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+            
+    return digest.hexdigest()
+
+def parse_content_range(contentRange):
+    # 'bytes <start>-<end>/<total>' or 'bytes */<total>' -> (start, total),
+    # start and total are None if unknown.
+    units, _, rangeSpec = contentRange.partition(' ')
+    byteRange, _, total = rangeSpec.partition('/')
+    start = byteRange.split('-')[0]
+    return (int(start) if start.isdigit() else None,
+            int(total) if total.isdigit() else None)
+
+def download_file_part(url, partPath):
+    # Downloads url to partPath, continuing from the end of partPath if it
+    # exists. Returns the expected size of the complete file, or None if the
+    # server did not announce it.
+    from requests.exceptions import RequestException
+    
+    offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    with http_slot(url), http_request('GET', url, stream=True, 
+                                      headers=headers) as response:
+        if response.status_code == 416 and offset:
+            # Nothing left to download, or a .part file from another file.
+            _, total = parse_content_range(
+                response.headers.get('Content-Range', ''))
+            if total == offset:
+                return total
+            os.remove(partPath)
+            raise IOError('Invalid partial download {}.'.format(partPath))
+        response.raise_for_status()
+        
+        if response.status_code == 206:
+            start, total = parse_content_range(
+                response.headers.get('Content-Range', ''))
+            if start != offset:
+                os.remove(partPath)
+                raise IOError('Unexpected range for {}.'.format(partPath))
+            mode = 'ab'
+        else:
+            # Range not supported by the server: start from zero.
+            mode = 'wb'
+            total = response.headers.get('Content-Length')
+            # With content encoding (eg, gzip), the size of the decoded 
+            # content is not known.
+            if (total is not None and 
+                    response.headers.get('Content-Encoding', 'identity') == 
+                    'identity'):
+                total = int(total)
+            else:
+                total = None
+        try:
+            with open(partPath, mode) as out_file:
+                for chunk in response.iter_content(chunk_size=1024*1024):
+                    out_file.write(chunk)
+        except RequestException as e:
+            # Not retried by the HTTP session, see download_file.
+            raise IOError('Interrupted download of {}: {}'.format(
+                url, e)) from e
+    
+    return total
+
+# %% Cache of session and trial json.
+# Session and trial json are requested many times when downloading a session
+# (eg, get_session_json is called by get_calibration_trial_id,
+# get_neutral_trial_id, get_camera_mapping...). The cache is opt-in: it is
+# enabled for the duration of download_session and download_kinematics (see
+# api_cache), with entries valid for API_CACHE_DOWNLOAD_TTL seconds (default
+# 300), such that other callers always get the current json (eg, trial
+# status). Set API_CACHE_TTL (default 0) in the environment (.env) file, or
+# use set_api_cache, to enable it for all calls. Set API_CACHE_DIR to also
+# cache on disk, to be reused across runs. Note that trial json contain signed
+# media urls that expire, so long TTLs are not advised. Entries are
+# invalidated when a trial or session is modified with the functions below,
+# and can be invalidated with clear_api_cache.
+API_CACHE = {}
+API_CACHE_LOCK = threading.Lock()
+API_CACHE_SCOPES = 0
+
+def get_api_cache_settings():
+    if 'API_CACHE_SETTINGS' not in globals():
+        global API_CACHE_SETTINGS
+        API_CACHE_SETTINGS = {
+            'ttl': config('API_CACHE_TTL', default=0, cast=float),
+            'download_ttl': config('API_CACHE_DOWNLOAD_TTL', default=300, 
+                                   cast=float),
+            'cache_dir': config('API_CACHE_DIR', default='') or None}
+    
+    return API_CACHE_SETTINGS
+
+def set_api_cache(ttl=None, cache_dir=None, download_ttl=None):
+    # ttl in seconds, 0 disables the cache (outside of api_cache).
+    # cache_dir=False disables the disk cache.
+    settings = get_api_cache_settings()
+    if ttl is not None:
+        settings['ttl'] = ttl
+    if download_ttl is not None:
+        settings['download_ttl'] = download_ttl
+    if cache_dir is not None:
+        settings['cache_dir'] = cache_dir or None
+
+def get_api_cache_ttl():
+    settings = get_api_cache_settings()
+    if API_CACHE_SCOPES > 0:
+        return max(settings['ttl'], settings['download_ttl'])
+    
+    return settings['ttl']
+
+def api_cache(func):
+    # Decorator enabling the cache while func runs, including in the threads
+    # it starts. The in-memory entries are dropped when the last caller
+    # returns, unless the cache is enabled for all calls.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global API_CACHE_SCOPES
+        with API_CACHE_LOCK:
+            API_CACHE_SCOPES += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with API_CACHE_LOCK:
+                API_CACHE_SCOPES -= 1
+                if (API_CACHE_SCOPES == 0 and 
+                        get_api_cache_settings()['ttl'] <= 0):
+                    API_CACHE.clear()
+    
+    return wrapper
+
+def get_api_cache_path(key):
+    # Entries are specific to the API and the user.
+    name = hashlib.sha1('{}|{}|{}'.format(
+        get_api_url(), get_token(), key).encode()).hexdigest()
+    
+    return os.path.join(get_api_cache_settings()['cache_dir'], name + '.json')
+
+def get_api_cache_entry(key):
+    # Entry ({'time', 'json'}) of key in memory, else on disk, or None.
+    settings = get_api_cache_settings()
+    with API_CACHE_LOCK:
+        entry = API_CACHE.get(key)
+    if entry is None and settings['cache_dir'] is not None:
+        try:
+            with open(get_api_cache_path(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+    
+    return entry
+
+def get_cached_api_json(key):
+    # key is the path of the request relative to the API url, eg trials/<id>/.
+    # Returns (status_code, json); json is None if not json. Only successful
+    # responses are cached.
+    settings = get_api_cache_settings()
+    ttl = get_api_cache_ttl()
+    now = time.time()
+    if ttl > 0:
+        entry = get_api_cache_entry(key)
+        if entry is not None and now - entry['time'] < ttl:
+            return 200, copy.deepcopy(entry['json'])
+    
+    resp = http_request('GET', get_api_url() + key,
+        headers = get_auth_headers())
+    try:
+        data = resp.json()
+    except ValueError:
+        data = None
+    
+    if resp.status_code == 200 and ttl > 0:
+        entry = {'time': now, 'json': data}
+        with API_CACHE_LOCK:
+            API_CACHE[key] = entry
+        if settings['cache_dir'] is not None:
+            try:
+                os.makedirs(settings['cache_dir'], exist_ok=True)
+                cachePath = get_api_cache_path(key)
+                tmpPath = '{}.{}.{}.tmp'.format(cachePath, os.getpid(),
+                                                threading.get_ident())
+                with open(tmpPath, 'w') as f:
+                    json.dump(entry, f)
+                os.replace(tmpPath, cachePath)
+            except OSError:
+                pass
+        data = copy.deepcopy(data)
+            
+    return resp.status_code, data
+
+def clear_api_cache(key=None):
+    # Removes the entry of key (eg, trials/<id>/), or all entries if None.
+    settings = get_api_cache_settings()
+    with API_CACHE_LOCK:
+        if key is None:
+            API_CACHE.clear()
+        else:
+            API_CACHE.pop(key, None)
+    if settings['cache_dir'] is not None:
+        if key is None:
+            paths = glob.glob(os.path.join(glob.escape(settings['cache_dir']), 
+                                           '*.json'))
+        else:
+            paths = [get_api_cache_path(key)]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-def download_file(url, file_name):
-    with urllib.request.urlopen(url) as response, open(file_name, 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
+def invalidate_session_json(session_id):
+    clear_api_cache("sessions/{}/".format(session_id))
+    
+def invalidate_trial_json(trial_id):
+    # Session json embed the json of their trials, so the session of the
+    # trial is invalidated too: the one referenced by the cached trial json,
+    # and any cached session json listing the trial.
+    key = "trials/{}/".format(trial_id)
+    sessionIds = set()
+    entry = get_api_cache_entry(key)
+    if entry is not None and isinstance(entry['json'], dict):
+        if entry['json'].get('session'):
+            sessionIds.add(str(entry['json']['session']))
+    with API_CACHE_LOCK:
+        for cacheKey, cacheEntry in API_CACHE.items():
+            if (not cacheKey.startswith('sessions/') or 
+                    not isinstance(cacheEntry['json'], dict)):
+                continue
+            trials = cacheEntry['json'].get('trials') or []
+            if any(str(t.get('id')) == str(trial_id) for t in trials):
+                sessionIds.add(cacheKey.split('/')[1])
+    clear_api_cache(key)
+    for session_id in sessionIds:
+        invalidate_session_json(session_id)
 
 def get_session_json(session_id):
-    resp = requests.get(
-        API_URL + "sessions/{}/".format(session_id),
-        headers = {"Authorization": "Token {}".format(API_TOKEN)})
+    status_code, sessionJson = get_cached_api_json(
+        "sessions/{}/".format(session_id))
     
-    if resp.status_code == 500:
+    if status_code == 500:
         raise Exception('No server response. Likely not a valid session id.')
         
-    sessionJson = resp.json()
-    if 'trials' not in sessionJson.keys():
+    if not isinstance(sessionJson, dict) or 'trials' not in sessionJson:
         raise Exception('This session is not in your username, nor is it public. You do not have access.')
     
     # Sort trials by time recorded.
@@ -63,43 +363,149 @@ def get_session_json(session_id):
     
     return sessionJson
     
+def get_paginated_json(url, user_token=None):
+    # Items of a list endpoint, following the pages (next) of paginated
+    # responses ({'count', 'next', 'results'}).
+    response = http_request('GET', url, 
+                            headers = get_auth_headers(user_token)).json()
+    if not isinstance(response, dict) or 'results' not in response:
+        return response
+    items = list(response['results'])
+    while response.get('next'):
+        response = http_request('GET', response['next'], 
+                                headers = get_auth_headers(user_token)).json()
+        items += response['results']
+        
+    return items
+
 # Returns a list of all sessions of the user.
 def get_user_sessions():
-    sessions = requests.get(
-        API_URL + "sessions/valid/", 
-        headers = {"Authorization": "Token {}".format(API_TOKEN)}).json()
+    sessions = get_paginated_json(get_api_url() + "sessions/valid/")
     
     return sessions
 
 # Returns a list of all sessions of the user.
 # TODO: this also contains public sessions of other users.
-def get_user_sessions_all(user_token=API_TOKEN):
-    sessions = requests.get(
-        API_URL + "sessions/", 
-        headers = {"Authorization": "Token {}".format(user_token)}).json()
+def get_user_sessions_all(user_token=None):
+    sessions = get_paginated_json(get_api_url() + "sessions/", user_token)
     
     return sessions
 
 # Returns a list of all subjects of the user.
-def get_user_subjects(user_token=API_TOKEN):
-    subjects = requests.get(
-            API_URL + "subjects/", 
-            headers = {"Authorization": "Token {}".format(user_token)}).json()
+def get_user_subjects(user_token=None):
+    subjects = get_paginated_json(get_api_url() + "subjects/", user_token)
     
     return subjects
 
 # Returns a list of all sessions of a subject.
-def get_subject_sessions(subject_id, user_token=API_TOKEN):
-    sessions = requests.get(
-        API_URL + "subjects/{}/".format(subject_id),
-        headers = {"Authorization": "Token {}".format(user_token)}).json()['sessions']
+def get_subject_sessions(subject_id, user_token=None):
+    sessions = http_request('GET', 
+        get_api_url() + "subjects/{}/".format(subject_id),
+        headers = get_auth_headers(user_token)).json()['sessions']
     
     return sessions
 
+def get_session_index(subject_ids=None, session_ids=None, 
+                      include_trials=True, n_workers=8):
+    """Index of subjects, sessions, and trials, as a flat table.
+
+    Subjects, sessions, and trials are queried concurrently (n_workers 
+    threads) instead of one after the other.
+
+    Parameters
+    ----------
+    subject_ids : list, optional
+        Only index the sessions of these subjects.
+    session_ids : list, optional
+        Only index these sessions. If neither subject_ids nor session_ids
+        are provided, all sessions of the user are indexed (sessions of
+        the subjects of the user, and sessions without subject).
+    include_trials : bool
+        One row per trial (sessions without trials have one row with empty
+        trial fields), otherwise one row per session.
+    n_workers : int
+        Number of threads.
+    Returns
+    -------
+    index : pandas.DataFrame
+        Columns subject_id, subject_name, session_id, session_name, 
+        session_created_at, and, with include_trials, trial_id, trial_name,
+        trial_status, and trial_created_at. Sessions that could not be
+        queried are listed in index.attrs['errors'] as 
+        {'session_id', 'error'}.
+    """
+    
+    subjectNames = {subject['id']: subject.get('name') 
+                    for subject in get_user_subjects()}
+    sessionSubjects = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # Subjects -> sessions.
+        if session_ids is None:
+            if subject_ids is None:
+                subject_ids = list(subjectNames)
+                # Sessions without subject.
+                sessionFuture = executor.submit(get_user_sessions)
+            else:
+                sessionFuture = None
+            subjectFutures = {executor.submit(get_subject_sessions, subject_id): 
+                              subject_id for subject_id in subject_ids}
+            for future in concurrent.futures.as_completed(subjectFutures):
+                for session in future.result():
+                    session_id = session['id'] if isinstance(
+                        session, dict) else session
+                    sessionSubjects[str(session_id)] = subjectFutures[future]
+            if sessionFuture is not None:
+                for session in sessionFuture.result():
+                    sessionSubjects.setdefault(str(session['id']), None)
+            session_ids = list(sessionSubjects)
+        session_ids = [str(session_id) for session_id in session_ids]
+        
+        # Sessions -> trials.
+        sessionFutures = {executor.submit(get_session_json, session_id): 
+                          session_id for session_id in session_ids}
+        rows, errors = [], []
+        for future in concurrent.futures.as_completed(sessionFutures):
+            session_id = sessionFutures[future]
+            try:
+                session = future.result()
+            except Exception as e:
+                errors.append({'session_id': session_id, 'error': e})
+                continue
+            subject_id = sessionSubjects.get(session_id, session.get('subject'))
+            sessionRow = {
+                'subject_id': subject_id, 
+                'subject_name': subjectNames.get(subject_id),
+                'session_id': session_id, 'session_name': session.get('name'),
+                'session_created_at': session.get('created_at')}
+            if not include_trials:
+                rows.append(sessionRow)
+                continue
+            trials = session['trials'] or [{}]
+            for trial in trials:
+                rows.append(dict(sessionRow, 
+                    trial_id=trial.get('id'), trial_name=trial.get('name'),
+                    trial_status=trial.get('status'), 
+                    trial_created_at=trial.get('created_at')))
+    
+    columns = ['subject_id', 'subject_name', 'session_id', 'session_name',
+               'session_created_at']
+    if include_trials:
+        columns += ['trial_id', 'trial_name', 'trial_status', 
+                    'trial_created_at']
+    index = pd.DataFrame(rows, columns=columns)
+    # Order of the sessions requested, and of the trials in the sessions.
+    order = {session_id: k for k, session_id in enumerate(session_ids)}
+    index = index.iloc[index['session_id'].map(order).argsort(
+        kind='stable')].reset_index(drop=True)
+    index.attrs['errors'] = errors
+    for error in errors:
+        print('Could not index session {}: {}'.format(error['session_id'], 
+                                                      repr(error['error'])))
+    
+    return index
+
 def get_trial_json(trial_id):
-    trialJson = requests.get(
-        API_URL + "trials/{}/".format(trial_id),
-        headers = {"Authorization": "Token {}".format(API_TOKEN)}).json()
+    _, trialJson = get_cached_api_json("trials/{}/".format(trial_id))
     
     return trialJson
 
@@ -143,7 +549,7 @@ def get_camera_mapping(session_id, session_path):
         download_file(mappingURL, mappingPath)
     
 
-def get_model_and_metadata(session_id, session_path):
+def get_model_and_metadata(session_id, session_path, downloads=None):
     neutral_id = get_neutral_trial_id(session_id)
     trial = get_trial_json(neutral_id)
     resultTags = [res['tag'] for res in trial['results']]
@@ -152,7 +558,7 @@ def get_model_and_metadata(session_id, session_path):
     metadataPath = os.path.join(session_path,'sessionMetadata.yaml')
     if not os.path.exists(metadataPath) :
         metadataURL = trial['results'][resultTags.index('session_metadata')]['media']
-        download_file(metadataURL, metadataPath)
+        download_file(metadataURL, metadataPath, downloads=downloads)
     
     # Model.
     modelURL = trial['results'][resultTags.index('opensim_model')]['media']
@@ -161,7 +567,7 @@ def get_model_and_metadata(session_id, session_path):
     modelPath = os.path.join(modelFolder, modelName)
     if not os.path.exists(modelPath):
         os.makedirs(modelFolder, exist_ok=True)
-        download_file(modelURL, modelPath)
+        download_file(modelURL, modelPath, downloads=downloads)
         
     return modelName
 
@@ -185,7 +591,7 @@ def get_model_name_from_metadata(sessionFolder,appendText='_scaled'):
     return modelName
 
         
-def get_motion_data(trial_id, session_path):
+def get_motion_data(trial_id, session_path, downloads=None):
     trial = get_trial_json(trial_id)
     trial_name = trial['name']
     resultTags = [res['tag'] for res in trial['results']]
@@ -197,7 +603,7 @@ def get_motion_data(trial_id, session_path):
         os.makedirs(markerFolder, exist_ok=True)
         if not os.path.exists(markerPath):
             markerURL = trial['results'][resultTags.index('marker_data')]['media']
-            download_file(markerURL, markerPath)
+            download_file(markerURL, markerPath, downloads=downloads)
     
     # IK data.
     if 'ik_results' in resultTags:
@@ -206,7 +612,7 @@ def get_motion_data(trial_id, session_path):
         os.makedirs(ikFolder, exist_ok=True)
         if not os.path.exists(ikPath):
             ikURL = trial['results'][resultTags.index('ik_results')]['media']
-            download_file(ikURL, ikPath)
+            download_file(ikURL, ikPath, downloads=downloads)
         
     # Main settings
     if 'main_settings' in resultTags:
@@ -215,46 +621,149 @@ def get_motion_data(trial_id, session_path):
         os.makedirs(settingsFolder, exist_ok=True)
         if not os.path.exists(settingsPath):
             settingsURL = trial['results'][resultTags.index('main_settings')]['media']
-            download_file(settingsURL, settingsPath)
-        
+            download_file(settingsURL, settingsPath, downloads=downloads)
         
-def get_geometries(session_path, modelName='LaiUhlrich2022_scaled'):
         
+# %% Geometry cache.
+# The geometries (.vtp files) of the OpenSim models are the same for all
+# sessions. They are downloaded once, in parallel, into a cache shared by all
+# sessions, and linked into the session folders (hard links, or symbolic
+# links if hard links are not possible, eg across file systems; copies as a
+# last resort). Set GEOMETRY_CACHE_DIR in the environment (.env) file to
+# change the location of the cache (default: <temp dir>/opencap_geometries).
+# The cache is content-addressed: files are stored once in objects/<sha256>,
+# and urls/<sha1 of the url> contains the sha256 of the file downloaded from
+# that url. Since linked files share their content with the cache, geometry
+# files of sessions should not be modified in place; cached files are checked
+# against their sha256 before being linked, and downloaded again if they were.
+GEOMETRY_URL = ('https://mc-opencap-public.s3.us-west-2.amazonaws.com/'
+                'geometries_vtp/{}/{}.vtp')
+GEOMETRY_NAMES = {'LaiArnold': [
+    'capitate_lvs','capitate_rvs','hamate_lvs','hamate_rvs',
+    'hat_jaw','hat_ribs_scap','hat_skull','hat_spine','humerus_lv',
+    'humerus_rv','index_distal_lvs','index_distal_rvs',
+    'index_medial_lvs', 'index_medial_rvs','index_proximal_lvs',
+    'index_proximal_rvs','little_distal_lvs','little_distal_rvs',
+    'little_medial_lvs','little_medial_rvs','little_proximal_lvs',
+    'little_proximal_rvs','lunate_lvs','lunate_rvs','l_bofoot',
+    'l_femur','l_fibula','l_foot','l_patella','l_pelvis','l_talus',
+    'l_tibia','metacarpal1_lvs','metacarpal1_rvs',
+    'metacarpal2_lvs','metacarpal2_rvs','metacarpal3_lvs',
+    'metacarpal3_rvs','metacarpal4_lvs','metacarpal4_rvs',
+    'metacarpal5_lvs','metacarpal5_rvs','middle_distal_lvs',
+    'middle_distal_rvs','middle_medial_lvs','middle_medial_rvs',
+    'middle_proximal_lvs','middle_proximal_rvs','pisiform_lvs',
+    'pisiform_rvs','radius_lv','radius_rv','ring_distal_lvs',
+    'ring_distal_rvs','ring_medial_lvs','ring_medial_rvs',
+    'ring_proximal_lvs','ring_proximal_rvs','r_bofoot','r_femur',
+    'r_fibula','r_foot','r_patella','r_pelvis','r_talus','r_tibia',
+    'sacrum','scaphoid_lvs','scaphoid_rvs','thumb_distal_lvs',
+    'thumb_distal_rvs','thumb_proximal_lvs','thumb_proximal_rvs',
+    'trapezium_lvs','trapezium_rvs','trapezoid_lvs','trapezoid_rvs',
+    'triquetrum_lvs','triquetrum_rvs','ulna_lv','ulna_rv']}
+
+def get_geometry_model_type(modelName):
+    if modelName is not None and 'Lai' in modelName:
+        return 'LaiArnold'
+    else:
+        raise ValueError("Geometries not available for this model, please contact us")
+
+def get_geometry_cache_dir():
+    return config('GEOMETRY_CACHE_DIR', default=os.path.join(
+        tempfile.gettempdir(), 'opencap_geometries'))
+
+def get_cached_file(url, cacheDir=None):
+    # Returns the path of the file of url in the cache, downloading it if it
+    # is not in the cache yet.
+    if cacheDir is None:
+        cacheDir = get_geometry_cache_dir()
+    urlHash = hashlib.sha1(get_media_key(url).encode()).hexdigest()
+    urlPath = os.path.join(cacheDir, 'urls', urlHash)
+    try:
+        with open(urlPath, 'r') as f:
+            objectHash = f.read().strip()
+        objectPath = os.path.join(cacheDir, 'objects', objectHash)
+        if get_file_digest(objectPath) == objectHash:
+            return objectPath
+        # Modified (eg, through a link) or truncated file.
+        os.remove(objectPath)
+    except (OSError, ValueError):
+        pass
+    
+    os.makedirs(os.path.join(cacheDir, 'objects'), exist_ok=True)
+    os.makedirs(os.path.join(cacheDir, 'urls'), exist_ok=True)
+    tmpPath = os.path.join(cacheDir, 'objects', '{}.{}.{}.tmp'.format(
+        urlHash, os.getpid(), threading.get_ident()))
+    download_file(url, tmpPath)
+    objectHash = get_file_digest(tmpPath)
+    # Renaming is atomic, and a file with the same name has the same content.
+    objectPath = os.path.join(cacheDir, 'objects', objectHash)
+    os.replace(tmpPath, objectPath)
+    with open(tmpPath, 'w') as f:
+        f.write(objectHash)
+    os.replace(tmpPath, urlPath)
+    
+    return objectPath
+
+def link_file(src, dst):
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+def link_geometries(session_path, modelName='LaiUhlrich2022_scaled',
+                    n_workers=8):
+    # Links the geometries of the model into the session folder, downloading
+    # the ones missing from the cache with n_workers threads. Returns the
+    # errors, with keys step, path, and error (see download_session).
+    modelType = get_geometry_model_type(modelName)
     geometryFolder = os.path.join(session_path, 'OpenSimData', 'Model', 'Geometry')
+    os.makedirs(geometryFolder, exist_ok=True)
+    
+    def link_geometry(vtpName):
+        url = GEOMETRY_URL.format(modelType, vtpName)
+        link_file(get_cached_file(url), 
+                  os.path.join(geometryFolder, '{}.vtp'.format(vtpName)))
+    
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(link_geometry, vtpName): vtpName 
+                   for vtpName in GEOMETRY_NAMES[modelType]}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append({'step': 'geometry', 'error': e, 'path': 
+                    os.path.join(geometryFolder, futures[future] + '.vtp')})
+                
+    return errors
+        
+def get_geometries(session_path, modelName='LaiUhlrich2022_scaled',
+                   downloads=None, n_workers=8):
+    # If downloads (a list) is provided, the geometries missing from the
+    # session folder are added to it as (url, file_name), see download_file,
+    # instead of being linked from the cache.
     try:
-        # Download.
+        if downloads is None:
+            link_geometries(session_path, modelName=modelName, 
+                            n_workers=n_workers)
+            return
+        modelType = get_geometry_model_type(modelName)
+        geometryFolder = os.path.join(session_path, 'OpenSimData', 'Model', 
+                                      'Geometry')
         os.makedirs(geometryFolder, exist_ok=True)
-        if 'Lai' in modelName:
-            modelType = 'LaiArnold'
-            vtpNames = [
-                'capitate_lvs','capitate_rvs','hamate_lvs','hamate_rvs',
-                'hat_jaw','hat_ribs_scap','hat_skull','hat_spine','humerus_lv',
-                'humerus_rv','index_distal_lvs','index_distal_rvs',
-                'index_medial_lvs', 'index_medial_rvs','index_proximal_lvs',
-                'index_proximal_rvs','little_distal_lvs','little_distal_rvs',
-                'little_medial_lvs','little_medial_rvs','little_proximal_lvs',
-                'little_proximal_rvs','lunate_lvs','lunate_rvs','l_bofoot',
-                'l_femur','l_fibula','l_foot','l_patella','l_pelvis','l_talus',
-                'l_tibia','metacarpal1_lvs','metacarpal1_rvs',
-                'metacarpal2_lvs','metacarpal2_rvs','metacarpal3_lvs',
-                'metacarpal3_rvs','metacarpal4_lvs','metacarpal4_rvs',
-                'metacarpal5_lvs','metacarpal5_rvs','middle_distal_lvs',
-                'middle_distal_rvs','middle_medial_lvs','middle_medial_rvs',
-                'middle_proximal_lvs','middle_proximal_rvs','pisiform_lvs',
-                'pisiform_rvs','radius_lv','radius_rv','ring_distal_lvs',
-                'ring_distal_rvs','ring_medial_lvs','ring_medial_rvs',
-                'ring_proximal_lvs','ring_proximal_rvs','r_bofoot','r_femur',
-                'r_fibula','r_foot','r_patella','r_pelvis','r_talus','r_tibia',
-                'sacrum','scaphoid_lvs','scaphoid_rvs','thumb_distal_lvs',
-                'thumb_distal_rvs','thumb_proximal_lvs','thumb_proximal_rvs',
-                'trapezium_lvs','trapezium_rvs','trapezoid_lvs','trapezoid_rvs',
-                'triquetrum_lvs','triquetrum_rvs','ulna_lv','ulna_rv']
-        else:
-            raise ValueError("Geometries not available for this model")                
-        for vtpName in vtpNames:
-            url = 'https://mc-opencap-public.s3.us-west-2.amazonaws.com/geometries_vtp/{}/{}.vtp'.format(modelType, vtpName)
-            filename = os.path.join(geometryFolder, '{}.vtp'.format(vtpName))                
-            download_file(url, filename)
+        for vtpName in GEOMETRY_NAMES[modelType]:
+            filename = os.path.join(geometryFolder, '{}.vtp'.format(vtpName))
+            if not os.path.exists(filename):
+                download_file(GEOMETRY_URL.format(modelType, vtpName), 
+                              filename, downloads=downloads)
     except:
         pass
     
@@ -264,7 +773,9 @@ def import_metadata(filePath):
     
     return parsedYamlFile
     
-def download_kinematics(session_id, folder=None, trialNames=None):
+@api_cache
+def download_kinematics(session_id, folder=None, trialNames=None, 
+                        sync=False):
     
     # Login to access opencap data from server. 
     
@@ -273,15 +784,53 @@ def download_kinematics(session_id, folder=None, trialNames=None):
         folder = os.getcwd()    
     os.makedirs(folder, exist_ok=True)
     
+    # Incremental sync: only download the results that are new or changed
+    # since the last sync, see load_sync_manifest.
+    manifest = load_sync_manifest(folder) if sync else None
+    def sync_trial(trial_id, get_data):
+        # get_data(downloads) lists the files of the trial to download.
+        if manifest is None:
+            return get_data(None)
+        trialDict = get_sync_trial(trialDicts, trial_id)
+        if is_trial_synced(manifest, folder, trialDict, videos=False):
+            return
+        downloads = []
+        result = get_data(downloads)
+        trial = get_trial_json(trialDict['id'])
+        for url, file_name in get_sync_downloads(manifest, folder, trial, 
+                                                 downloads):
+            download_file(url, file_name)
+            record_sync_download(manifest, folder, trial, url, file_name)
+        record_sync_trial(manifest, trialDict, videos=False)
+        save_sync_manifest(folder, manifest)
+        
+        return result
+    
+    # Session trials.
+    sessionJson = get_session_json(session_id)
+    if manifest is not None:
+        trialDicts = {t['id']: t for t in sessionJson['trials']}
+    
     # Model and metadata.
     neutral_id = get_neutral_trial_id(session_id)
-    get_motion_data(neutral_id, folder)
-    modelName = get_model_and_metadata(session_id, folder)
+    def get_neutral_data(downloads):
+        get_motion_data(neutral_id, folder, downloads=downloads)
+        return get_model_and_metadata(session_id, folder, downloads=downloads)
+    modelName = sync_trial(neutral_id, get_neutral_data)
+    if modelName is None:
+        # Synced neutral trial: the model name is in the manifest, unless it
+        # predates it, in which case the model metadata is downloaded again
+        # (existing files are skipped).
+        modelName = manifest.get('modelName')
+    if modelName is None:
+        modelName = get_model_and_metadata(session_id, folder)
+    if manifest is not None and manifest.get('modelName') != modelName:
+        manifest['modelName'] = modelName
+        save_sync_manifest(folder, manifest)
     # Remove extension from modelName
     modelName = modelName.replace('.osim','')
     
     # Session trial names.
-    sessionJson = get_session_json(session_id)
     sessionTrialNames = [t['name'] for t in sessionJson['trials']]
     if trialNames != None:
         [print(t + ' not in session trial names.') 
@@ -293,7 +842,8 @@ def download_kinematics(session_id, folder=None, trialNames=None):
         if trialNames is not None and trialDict['name'] not in trialNames:
             continue        
         trial_id = trialDict['id']
-        get_motion_data(trial_id,folder)
+        sync_trial(trial_id, lambda downloads: get_motion_data(
+            trial_id, folder, downloads=downloads))
         loadedTrialNames.append(trialDict['name'])
         
     # Remove 'calibration' and 'neutral' from loadedTrialNames.    
@@ -331,7 +881,38 @@ def get_trial_id(session_id,trial_name):
     return trial_id[0]
 
 # %%  Storage file to numpy array.
-def storage_to_numpy(storage_file, excess_header_entries=0):
+# Same field names as np.genfromtxt(..., names=True), ie the rules of 
+# numpy's (private) NameValidator with its default settings: characters that
+# are not valid in field names are deleted, empty names are replaced by f0,
+# f1, ..., names excluded by numpy.genfromtxt (NameValidator defaults: return,
+# file, print) get a trailing underscore, and duplicates get a _1, _2, ...
+# suffix.
+_storage_name_deletechars = set(r""" !#$%&'()*+,-./:;<=>?@[\]^{|}~""")
+_storage_name_excludelist = ['return', 'file', 'print']
+
+def validate_storage_names(column_names):
+    
+    names = []
+    seen = {}
+    nbempty = 0
+    for name in column_names:
+        name = name.strip().replace(' ', '_')
+        name = ''.join([c for c in name if not c in _storage_name_deletechars])
+        if name == '':
+            name = 'f%i' % nbempty
+            while name in column_names:
+                nbempty += 1
+                name = 'f%i' % nbempty
+            nbempty += 1
+        elif name in _storage_name_excludelist:
+            name += '_'
+        count = seen.get(name, 0)
+        names.append(name + '_%d' % count if count > 0 else name)
+        seen[name] = count + 1
+        
+    return names
+
+def storage_to_numpy(storage_file, excess_header_entries=0, columns=None):
     """Returns the data from a storage file in a numpy format. Skips all lines
     up to and including the line that says 'endheader'.
     Parameters
@@ -347,50 +928,172 @@ def storage_to_numpy(storage_file, excess_header_entries=0):
         We'll ignore this many header row entries from the end of the header
         row. This argument allows for a hacky fix to an issue that arises from
         Static Optimization '.sto' outputs.
+    columns : list of str, optional
+        Names of the columns to parse. Other columns are skipped by the
+        parser. All columns are returned if None.
     Examples
     --------
     Columns from the storage file can be obtained as follows:
         >>> data = storage2numpy('<filename>')
         >>> data['ground_force_vy']
+        >>> data = storage2numpy('<filename>', columns=['time', 'pelvis_ty'])
     """
-    # What's the line number of the line containing 'endheader'?
-    f = open(storage_file, 'r')
-
-    header_line = False
-    for i, line in enumerate(f):
-        if header_line:
-            column_names = line.split()
-            break
-        if line.count('endheader') != 0:
-            line_number_of_line_containing_endheader = i + 1
-            header_line = True
-    f.close()
-
-    # With this information, go get the data.
-    if excess_header_entries == 0:
-        names = True
-        skip_header = line_number_of_line_containing_endheader
+    # Parsed files are memory-mapped from the sidecar cache if enabled.
+    if utilsCache.is_cache_enabled():
+        data, _ = utilsCache.load_cached(
+            storage_file, 
+            lambda path: (parse_storage(path, excess_header_entries), {}),
+            tag='storage{}'.format(excess_header_entries))
+        if columns is not None:
+            columns = list(dict.fromkeys(columns))
+            missing = [c for c in columns if not c in data.dtype.names]
+            if missing:
+                raise ValueError('Columns {} not in {}.'.format(
+                    missing, storage_file))
+            data = data[columns]
     else:
-        names = column_names[:-excess_header_entries]
-        skip_header = line_number_of_line_containing_endheader + 1
-    data = np.genfromtxt(storage_file, names=names,
-            skip_header=skip_header)
+        data = parse_storage(storage_file, excess_header_entries, columns)
+        
+    # Like np.genfromtxt, a single row is returned as a 0-d structured array.
+    if data.shape == (1,):
+        data = data.reshape(())
 
     return data
 
+def parse_storage(storage_file, excess_header_entries=0, columns=None):
+    
+    # The header is read once; the same file handle is then passed on to the
+    # (C-backed) pandas parser such that the file is only traversed once.
+    with open(storage_file, 'r') as f:
+        names, usecols = read_storage_header(
+            f, storage_file, excess_header_entries, columns)
+        data = pd.read_csv(f, sep=r'\s+', header=None, comment='#',
+                           usecols=sorted(usecols), engine='c')
+    
+    return storage_columns_to_numpy(data, names, usecols)
+
+# Reads the header of an open storage file up to and including the row with
+# the column names. Returns the column names and indices of the columns to
+# parse.
+def read_storage_header(f, storage_file, excess_header_entries=0, 
+                        columns=None):
+    
+    line = f.readline()
+    while line and line.count('endheader') == 0:
+        line = f.readline()
+    if not line:
+        raise ValueError('No endheader found in ' + storage_file + '.')
+    column_names = f.readline().split('#')[0].split()
+    if excess_header_entries > 0:
+        column_names = column_names[:-excess_header_entries]
+    names = validate_storage_names(column_names)
+    
+    if columns is None:
+        usecols = list(range(len(names)))
+    else:
+        columns = list(dict.fromkeys(columns))
+        missing = [c for c in columns if not c in names]
+        if missing:
+            raise ValueError('Columns {} not in {}.'.format(
+                missing, storage_file))
+        usecols = [names.index(c) for c in columns]
+        
+    return names, usecols
+
+def storage_columns_to_numpy(data, names, usecols):
+    
+    # Reorder as requested and view as a structured array.
+    values = np.ascontiguousarray(data[usecols].to_numpy(dtype=float))
+    dtype = [(names[i], float) for i in usecols]
+    
+    return values.view(dtype=dtype).reshape(-1)
+
+# %%  Storage file to numpy arrays, window by window.
+def iter_storage_windows(storage_file, window_size, overlap=0, columns=None,
+                         excess_header_entries=0):
+    """Reads a storage file window by window, such that memory use does not
+    depend on the length of the trial. Yields structured arrays with the same
+    format as storage_to_numpy, with `window_size` rows (the last window may
+    be shorter), consecutive windows sharing `overlap` rows.
+    Examples
+    --------
+        >>> for data in iter_storage_windows('<filename>', 500, overlap=100,
+                                             columns=['time', 'pelvis_ty']):
+        >>>     data['pelvis_ty']
+    """
+    with open(storage_file, 'r') as f:
+        names, usecols = read_storage_header(
+            f, storage_file, excess_header_entries, columns)
+        with pd.read_csv(f, sep=r'\s+', header=None, comment='#',
+                         usecols=sorted(usecols), engine='c', 
+                         chunksize=max(window_size - overlap, 1)) as reader:
+            chunks = (storage_columns_to_numpy(chunk, names, usecols)
+                      for chunk in reader)
+            for _, window in iter_array_windows(chunks, window_size, overlap):
+                yield window
+
 # %%  Storage file to dataframe.
 def storage_to_dataframe(storage_file, headers):
     # Extract data
-    data = storage_to_numpy(storage_file)
+    data = storage_to_numpy(storage_file, columns=['time'] + list(headers))
     out = pd.DataFrame(data=data['time'], columns=['time'])    
     for count, header in enumerate(headers):
         out.insert(count + 1, header, data[header])    
     
     return out
 
+# %% Load storage as OpenSim TimeSeriesTable.
+def load_time_series_table(file_path):
+    
+    if not utilsCache.is_cache_enabled():
+        return opensim.TimeSeriesTable(file_path)
+    
+    # Parsed tables are memory-mapped from the sidecar cache. The table is
+    # then rebuilt from the binary data, skipping the text parsing.
+    def parse(path):
+        table = opensim.TimeSeriesTable(path)
+        data = np.hstack((
+            np.asarray(table.getIndependentColumn()).reshape(-1, 1),
+            table.getMatrix().to_numpy()))
+        # Only string entries (eg, inDegrees) are cached.
+        metadata = {'labels': list(table.getColumnLabels()),
+                    'tableMetaData': get_table_metadata_strings(table)}
+        return data, metadata
+    
+    data, metadata = utilsCache.load_cached(file_path, parse, tag='table')
+    
+    return numpy_to_time_series_table(data[:, 0], data[:, 1:], 
+                                      metadata['labels'],
+                                      metadata['tableMetaData'])
+
+# %% Numpy arrays to OpenSim TimeSeriesTable.
+def get_table_metadata_strings(table):
+    # String entries of the metadata of a table (eg, inDegrees), as a dict.
+    tableMetaData = {}
+    for key in table.getTableMetaDataKeys():
+        try:
+            tableMetaData[key] = table.getTableMetaDataString(key)
+        except Exception:
+            pass
+        
+    return tableMetaData
+
+def numpy_to_time_series_table(time, data, labels, tableMetaData=None):
+    # tableMetaData is a dict of string entries, eg {'inDegrees': 'yes'}.
+    table = opensim.TimeSeriesTable(
+        opensim.StdVectorDouble(np.asarray(time, dtype=float).tolist()),
+        opensim.Matrix.createFromMat(
+            np.ascontiguousarray(data, dtype=float)),
+        opensim.StdVectorString(list(labels)))
+    if tableMetaData is not None:
+        for key, value in tableMetaData.items():
+            table.addTableMetaDataString(key, value)
+        
+    return table
+
 # %% Load storage and output as dataframe or numpy
 def load_storage(file_path,outputFormat='numpy'):
-    table = opensim.TimeSeriesTable(file_path)    
+    table = load_time_series_table(file_path)
     data = table.getMatrix().to_numpy()
     time = np.asarray(table.getIndependentColumn()).reshape(-1, 1)
     data = np.hstack((time,data))
@@ -404,64 +1107,77 @@ def load_storage(file_path,outputFormat='numpy'):
         return None    
     
 # %%  Numpy array to storage file.
-def numpy_to_storage(labels, data, storage_file, datatype=None):
+def numpy_to_storage(labels, data, storage_file, datatype=None, 
+                     chunk_size=10000):
+    """Writes a numpy array to an OpenSim storage (.sto/.mot) file.
+    
+    The header is assembled once and the data block is formatted in bulk,
+    chunk_size rows at a time, such that memory remains bounded for large
+    arrays. Each entry is formatted as '%20.8f' followed by a tab.
+    """
     
     assert data.shape[1] == len(labels), "# labels doesn't match columns"
     assert labels[0] == "time"
     
-    f = open(storage_file, 'w')
+    header = storage_header(labels, data, storage_file, datatype=datatype)
+    
+    # One format string per row, repeated for each row of a chunk.
+    row_format = '%20.8f\t' * data.shape[1] + '\n'
+    with open(storage_file, 'w') as f:
+        f.write(header)
+        for i in range(0, data.shape[0], chunk_size):
+            chunk = np.asarray(data[i:i+chunk_size, :], dtype=float)
+            f.write((row_format * chunk.shape[0]) % tuple(chunk.ravel()))
+
+# %%  Header of storage file.
+def storage_header(labels, data, storage_file, datatype=None):
+    
+    header = []
     # Old style
     if datatype is None:
-        f = open(storage_file, 'w')
-        f.write('name %s\n' %storage_file)
-        f.write('datacolumns %d\n' %data.shape[1])
-        f.write('datarows %d\n' %data.shape[0])
-        f.write('range %f %f\n' %(np.min(data[:, 0]), np.max(data[:, 0])))
-        f.write('endheader \n')
+        header.append('name %s\n' %storage_file)
+        header.append('datacolumns %d\n' %data.shape[1])
+        header.append('datarows %d\n' %data.shape[0])
+        header.append('range %f %f\n' %(np.min(data[:, 0]), np.max(data[:, 0])))
+        header.append('endheader \n')
     # New style
     else:
         if datatype == 'IK':
-            f.write('Coordinates\n')
+            header.append('Coordinates\n')
         elif datatype == 'ID':
-            f.write('Inverse Dynamics Generalized Forces\n')
+            header.append('Inverse Dynamics Generalized Forces\n')
         elif datatype == 'GRF':
-            f.write('%s\n' %storage_file)
+            header.append('%s\n' %storage_file)
         elif datatype == 'muscle_forces':
-            f.write('ModelForces\n')
-        f.write('version=1\n')
-        f.write('nRows=%d\n' %data.shape[0])
-        f.write('nColumns=%d\n' %data.shape[1])    
+            header.append('ModelForces\n')
+        header.append('version=1\n')
+        header.append('nRows=%d\n' %data.shape[0])
+        header.append('nColumns=%d\n' %data.shape[1])    
         if datatype == 'IK':
-            f.write('inDegrees=yes\n\n')
-            f.write('Units are S.I. units (second, meters, Newtons, ...)\n')
-            f.write("If the header above contains a line with 'inDegrees', this indicates whether rotational values are in degrees (yes) or radians (no).\n\n")
+            header.append('inDegrees=yes\n\n')
+            header.append('Units are S.I. units (second, meters, Newtons, ...)\n')
+            header.append("If the header above contains a line with 'inDegrees', this indicates whether rotational values are in degrees (yes) or radians (no).\n\n")
         elif datatype == 'ID':
-            f.write('inDegrees=no\n')
+            header.append('inDegrees=no\n')
         elif datatype == 'GRF':
-            f.write('inDegrees=yes\n')
+            header.append('inDegrees=yes\n')
         elif datatype == 'muscle_forces':
-            f.write('inDegrees=yes\n\n')
-            f.write('This file contains the forces exerted on a model during a simulation.\n\n')
-            f.write("A force is a generalized force, meaning that it can be either a force (N) or a torque (Nm).\n\n")
-            f.write('Units are S.I. units (second, meters, Newtons, ...)\n')
-            f.write('Angles are in degrees.\n\n')
+            header.append('inDegrees=yes\n\n')
+            header.append('This file contains the forces exerted on a model during a simulation.\n\n')
+            header.append("A force is a generalized force, meaning that it can be either a force (N) or a torque (Nm).\n\n")
+            header.append('Units are S.I. units (second, meters, Newtons, ...)\n')
+            header.append('Angles are in degrees.\n\n')
             
-        f.write('endheader \n')
+        header.append('endheader \n')
     
-    for i in range(len(labels)):
-        f.write('%s\t' %labels[i])
-    f.write('\n')
+    header.append(''.join(['%s\t' %label for label in labels]) + '\n')
     
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            f.write('%20.8f\t' %data[i, j])
-        f.write('\n')
-        
-    f.close()
+    return ''.join(header)
 
 def download_videos_from_server(session_id,trial_id,
                              isCalibration=False, isStaticPose=False,
-                             trial_name= None, session_path = None):
+                             trial_name= None, session_path = None,
+                             downloads=None):
     
     if session_path is None:
         data_dir = os.getcwd() 
@@ -469,9 +1185,7 @@ def download_videos_from_server(session_id,trial_id,
     if not os.path.exists(session_path): 
         os.makedirs(session_path, exist_ok=True)
     
-    resp = requests.get("{}trials/{}/".format(API_URL,trial_id),
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-    trial = resp.json()
+    trial = get_trial_json(trial_id)
     if trial_name is None:
         trial_name = trial['name']
     trial_name = trial_name.replace(' ', '')
@@ -486,7 +1200,7 @@ def download_videos_from_server(session_id,trial_id,
         for k, video in enumerate(trial["videos"]):
             os.makedirs(os.path.join(session_path, "Videos", "Cam{}".format(k), "InputMedia", trial_name), exist_ok=True)
             video_path = os.path.join(session_path, "Videos", "Cam{}".format(k), "InputMedia", trial_name, trial_name + ".mov")
-            download_file(video["video"], video_path)                
+            download_file(video["video"], video_path, downloads=downloads)
             mappingCamDevice[video["device_id"].replace('-', '').upper()] = k
         with open(os.path.join(session_path, "Videos", 'mappingCamDevice.pickle'), 'wb') as handle:
             pickle.dump(mappingCamDevice, handle)
@@ -494,8 +1208,8 @@ def download_videos_from_server(session_id,trial_id,
         with open(os.path.join(session_path, "Videos", 'mappingCamDevice.pickle'), 'rb') as handle:
             mappingCamDevice = pickle.load(handle) 
             # ensure upper on deviceID
-            for dID in mappingCamDevice.keys():
-                mappingCamDevice[dID.upper()] = mappingCamDevice.pop(dID)
+            mappingCamDevice = {dID.upper(): k for dID, k in 
+                                mappingCamDevice.items()}
         for video in trial["videos"]:            
             k = mappingCamDevice[video["device_id"].replace('-', '').upper()] 
             videoDir = os.path.join(session_path, "Videos", "Cam{}".format(k), "InputMedia", trial_name)
@@ -503,17 +1217,16 @@ def download_videos_from_server(session_id,trial_id,
             video_path = os.path.join(videoDir, trial_name + ".mov")
             if not os.path.exists(video_path):
                 if video['video'] :
-                    download_file(video["video"], video_path)
+                    download_file(video["video"], video_path,
+                                  downloads=downloads)
               
     return trial_name
    
     
-def get_calibration(session_id,session_path):
+def get_calibration(session_id,session_path,downloads=None):
     calibration_id = get_calibration_trial_id(session_id)
 
-    resp = requests.get("{}trials/{}/".format(API_URL,calibration_id),
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-    trial = resp.json()
+    trial = get_trial_json(calibration_id)
     calibResultTags = [res['tag'] for res in trial['results']]
    
     videoFolder = os.path.join(session_path,'Videos')
@@ -525,19 +1238,19 @@ def get_calibration(session_id,session_path):
     mapURL = trial['results'][calibResultTags.index('camera_mapping')]['media']
     mapLocalPath = os.path.join(videoFolder,'mappingCamDevice.pickle')
 
-    download_and_switch_calibration(session_id,session_path,calibTrialID=calibration_id)
+    download_and_switch_calibration(session_id,session_path,calibTrialID=calibration_id,
+                                    downloads=downloads)
     
     # Download mapping
     if len(glob.glob(mapLocalPath)) == 0:
-        download_file(mapURL,mapLocalPath)
+        download_file(mapURL,mapLocalPath,downloads=downloads)
                         
 
-def download_and_switch_calibration(session_id,session_path,calibTrialID = None):
+def download_and_switch_calibration(session_id,session_path,calibTrialID = None,
+                                    downloads=None):
     if calibTrialID == None:
         calibTrialID = get_calibration_trial_id(session_id)
-    resp = requests.get("https://api.opencap.ai/trials/{}/".format(calibTrialID),
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-    trial = resp.json()
+    trial = get_trial_json(calibTrialID)
        
     calibURLs = {t['device_id']:t['media'] for t in trial['results'] if t['tag'] == 'calibration_parameters_options'}
     calibImgURLs = {t['device_id']:t['media'] for t in trial['results'] if t['tag'] == 'calibration-img'}
@@ -556,41 +1269,204 @@ def download_and_switch_calibration(session_id,session_path,calibTrialID = None)
             file_name = os.path.join(camDir,'cameraIntrinsicsExtrinsics.pickle')
             img_fileName = os.path.join(calibImgFolder,'calib_img' + cam + imgExtension)
             if calibNum == 0:
-                download_file(calibURLs[cam+'_soln0'], file_name)
-                download_file(calibImgURLs[cam],img_fileName)
+                download_file(calibURLs[cam+'_soln0'], file_name, downloads=downloads)
+                download_file(calibImgURLs[cam],img_fileName, downloads=downloads)
             elif calibNum == 1:
-                download_file(calibURLs[cam+'_soln1'], file_name) 
-                download_file(calibImgURLs[cam + '_altSoln'],img_fileName)
+                download_file(calibURLs[cam+'_soln1'], file_name, downloads=downloads) 
+                download_file(calibImgURLs[cam + '_altSoln'],img_fileName, downloads=downloads)
                 
             
+# %% Uploads.
+# Files are streamed from disk in chunks as multipart/form-data (instead of
+# being loaded in memory to build the request), and uploads are retried with
+# exponential backoff on connection errors and 429/5xx responses
+# (HTTP_RETRIES, HTTP_BACKOFF, see utilsAPI.get_http_config). Note that an
+# upload that reached the server before the connection failed may then be
+# posted twice.
+class MultipartFileStream:
+    """multipart/form-data body with form fields and one file.
+
+    The file is read in chunks while the body is sent. Fields are encoded
+    like requests does (iterable values give one field per item).
+
+    """
+    def __init__(self, fields, fileField, filePath):
+        self.boundary = os.urandom(16).hex()
+        self.filePath = filePath
+        head = b''
+        for name, values in fields.items():
+            if isinstance(values, (str, bytes)) or not hasattr(values, '__iter__'):
+                values = [values]
+            for value in values:
+                if value is None:
+                    continue
+                if not isinstance(value, bytes):
+                    value = str(value).encode()
+                head += ('--{}\r\nContent-Disposition: form-data; '
+                         'name="{}"\r\n\r\n'.format(self.boundary, name).encode()
+                         + value + b'\r\n')
+        head += ('--{}\r\nContent-Disposition: form-data; name="{}"; '
+                 'filename="{}"\r\nContent-Type: application/octet-stream'
+                 '\r\n\r\n'.format(self.boundary, fileField, 
+                                      os.path.basename(filePath)).encode())
+        self.head = head
+        self.tail = '\r\n--{}--\r\n'.format(self.boundary).encode()
+        self.file_size = os.path.getsize(filePath)
+        # Used by requests for the Content-Length header.
+        self.len = len(self.head) + self.file_size + len(self.tail)
+        self.file = None
+        self.rewind()
+    
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+    
+    def rewind(self):
+        self.close()
+        self.file = open(self.filePath, 'rb')
+        self.position = 0
+        
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        chunk = b''
+        while len(chunk) < size and self.position < self.len:
+            n = size - len(chunk)
+            fileEnd = len(self.head) + self.file_size
+            if self.position < len(self.head):
+                data = self.head[self.position:self.position + n]
+            elif self.position < fileEnd:
+                data = self.file.read(min(n, fileEnd - self.position))
+                if not data:
+                    raise IOError('{} changed during upload.'.format(
+                        self.filePath))
+            else:
+                start = self.position - fileEnd
+                data = self.tail[start:start + n]
+            chunk += data
+            self.position += len(data)
+            
+        return chunk
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def upload_file(url, fields, fileField, filePath):
+    # Streams filePath with form fields to url (POST), with retries (here
+    # only, not in the HTTP session, since the stream is rewound for each
+    # attempt). Returns the response of the last attempt.
+    from requests.exceptions import HTTPError, RequestException
+    
+    httpConfig = get_http_config()
+    stream = MultipartFileStream(fields, fileField, filePath)
+    headers = dict(get_auth_headers(), **{'Content-Type': stream.content_type})
+    try:
+        for attempt in range(httpConfig['retries'] + 1):
+            stream.rewind()
+            try:
+                response = http_request('POST', url, retries=False, 
+                                        data=stream, headers=headers)
+                if response.status_code != 429 and response.status_code < 500:
+                    return response
+                error = HTTPError('{} response'.format(response.status_code), 
+                                  response=response)
+            except RequestException as e:
+                error = e
+            if attempt < httpConfig['retries']:
+                time.sleep(httpConfig['backoff'] * 2**attempt)
+    finally:
+        stream.close()
+    
+    if isinstance(error, HTTPError):
+        return error.response
+    raise error
+
 def post_file_to_trial(filePath,trial_id,tag,device_id):
-    files = {'media': open(filePath, 'rb')}
     data = {
         "trial": trial_id,
         "tag": tag,
         "device_id" : device_id
     }
 
-    requests.post("{}results/".format(API_URL), files=files, data=data,
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-    files["media"].close()
+    response = upload_file("{}results/".format(get_api_url()), data, 'media',
+                           filePath)
+    invalidate_trial_json(trial_id)
+    
+    return response
 
 def post_video_to_trial(filePath,trial_id,device_id,parameters):
-    files = {'video': open(filePath, 'rb')}
     data = {
         "trial": trial_id,
         "device_id" : device_id,
         "parameters": parameters
     }
 
-    requests.post("{}videos/".format(API_URL), files=files, data=data,
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-    files["video"].close()
+    response = upload_file("{}videos/".format(get_api_url()), data, 'video',
+                           filePath)
+    invalidate_trial_json(trial_id)
+    
+    return response
+
+def post_files_to_trials(uploads, n_workers=4, verbose=True):
+    """Uploads results and videos concurrently.
+
+    Parameters
+    ----------
+    uploads : list of dict
+        Arguments of post_file_to_trial (filePath, trial_id, tag, device_id)
+        for results, or of post_video_to_trial (filePath, trial_id, 
+        device_id, parameters) for videos.
+    n_workers : int
+        Number of files uploaded at the same time.
+    verbose : bool
+        Print the throughput of each file.
+    Returns
+    -------
+    reports : list of dict
+        One per upload (same order), with keys filePath, trial_id, status
+        (succeeded or failed), status_code, bytes, seconds, and error.
+    """
+    
+    def upload(kwargs):
+        start = time.time()
+        report = {'filePath': kwargs['filePath'], 
+                  'trial_id': kwargs['trial_id'], 'status': 'failed',
+                  'status_code': None, 'bytes': None, 'seconds': None,
+                  'error': None}
+        try:
+            report['bytes'] = os.path.getsize(kwargs['filePath'])
+            if 'tag' in kwargs:
+                response = post_file_to_trial(**kwargs)
+            else:
+                response = post_video_to_trial(**kwargs)
+            report['status_code'] = response.status_code
+            response.raise_for_status()
+            report['status'] = 'succeeded'
+        except Exception as e:
+            report['error'] = e
+        report['seconds'] = time.time() - start
+        if verbose:
+            print('{} {}: {:.1f} MB in {:.1f} s ({:.1f} MB/s){}'.format(
+                report['status'], kwargs['filePath'], 
+                (report['bytes'] or 0) / 1e6, report['seconds'], 
+                (report['bytes'] or 0) / 1e6 / max(report['seconds'], 1e-6),
+                '' if report['error'] is None else 
+                ': ' + repr(report['error'])))
+        
+        return report
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        reports = list(executor.map(upload, uploads))
+        
+    return reports
 
 def delete_video_from_trial(video_id):
 
-    requests.delete("{}videos/{}/".format(API_URL, video_id),
-                        headers = {"Authorization": "Token {}".format(API_TOKEN)})
+    http_request('DELETE', "{}videos/{}/".format(get_api_url(), video_id),
+                        headers = get_auth_headers())
+    # The trial of the video is not known.
+    clear_api_cache()
     
 def delete_results(trial_id, tag=None, resultNum=None):
     # Delete specific result number, or all results with a specific tag, or all results if tag==None
@@ -605,8 +1481,9 @@ def delete_results(trial_id, tag=None, resultNum=None):
         resultNums = [r['id'] for r in trial['results']]
 
     for rNum in resultNums:
-        requests.delete(API_URL + "results/{}/".format(rNum),
-                        headers = {"Authorization": "Token {}".format(API_TOKEN)})
+        http_request('DELETE', get_api_url() + "results/{}/".format(rNum),
+                        headers = get_auth_headers())
+    invalidate_trial_json(trial_id)
         
 def set_trial_status(trial_id, status):
 
@@ -616,16 +1493,17 @@ def set_trial_status(trial_id, status):
     if status not in ['done', 'error', 'stopped', 'reprocess']:
         raise ValueError('Invalid status. Available statuses: done, error, stopped, reprocess')
 
-    requests.patch(API_URL+"trials/{}/".format(trial_id), data={'status': status},
-                     headers = {"Authorization": "Token {}".format(API_TOKEN)})
+    http_request('PATCH', get_api_url()+"trials/{}/".format(trial_id), data={'status': status},
+                     headers = get_auth_headers())
+    invalidate_trial_json(trial_id)
     
 def set_session_subject(session_id, subject_id):
-    requests.patch(API_URL+"sessions/{}/".format(session_id), data={'subject': subject_id},
-                     headers = {"Authorization": "Token {}".format(API_TOKEN)})  
+    http_request('PATCH', get_api_url()+"sessions/{}/".format(session_id), data={'subject': subject_id},
+                     headers = get_auth_headers())  
+    invalidate_session_json(session_id)
 
-def get_syncd_videos(trial_id,session_path):
-    trial = requests.get("{}trials/{}/".format(API_URL,trial_id),
-                         headers = {"Authorization": "Token {}".format(API_TOKEN)}).json()
+def get_syncd_videos(trial_id,session_path,downloads=None):
+    trial = get_trial_json(trial_id)
     trial_name = trial['name']
     
     if trial['results']:
@@ -638,11 +1516,155 @@ def get_syncd_videos(trial_id,session_path):
                     suff = suff[:lastIdx]
                 
                 syncVideoPath = os.path.join(session_path,'Videos',cam,'InputMedia',trial_name,trial_name + '_sync' + suff)
-                download_file(url,syncVideoPath)
+                download_file(url,syncVideoPath,downloads=downloads)
         
         
+# %% Incremental sync.
+# With sync=True, download_session and download_kinematics keep a manifest of
+# the downloaded files in <session_path>/syncManifest.json: for each file, the
+# trial and result (tag, device) it comes from and its media key (media url
+# without the signature, which changes when a result is replaced). Trials
+# whose updated_at did not change since the last sync are skipped without
+# querying them, and only new or changed files of the other trials are
+# downloaded.
+SYNC_MANIFEST_NAME = 'syncManifest.json'
+
+def get_media_key(url):
+    return url.split('?')[0]
+
+def load_sync_manifest(session_path):
+    try:
+        with open(os.path.join(session_path, SYNC_MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest.setdefault('trials', {})
+    manifest.setdefault('files', {})
+    
+    return manifest
+
+def save_sync_manifest(session_path, manifest):
+    os.makedirs(session_path, exist_ok=True)
+    manifestPath = os.path.join(session_path, SYNC_MANIFEST_NAME)
+    with open(manifestPath + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifestPath + '.tmp', manifestPath)
+    
+def get_trial_media(trial):
+    # Media of a trial (results and input videos) as 
+    # {media key: (tag, device_id, url)}.
+    media = {}
+    for result in trial['results']:
+        if result['media']:
+            media[get_media_key(result['media'])] = (
+                result['tag'], result['device_id'], result['media'])
+    for video in trial['videos']:
+        if video['video']:
+            media[get_media_key(video['video'])] = (
+                'video', video['device_id'], video['video'])
+            
+    return media
+    
+def is_trial_synced(manifest, session_path, trialDict, videos=True):
+    # True if the trial did not change since it was synced (with videos if 
+    # needed) and its files are still there.
+    entry = manifest['trials'].get(trialDict['id'])
+    if (entry is None or 'updated_at' not in trialDict or 
+            entry['updated_at'] != trialDict['updated_at'] or
+            (videos and not entry['videos'])):
+        return False
+    
+    return all(os.path.exists(os.path.join(session_path, path)) 
+               for path, file in manifest['files'].items() 
+               if file['trial_id'] == trialDict['id'])
+
+def get_sync_downloads(manifest, session_path, trial, downloads):
+    # Filters downloads (url, file_name) for a trial: files that exist and 
+    # were downloaded from the same media are dropped, and files whose result
+    # was replaced since the last sync are added (the download functions
+    # skip existing files).
+    syncDownloads = []
+    for url, file_name in downloads:
+        file = manifest['files'].get(os.path.relpath(file_name, session_path))
+        if (file is None or not os.path.exists(file_name) or 
+                file['media'] != get_media_key(url)):
+            syncDownloads.append((url, file_name))
+    if trial is None:
+        return syncDownloads
+    
+    current = {(tag, device_id): url for tag, device_id, url in 
+               get_trial_media(trial).values()}
+    listed = [file_name for _, file_name in syncDownloads]
+    for path, file in manifest['files'].items():
+        if file['trial_id'] != trial['id']:
+            continue
+        url = current.get((file['tag'], file['device_id']))
+        file_name = os.path.join(session_path, path)
+        if (url is not None and file['media'] != get_media_key(url) and 
+                file_name not in listed):
+            syncDownloads.append((url, file_name))
+    
+    return syncDownloads
+
+def record_sync_download(manifest, session_path, trial, url, file_name):
+    tag, device_id = None, None
+    if trial is not None:
+        tag, device_id, _ = get_trial_media(trial).get(get_media_key(url), 
+                                                       (None, None, None))
+    manifest['files'][os.path.relpath(file_name, session_path)] = {
+        'trial_id': None if trial is None else trial['id'], 'tag': tag, 
+        'device_id': device_id, 'media': get_media_key(url)}
+
+def get_sync_trial(trialDicts, trial_id):
+    # Trial of the session (trialDicts: {id: trial of session['trials']}), or
+    # the trial json for trials of other sessions (eg, the calibration trial
+    # of meta['sessionWithCalibration'], or meta['neutral_trial']).
+    trialDict = trialDicts.get(trial_id)
+    if trialDict is None:
+        trialDict = get_trial_json(trial_id)
+        
+    return trialDict
+
+def record_sync_trial(manifest, trialDict, videos=True):
+    manifest['trials'][trialDict['id']] = {
+        'name': trialDict['name'], 
+        'updated_at': trialDict.get('updated_at'), 'videos': videos}
+
+@api_cache
 def download_session(session_id, sessionBasePath= None,
-                     zipFolder=False,writeToDB=False, downloadVideos=True):
+                     zipFolder=False,writeToDB=False, downloadVideos=True,
+                     n_workers=1, sync=False):
+    """Downloads the data of a session.
+
+    Parameters
+    ----------
+    session_id : str
+    sessionBasePath : str, optional
+        The session is saved in <sessionBasePath>/OpenCapData_<session_id>.
+        Defaults to <current working directory>/Data.
+    zipFolder : bool
+        Also zip the session folder (<session folder>.zip), see 
+        utilsArchive.SessionArchive. Files are added as their download
+        completes; compression is single-threaded.
+    writeToDB : bool
+        Post the zipped session folder to the last dynamic trial.
+    downloadVideos : bool
+        Download the input videos.
+    n_workers : int
+        Number of threads used to query trials and download files
+        concurrently (motion data, calibration, and videos). Geometries are
+        linked from a cache shared by all sessions, see link_geometries.
+    sync : bool
+        Incremental sync: only download the results that are new or changed
+        since the last sync, see load_sync_manifest.
+    Returns
+    -------
+    errors : list of dict
+        Errors that occurred, with keys step (eg, calibration, or the name
+        of the trial), path (file that failed to download, None if the step
+        failed before downloading files), and error (the exception). The
+        session is downloaded as far as possible despite errors.
+    """
     print('\nDownloading {}'.format(session_id))
     
     if sessionBasePath is None:
@@ -653,95 +1675,185 @@ def download_session(session_id, sessionBasePath= None,
     
     calib_id = get_calibration_trial_id(session_id)
     neutral_id = get_neutral_trial_id(session_id)
-    dynamic_ids = [t['id'] for t in session['trials'] if (t['name'] != 'calibration' and t['name'] !='neutral')]  
-    
-    # Calibration
-    try:
+    dynamic_trials = [(t['id'], t['name']) for t in session['trials'] if (t['name'] != 'calibration' and t['name'] !='neutral')]  
+    dynamic_ids = [dynamic_id for dynamic_id, _ in dynamic_trials]
+    manifest = load_sync_manifest(session_path) if sync else None
+    if manifest is not None:
+        trialDicts = {t['id']: t for t in session['trials']}
+    
+    # Each step queries the trial(s) it needs and lists the files to download
+    # in downloads; the files are then downloaded by the worker pool.
+    def download_calibration(downloads):
         get_camera_mapping(session_id, session_path)
         if downloadVideos:
             download_videos_from_server(session_id,calib_id,
                                  isCalibration=True,isStaticPose=False,
-                                 session_path = session_path) 
+                                 session_path = session_path,
+                                 downloads=downloads) 
 
-        get_calibration(session_id,session_path)
-    except:
-        pass
-    
-    # Neutral
-    try:
-        modelName = get_model_and_metadata(session_id,session_path)
-        get_motion_data(neutral_id,session_path)
+        get_calibration(session_id,session_path,downloads=downloads)
+        
+    def download_neutral(downloads):
+        modelName = get_model_and_metadata(session_id,session_path,
+                                           downloads=downloads)
+        get_motion_data(neutral_id,session_path,downloads=downloads)
         if downloadVideos:
             download_videos_from_server(session_id,neutral_id,
                              isCalibration=False,isStaticPose=True,
-                             session_path = session_path)
+                             session_path = session_path,
+                             downloads=downloads)
 
-        get_syncd_videos(neutral_id,session_path)
-    except:
-        pass
+        get_syncd_videos(neutral_id,session_path,downloads=downloads)
+        
+        return modelName
+        
+    def download_dynamic(dynamic_id, downloads):
+        get_motion_data(dynamic_id,session_path,downloads=downloads)
+        if downloadVideos:
+            download_videos_from_server(session_id,dynamic_id,
+                     isCalibration=False,isStaticPose=False,
+                     session_path = session_path,
+                     downloads=downloads)
 
-    # Dynamic
-    for dynamic_id in dynamic_ids:
-        try:
-            get_motion_data(dynamic_id,session_path)
-            if downloadVideos:
-                download_videos_from_server(session_id,dynamic_id,
-                         isCalibration=False,isStaticPose=False,
-                         session_path = session_path)
-
-            get_syncd_videos(dynamic_id,session_path)
-        except:
-            pass
+        get_syncd_videos(dynamic_id,session_path,downloads=downloads)
         
+    def run_step(step, *args):
+        downloads = []
+        return step(*args, downloads), downloads
+    
     repoDir = os.path.dirname(os.path.abspath(__file__))
+    errors = []
+    
+    # Zip: files are added to the archive as their download completes.
+    session_zip = '{}.zip'.format(session_path)
+    if os.path.isfile(session_zip):
+        os.remove(session_zip)
+    archive = None
+    if zipFolder:
+        os.makedirs(session_path, exist_ok=True)
+        archive = SessionArchive(session_zip, session_path)
+        
+    modelName = None
+    fileFutures = {}
+    stepTrials = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        def finish_step(stepName, run, trial_id=None):
+            # run() returns the result of the step and the files to download.
+            try:
+                result, downloads = run()
+                trial = None
+                if manifest is not None:
+                    if trial_id is not None:
+                        trial = get_trial_json(trial_id)
+                    downloads = get_sync_downloads(manifest, session_path,
+                                                   trial, downloads)
+            except Exception as e:
+                errors.append({'step': stepName, 'path': None, 'error': e})
+                return None
+            stepTrials[stepName] = trial
+            for url, path in downloads:
+                fileFutures[executor.submit(download_file, url, path)] = (
+                    stepName, path, url)
+            return result
+        
+        def is_synced(trial_id):
+            return manifest is not None and is_trial_synced(
+                manifest, session_path, get_sync_trial(trialDicts, trial_id), 
+                videos=downloadVideos)
+        
+        # Calibration first: the camera mapping is needed to organize the
+        # videos of the other trials. If it is not available, the videos of
+        # the neutral trial define it, so the neutral trial goes next.
+        if not is_synced(calib_id):
+            finish_step('calibration', lambda: run_step(download_calibration),
+                        calib_id)
+        steps = [(dynamic_name, download_dynamic, (dynamic_id,), dynamic_id) 
+                 for dynamic_id, dynamic_name in dynamic_trials 
+                 if not is_synced(dynamic_id)]
+        if is_synced(neutral_id):
+            modelName = manifest.get('modelName')
+            if modelName is None:
+                # Manifest predating the model name.
+                modelName = get_model_and_metadata(session_id, session_path)
+        elif os.path.exists(os.path.join(session_path, 'Videos', 
+                                         'mappingCamDevice.pickle')):
+            steps.insert(0, ('neutral', download_neutral, (), neutral_id))
+        else:
+            modelName = finish_step('neutral', 
+                                    lambda: run_step(download_neutral),
+                                    neutral_id)
+        
+        # Other trials, concurrently.
+        stepFutures = {executor.submit(run_step, step, *args): 
+                       (stepName, trial_id)
+                       for stepName, step, args, trial_id in steps}
+        for future in concurrent.futures.as_completed(stepFutures):
+            stepName, trial_id = stepFutures[future]
+            result = finish_step(stepName, future.result, trial_id)
+            if stepName == 'neutral':
+                modelName = result
+            
+        # Geometry, from the cache shared by all sessions.
+        try:
+            errors += link_geometries(session_path, modelName=modelName)
+        except Exception as e:
+            errors.append({'step': 'geometry', 'path': None, 'error': e})
+            
+        for future in concurrent.futures.as_completed(fileFutures):
+            stepName, path, url = fileFutures[future]
+            try:
+                future.result()
+            except Exception as e:
+                errors.append({'step': stepName, 'path': path, 'error': e})
+                continue
+            if manifest is not None:
+                record_sync_download(manifest, session_path, 
+                                     stepTrials[stepName], url, path)
+            if archive is not None:
+                archive.add(path)
+    
+    # Trials downloaded without errors are synced.
+    if manifest is not None:
+        failedSteps = [error['step'] for error in errors]
+        for stepName, trial in stepTrials.items():
+            if trial is not None and stepName not in failedSteps:
+                record_sync_trial(manifest, 
+                                  get_sync_trial(trialDicts, trial['id']), 
+                                  videos=downloadVideos)
+        if modelName is not None:
+            manifest['modelName'] = modelName
+        save_sync_manifest(session_path, manifest)
     
     # Readme  
     try:        
         pathReadme = os.path.join(repoDir, 'Resources', 'README.txt')
         pathReadmeEnd = os.path.join(session_path, 'README.txt')
         shutil.copy2(pathReadme, pathReadmeEnd)
-    except:
-        pass
+    except Exception as e:
+        errors.append({'step': 'readme', 'path': None, 'error': e})
         
-    # Geometry
-    try:
-        if 'Lai' in modelName:
-            modelType = 'LaiArnold'
-        else:
-            raise ValueError("Geometries not available for this model, please contact us")
-        if platform.system() == 'Windows':
-            geometryDir = os.path.join(repoDir, 'tmp', modelType, 'Geometry')
-        else:
-            geometryDir = "/tmp/{}/Geometry".format(modelType)
-        # If not in cache, download from s3.
-        if not os.path.exists(geometryDir):
-            os.makedirs(geometryDir, exist_ok=True)
-            get_geometries(session_path, modelName=modelName)
-        geometryDirEnd = os.path.join(session_path, 'OpenSimData', 'Model', 'Geometry')
-        shutil.copytree(geometryDir, geometryDirEnd)
-    except:
-        pass
-    
-    # Zip   
-    def zipdir(path, ziph):
-        # ziph is zipfile handle
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                ziph.write(os.path.join(root, file), 
-                           os.path.relpath(os.path.join(root, file), 
-                                           os.path.join(path, '..')))    
-    session_zip = '{}.zip'.format(session_path)
-    if os.path.isfile(session_zip):
-        os.remove(session_zip)  
-    if zipFolder:
-        zipf = zipfile.ZipFile(session_zip, 'w', zipfile.ZIP_DEFLATED)
-        zipdir(session_path, zipf)
-        zipf.close()
+    # Zip: the files added during the download, and the other ones.
+    if archive is not None:
+        try:
+            archive.close()
+        except Exception as e:
+            errors.append({'step': 'zip', 'path': session_zip, 'error': e})
     
     # Write zip as a result to last trial for now
     if writeToDB:
         post_file_to_trial(session_zip,dynamic_ids[-1],tag='session_zip',
                            device_id='all')    
+        
+    if errors:
+        print('{} error(s) while downloading {}:'.format(len(errors), 
+                                                         session_id))
+        for error in errors:
+            print('  {}: {}{}'.format(
+                error['step'], 
+                '' if error['path'] is None else error['path'] + ': ',
+                repr(error['error'])))
+    
+    return errors
     
 def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False):
     """Calculates the cross correlation and lags without normalization.
@@ -777,6 +1889,7 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False):
     argmax_corr = np.argmax(corr)    
         
     if visualize:
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.plot(corr)
         plt.title('vertical velocity correlation')
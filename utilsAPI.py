@@ -18,6 +18,9 @@
     limitations under the License.
 '''
 
+import threading
+import contextlib
+import urllib.parse
 from decouple import config
 
 def get_api_url():
@@ -31,3 +34,143 @@ def get_api_url():
         API_URL= API_URL + '/'
 
     return API_URL
+
+def set_api_url(url):
+    # Overrides the API url (eg, a local server, see utilsMockAPI.py).
+    global API_URL
+    API_URL = url if url[-1] == '/' else url + '/'
+
+# %% Shared HTTP session.
+# All API and media requests go through one requests.Session, such that
+# connections are kept alive and reused (no TCP/TLS handshake per request).
+# Requests time out, and are retried with exponential backoff on connection
+# errors and on 429/5xx responses (honoring Retry-After). The defaults can be
+# changed in the environment (.env) file:
+#   HTTP_TIMEOUT: timeout in seconds (connect and read), default 30.
+#   HTTP_RETRIES: maximum number of retries, default 5.
+#   HTTP_BACKOFF: backoff factor in seconds, default 0.5 (ie, 0.5s, 1s, 2s...).
+#   HTTP_POOL_SIZE: maximum number of connections kept per host, default 16.
+def get_http_config():
+    if 'HTTP_CONFIG' not in globals():
+        global HTTP_CONFIG
+        HTTP_CONFIG = {
+            'timeout': config('HTTP_TIMEOUT', default=30, cast=float),
+            'retries': config('HTTP_RETRIES', default=5, cast=int),
+            'backoff': config('HTTP_BACKOFF', default=0.5, cast=float),
+            'pool_size': config('HTTP_POOL_SIZE', default=16, cast=int)}
+        
+    return HTTP_CONFIG
+
+HTTP_SESSION_LOCK = threading.Lock()
+HTTP_SESSIONS = {}
+
+def get_http_session(retries=True):
+    # The sessions are created once, under a lock, such that threads (eg, the
+    # download thread pools) share one connection pool and retry adapter.
+    # With retries=False, the session does not retry, for callers that retry
+    # themselves (eg, utils.upload_file).
+    if retries not in HTTP_SESSIONS:
+        with HTTP_SESSION_LOCK:
+            if retries not in HTTP_SESSIONS:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                
+                httpConfig = get_http_config()
+                retry = Retry(
+                    total=httpConfig['retries'] if retries else 0, 
+                    backoff_factor=httpConfig['backoff'],
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=True,
+                    # Return the last response instead of raising, such that
+                    # the caller sees the status code.
+                    raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=httpConfig['pool_size'],
+                                      pool_maxsize=httpConfig['pool_size'],
+                                      max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                # Only published once fully set up.
+                HTTP_SESSIONS[retries] = session
+        
+    return HTTP_SESSIONS[retries]
+
+# %% Concurrency limits.
+# Optional limits on the number of concurrent requests, in total and per host,
+# shared by all threads (eg, when downloading several sessions at once).
+# set_http_concurrency sets the limits of the process, and http_concurrency
+# sets limits for the duration of a with block (eg, a batch download), after
+# which the previous limits apply again.
+HTTP_LIMITS_LOCK = threading.Lock()
+HTTP_LIMITS = {'max_total': None, 'max_per_host': None, 
+               'total': None, 'hosts': {}}
+# Limits of the open http_concurrency blocks, the last one applies.
+HTTP_LIMITS_STACK = []
+
+def set_http_limits(limits, max_total=None, max_per_host=None):
+    # None means no limit.
+    limits['max_total'] = max_total
+    limits['max_per_host'] = max_per_host
+    limits['total'] = (None if max_total is None else 
+                       threading.BoundedSemaphore(max_total))
+    limits['hosts'] = {}
+    
+    return limits
+
+def set_http_concurrency(max_total=None, max_per_host=None):
+    with HTTP_LIMITS_LOCK:
+        set_http_limits(HTTP_LIMITS, max_total, max_per_host)
+
+@contextlib.contextmanager
+def http_concurrency(max_total=None, max_per_host=None):
+    # Blocks can overlap (eg, two batch downloads at the same time): the
+    # limits of the last block opened, and not closed yet, apply.
+    limits = set_http_limits({}, max_total, max_per_host)
+    with HTTP_LIMITS_LOCK:
+        HTTP_LIMITS_STACK.append(limits)
+    try:
+        yield
+    finally:
+        with HTTP_LIMITS_LOCK:
+            # By identity: the limits of other blocks may be equal.
+            HTTP_LIMITS_STACK[:] = [l for l in HTTP_LIMITS_STACK 
+                                    if l is not limits]
+
+@contextlib.contextmanager
+def http_slot(url):
+    # Waits until a request to url is allowed by the concurrency limits.
+    with HTTP_LIMITS_LOCK:
+        limits = HTTP_LIMITS_STACK[-1] if HTTP_LIMITS_STACK else HTTP_LIMITS
+        semaphores = [limits['total']]
+        if limits['max_per_host'] is not None:
+            host = urllib.parse.urlsplit(url).netloc
+            if not host in limits['hosts']:
+                limits['hosts'][host] = threading.BoundedSemaphore(
+                    limits['max_per_host'])
+            semaphores.append(limits['hosts'][host])
+    semaphores = [sem for sem in semaphores if sem is not None]
+    # Host first, such that a request waiting for its host does not hold a
+    # global slot.
+    for semaphore in reversed(semaphores):
+        semaphore.acquire()
+    try:
+        yield
+    finally:
+        for semaphore in semaphores:
+            semaphore.release()
+
+def http_request(method, url, retries=True, **kwargs):
+    # Same arguments as requests.request, with a default timeout. Connection
+    # errors and 429/5xx responses are retried (HTTP_RETRIES), unless
+    # retries is False.
+    # Streamed requests (stream=True) are not covered by the concurrency
+    # limits since their content is read after returning; wrap them with
+    # http_slot (see utils.download_file).
+    kwargs.setdefault('timeout', get_http_config()['timeout'])
+    session = get_http_session(retries)
+    
+    if kwargs.get('stream', False):
+        return session.request(method, url, **kwargs)
+    with http_slot(url):
+        return session.request(method, url, **kwargs)
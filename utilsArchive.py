@@ -0,0 +1,119 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsArchive.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Zip archives of session folders.
+# Files are added to the archive while the session is downloading (eg, as
+# each download completes), such that archiving overlaps with the downloads.
+# Already compressed media (videos, images) are stored as is, and the other
+# files are compressed (deflate). A single writer thread compresses and writes
+# the entries, one at a time, with the public zipfile API: compression is not
+# parallel, since zipfile cannot write data compressed outside of it. The
+# archive is written to <archivePath>.tmp and renamed when complete.
+
+import os
+import zipfile
+import concurrent.futures
+
+# Extensions of files that are stored without compression.
+STORED_EXTENSIONS = ['.mp4', '.mov', '.avi', '.png', '.jpg', '.jpeg', '.zip',
+                     '.gz']
+# Files that are not archived (partial downloads, temporary files).
+EXCLUDED_EXTENSIONS = ['.part', '.tmp']
+
+class SessionArchive:
+    """Zip archive of a folder, filled while the folder is being written.
+
+    Parameters
+    ----------
+    archivePath : str
+        Path of the archive (eg, <session folder>.zip).
+    rootPath : str
+        Folder to archive. Entries are named relative to the parent of
+        rootPath (ie, they start with the name of the folder).
+    compresslevel : int
+        zlib compression level (0-9).
+
+    Usage:
+        archive = SessionArchive(sessionPath + '.zip', sessionPath)
+        archive.add(filePath) # eg, when the download of filePath completes
+        archive.close() # adds the other files of sessionPath
+
+    """
+    def __init__(self, archivePath, rootPath, compresslevel=6):
+        self.archivePath = archivePath
+        self.rootPath = rootPath
+        self.compresslevel = compresslevel
+        self.tmpPath = archivePath + '.tmp'
+        self.zipf = zipfile.ZipFile(self.tmpPath, 'w', zipfile.ZIP_DEFLATED,
+                                    allowZip64=True)
+        # All writes to the archive happen in this thread.
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.added = set()
+        self.futures = []
+
+    def get_arcname(self, filePath):
+        return os.path.relpath(filePath, os.path.join(self.rootPath, '..'))
+
+    def add(self, filePath):
+        # Adds the file in the background; files already added are skipped.
+        arcname = self.get_arcname(filePath)
+        if arcname in self.added:
+            return
+        self.added.add(arcname)
+        self.futures.append(self.writer.submit(self._write, filePath,
+                                               arcname))
+
+    def _write(self, filePath, arcname):
+        # Runs in the writer thread. Files are streamed into the archive.
+        extension = os.path.splitext(filePath)[1].lower()
+        if extension in STORED_EXTENSIONS:
+            self.zipf.write(filePath, arcname, 
+                            compress_type=zipfile.ZIP_STORED)
+        else:
+            self.zipf.write(filePath, arcname, 
+                            compress_type=zipfile.ZIP_DEFLATED,
+                            compresslevel=self.compresslevel)
+
+    def wait(self):
+        # Waits for the files added so far, and raises the first error.
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        # Adds the files of rootPath not added yet, and completes the archive.
+        try:
+            for root, _, files in os.walk(self.rootPath):
+                for file in sorted(files):
+                    if not os.path.splitext(file)[1] in EXCLUDED_EXTENSIONS:
+                        self.add(os.path.join(root, file))
+            self.wait()
+        except:
+            self.abort()
+            raise
+        self.writer.shutdown()
+        self.zipf.close()
+        os.replace(self.tmpPath, self.archivePath)
+
+    def abort(self):
+        # Discards the archive.
+        self.writer.shutdown(cancel_futures=True)
+        self.zipf.close()
+        os.remove(self.tmpPath)
@@ -25,8 +25,6 @@ import os
 import maskpass
 from utilsAPI import get_api_url
 
-API_URL = get_api_url()
-
 def get_token(saveEnvPath=None):
            
     if 'API_TOKEN' not in globals():
@@ -53,7 +51,7 @@ def get_token(saveEnvPath=None):
                     pw = getpass.getpass(prompt='Enter Password: ', stream=None)
                 
                 data = {"username":un,"password":pw}
-                resp = requests.post(API_URL + 'login/',data=data).json()
+                resp = requests.post(get_api_url() + 'login/',data=data).json()
                 token = resp['token']
                 
                 print('Login successful.')
@@ -0,0 +1,237 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsBatchDownload.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2022 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Download many sessions concurrently.
+# Sessions are scheduled with asyncio; each session is downloaded with
+# utils.download_session in a worker thread. The number of concurrent
+# requests is limited in total and per host (eg, api.opencap.ai and the
+# storage server of the media files) for the duration of the batch, see
+# utilsAPI.http_concurrency.
+# Progress and throughput are printed as sessions complete, and a manifest
+# (json) records the outcome of every session.
+#
+# Usage from the command line:
+#   python utilsBatchDownload.py <session_id> <session_id> ...
+#   python utilsBatchDownload.py --csv sessions.csv --column sid
+# Run python utilsBatchDownload.py --help for all options.
+# The API (eg, a local stand-in server for testing) is set with API_URL in the
+# environment (.env) file.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+
+import utils
+from utilsAPI import http_concurrency
+
+# %% Session list.
+def read_session_list(filePath, column='sid'):
+    # Reads session ids from a csv file (column column), or from a text file
+    # with one session id per line.
+    if filePath.endswith('.csv'):
+        import pandas as pd
+        df = pd.read_csv(filePath)
+        sessionList = [str(s) for s in df[column].dropna().unique()]
+    else:
+        with open(filePath, 'r') as f:
+            sessionList = [line.strip() for line in f if line.strip()]
+
+    return sessionList
+
+def get_folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+
+    return size
+
+def format_size(nBytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nBytes < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(nBytes, unit)
+        nBytes /= 1024
+
+# %% Manifest.
+def write_manifest(manifestPath, manifest):
+    # Written to a temporary file and renamed, such that the manifest is
+    # always complete, even if the batch is interrupted.
+    tmpPath = manifestPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmpPath, manifestPath)
+
+# %% Batch download.
+async def download_sessions_async(sessionList, sessionBasePath=None,
+                                  downloadVideos=True, max_sessions=4,
+                                  max_requests=16, max_requests_per_host=8,
+                                  n_workers_per_session=4, manifestPath=None,
+                                  verbose=True):
+    """Downloads sessions concurrently.
+
+    Parameters
+    ----------
+    sessionList : list of str
+        Session ids.
+    sessionBasePath : str, optional
+        Sessions are saved in <sessionBasePath>/OpenCapData_<session_id>.
+        Defaults to <current working directory>/Data.
+    downloadVideos : bool
+        Download the input videos.
+    max_sessions : int
+        Maximum number of sessions downloaded at the same time.
+    max_requests : int
+        Maximum number of concurrent requests, in total.
+    max_requests_per_host : int
+        Maximum number of concurrent requests to the same host.
+    n_workers_per_session : int
+        Number of threads per session, see utils.download_session.
+    manifestPath : str, optional
+        Path of the manifest. Defaults to
+        <sessionBasePath>/download_manifest.json.
+    verbose : bool
+        Print progress and throughput.
+    Returns
+    -------
+    manifest : dict
+        Keys: started, finished, succeeded (session ids downloaded without
+        errors), and sessions (for each session id: status - succeeded,
+        partial, or failed -, path, bytes, seconds, and errors).
+    """
+
+    if sessionBasePath is None:
+        sessionBasePath = os.path.join(os.getcwd(), 'Data')
+    os.makedirs(sessionBasePath, exist_ok=True)
+    if manifestPath is None:
+        manifestPath = os.path.join(sessionBasePath, 'download_manifest.json')
+
+    sessionList = list(dict.fromkeys(sessionList))
+    sessionSemaphore = asyncio.Semaphore(max_sessions)
+    manifest = {'started': datetime.datetime.now().isoformat(),
+                'finished': None, 'succeeded': [], 'sessions': {}}
+    progress = {'done': 0, 'bytes': 0, 'start': time.time()}
+
+    async def download_one(session_id):
+        async with sessionSemaphore:
+            sessionPath = os.path.join(sessionBasePath,
+                                       'OpenCapData_' + session_id)
+            sizeStart = get_folder_size(sessionPath)
+            start = time.time()
+            try:
+                errors = await asyncio.to_thread(
+                    utils.download_session, session_id,
+                    sessionBasePath=sessionBasePath,
+                    downloadVideos=downloadVideos,
+                    n_workers=n_workers_per_session)
+                errors = ['{}: {}{}'.format(
+                    e['step'], '' if e['path'] is None else e['path'] + ': ',
+                    repr(e['error'])) for e in errors]
+                status = 'succeeded' if not errors else 'partial'
+            except Exception as e:
+                errors = [repr(e)]
+                status = 'failed'
+            seconds = time.time() - start
+            nBytes = get_folder_size(sessionPath) - sizeStart
+
+        # Only the event loop thread updates the manifest.
+        manifest['sessions'][session_id] = {
+            'status': status, 'path': sessionPath, 'bytes': nBytes,
+            'seconds': round(seconds, 3), 'errors': errors}
+        if status == 'succeeded':
+            manifest['succeeded'].append(session_id)
+        write_manifest(manifestPath, manifest)
+
+        progress['done'] += 1
+        progress['bytes'] += nBytes
+        if verbose:
+            elapsed = time.time() - progress['start']
+            print('[{}/{}] {} {}: {} in {:.1f} s ({}/s). Total: {} in '
+                  '{:.1f} s ({}/s).'.format(
+                      progress['done'], len(sessionList), session_id, status,
+                      format_size(nBytes), seconds,
+                      format_size(nBytes / max(seconds, 1e-6)),
+                      format_size(progress['bytes']), elapsed,
+                      format_size(progress['bytes'] / max(elapsed, 1e-6))))
+
+    # The limits of the caller (or of another batch) apply again afterwards.
+    with http_concurrency(max_total=max_requests,
+                          max_per_host=max_requests_per_host):
+        await asyncio.gather(*[download_one(session_id)
+                               for session_id in sessionList])
+    manifest['finished'] = datetime.datetime.now().isoformat()
+    write_manifest(manifestPath, manifest)
+
+    if verbose:
+        print('Downloaded {} of {} sessions without errors. Manifest: '
+              '{}'.format(len(manifest['succeeded']), len(manifest['sessions']),
+                          manifestPath))
+
+    return manifest
+
+def download_sessions(sessionList, **kwargs):
+    # Blocking version of download_sessions_async (same arguments).
+    return asyncio.run(download_sessions_async(sessionList, **kwargs))
+
+# %% Command line.
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Download OpenCap sessions concurrently.')
+    parser.add_argument('session_ids', nargs='*', help='Session ids.')
+    parser.add_argument('--csv', help='csv (or text) file with session ids.')
+    parser.add_argument('--column', default='sid',
+                        help='Column of the csv file with the session ids.')
+    parser.add_argument('--output', default=None,
+                        help='Download folder (default: ./Data).')
+    parser.add_argument('--no-videos', action='store_true',
+                        help='Do not download the input videos.')
+    parser.add_argument('--max-sessions', type=int, default=4)
+    parser.add_argument('--max-requests', type=int, default=16)
+    parser.add_argument('--max-requests-per-host', type=int, default=8)
+    parser.add_argument('--workers-per-session', type=int, default=4)
+    parser.add_argument('--manifest', default=None,
+                        help='Path of the manifest (json).')
+    args = parser.parse_args(argv)
+
+    sessionList = list(args.session_ids)
+    if args.csv is not None:
+        sessionList += read_session_list(args.csv, column=args.column)
+    if not sessionList:
+        parser.error('No session ids.')
+
+    manifest = download_sessions(
+        sessionList, sessionBasePath=args.output,
+        downloadVideos=not args.no_videos, max_sessions=args.max_sessions,
+        max_requests=args.max_requests,
+        max_requests_per_host=args.max_requests_per_host,
+        n_workers_per_session=args.workers_per_session,
+        manifestPath=args.manifest)
+
+    # Non-zero exit code if a session was not fully downloaded.
+    return 0 if len(manifest['succeeded']) == len(manifest['sessions']) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsCache.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2022 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Binary sidecar cache for parsed text files (.trc, .mot, .sto).
+# The first time a file is parsed, the resulting array is saved as a .npy file
+# (plus a small .json file with metadata) in a .opencap_cache folder next to
+# the source file. Subsequent loads memory-map the .npy file instead of parsing
+# the text file again. Entries are keyed by the absolute path, size, and
+# modification time of the source file, such that edited files are re-parsed.
+# The cache is disabled by default. Enable it by adding OPENCAP_CACHE=True to
+# your environment (.env) file, or by calling set_cache_enabled(True).
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+from decouple import config
+
+CACHE_FOLDER_NAME = '.opencap_cache'
+
+def is_cache_enabled():
+    if 'CACHE_ENABLED' not in globals():
+        global CACHE_ENABLED
+        try: # look in environment file
+            CACHE_ENABLED = config('OPENCAP_CACHE', default=False, cast=bool)
+        except: # default
+            CACHE_ENABLED = False
+
+    return CACHE_ENABLED
+
+def set_cache_enabled(enabled=True):
+    global CACHE_ENABLED
+    CACHE_ENABLED = enabled
+
+# %% Paths of the cache entry of a file.
+def get_cache_paths(file_path, tag):
+
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+    key = hashlib.sha1('{}|{}|{}'.format(
+        file_path, file_stat.st_size,
+        file_stat.st_mtime_ns).encode()).hexdigest()[:16]
+    cacheDir = os.path.join(os.path.dirname(file_path), CACHE_FOLDER_NAME)
+    prefix = os.path.join(cacheDir, '{}.{}.'.format(
+        os.path.basename(file_path), tag))
+
+    return prefix + key + '.npy', prefix + key + '.json'
+
+# %% Load array from cache, parse and cache if not available.
+def load_cached(file_path, parse, tag):
+    """Returns the parsed content of a file, using the sidecar cache if enabled.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the source (text) file.
+    parse : callable
+        parse(file_path) returns (data, metadata), where data is a numpy
+        array (structured arrays are supported) and metadata is a
+        json-serializable dict.
+    tag : str
+        Identifies the parser; files parsed in different ways (e.g., with
+        different options) should use different tags.
+    Returns
+    -------
+    data : np.ndarray
+        Parsed data. When loaded from the cache, this is a copy-on-write
+        memory map: in-place changes are never written back to disk.
+    metadata : dict
+    """
+
+    if not is_cache_enabled():
+        return parse(file_path)
+
+    dataPath, metadataPath = get_cache_paths(file_path, tag)
+    if os.path.exists(dataPath) and os.path.exists(metadataPath):
+        try:
+            with open(metadataPath, 'r') as f:
+                metadata = json.load(f)
+            data = np.load(dataPath, mmap_mode='c', allow_pickle=False)
+            return data, metadata
+        except (OSError, ValueError):
+            # Corrupted entry, parse again.
+            pass
+
+    data, metadata = parse(file_path)
+    try:
+        write_cache_entry(dataPath, metadataPath, data, metadata)
+    except OSError:
+        # Eg, read-only data folder; the data just does not get cached.
+        pass
+
+    return data, metadata
+
+def write_cache_entry(dataPath, metadataPath, data, metadata):
+
+    cacheDir = os.path.dirname(dataPath)
+    os.makedirs(cacheDir, exist_ok=True)
+
+    # Remove stale entries of the same file and tag.
+    prefix = dataPath[:dataPath.rfind('.', 0, -4) + 1]
+    for stalePath in glob.glob(glob.escape(prefix) + '*'):
+        if (stalePath not in [dataPath, metadataPath] and 
+                not stalePath.endswith('.tmp')):
+            try:
+                os.remove(stalePath)
+            except FileNotFoundError:
+                pass
+
+    # Write to temporary files and rename, such that concurrent readers never
+    # see a partially written entry. The metadata file is written last since
+    # it marks the entry as complete.
+    pid = str(os.getpid())
+    with open(dataPath + '.' + pid + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(data), allow_pickle=False)
+    os.replace(dataPath + '.' + pid + '.tmp', dataPath)
+    with open(metadataPath + '.' + pid + '.tmp', 'w') as f:
+        json.dump(metadata, f)
+    os.replace(metadataPath + '.' + pid + '.tmp', metadataPath)
+
+# %% Delete cache entries.
+def clear_cache(folder):
+    """Deletes all cache folders in folder (recursively)."""
+
+    for root, dirs, files in os.walk(folder):
+        if CACHE_FOLDER_NAME in dirs:
+            shutil.rmtree(os.path.join(root, CACHE_FOLDER_NAME))
+            dirs.remove(CACHE_FOLDER_NAME)
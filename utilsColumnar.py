@@ -0,0 +1,445 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsColumnar.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2022 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Columnar (Parquet) export and import of session data.
+# export_session_columnar converts a downloaded session folder into one Parquet
+# file per trial and data type in <session_dir>/Columnar:
+#   <trial>.markers.parquet       time, <marker>_x, <marker>_y, <marker>_z
+#   <trial>.coordinates.parquet   time, <coordinate> (as in the .mot file)
+#   <trial>.com.parquet           time, x, y, z, speed_x, speed_y, speed_z
+#   <trial>.gait_events.parquet   one row per gait cycle
+#   <trial>.dynamics.parquet      one row per case and time point
+# Metadata (eg, table metadata of the .mot file, labels of the dynamic
+# simulation outputs) is stored as json in the schema metadata of each file.
+# Queries across many sessions can then read only the columns they need, eg
+# load_markers(session_dir, trial_name, marker_names=['r_calc_study']).
+# kinematics, gait_analysis, and kineticsOpenSimAD read from these files when
+# they exist and are not older than the text files they were exported from.
+# pyarrow is required (pip install pyarrow).
+
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+
+import utils
+import utilsResults
+from utilsTRC import TRCMarkers
+
+COLUMNAR_FOLDER_NAME = 'Columnar'
+METADATA_KEY = b'opencap'
+
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is required for columnar export/import '
+                          'of session data: pip install pyarrow.')
+    return pa, pq
+
+# %% Paths.
+def get_columnar_path(session_dir, trial_name, kind):
+    # kind is one of markers, coordinates, com, gait_events, dynamics.
+    return os.path.join(session_dir, COLUMNAR_FOLDER_NAME,
+                        '{}.{}.parquet'.format(trial_name, kind))
+
+def get_source_path(session_dir, trial_name, kind):
+    # File (or results folder for dynamics) a columnar file is exported from.
+    if kind == 'markers':
+        return os.path.join(session_dir, 'MarkerData',
+                            '{}.trc'.format(trial_name))
+    elif kind == 'dynamics':
+        return os.path.join(session_dir, 'OpenSimData', 'Dynamics',
+                            trial_name)
+    else:
+        return os.path.join(session_dir, 'OpenSimData', 'Kinematics',
+                            '{}.mot'.format(trial_name))
+
+def is_columnar_available(session_dir, trial_name, kind, lossless=False):
+    # The columnar file is only used if it is at least as recent as the file
+    # it was exported from (eg, not if the kinematics were re-processed).
+    # With lossless=True, it is also not used if it was exported with
+    # float32=True.
+    columnarPath = get_columnar_path(session_dir, trial_name, kind)
+    if not os.path.exists(columnarPath):
+        return False
+    sourcePath = get_source_path(session_dir, trial_name, kind)
+    if kind == 'dynamics':
+        sourceMTime = utilsResults.get_results_mtime(sourcePath)
+    elif os.path.exists(sourcePath):
+        sourceMTime = os.path.getmtime(sourcePath)
+    else:
+        sourceMTime = 0
+    if sourceMTime > os.path.getmtime(columnarPath):
+        return False
+    try:
+        import_pyarrow()
+    except ImportError:
+        return False
+    if lossless and is_float32(columnarPath):
+        return False
+
+    return True
+
+def is_float32(path):
+    # True if columns of the file are stored in single precision (see
+    # write_columnar).
+    pa, pq = import_pyarrow()
+    
+    return any(pa.types.is_float32(field.type) 
+               for field in pq.read_schema(path))
+
+# %% Write / read Parquet files.
+def write_columnar(path, columns, metadata=None, float32=False):
+    # columns is a dict {name: 1D array}. Time columns are kept in double
+    # precision.
+    pa, pq = import_pyarrow()
+    arrays = {}
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if (float32 and values.dtype == np.float64 and name != 'time' and
+                not name.startswith('time/')):
+            values = values.astype(np.float32)
+        arrays[name] = values
+    table = pa.table(arrays)
+    if metadata is not None:
+        table = table.replace_schema_metadata(
+            {METADATA_KEY: json.dumps(metadata)})
+
+    # Write to a temporary file and rename, such that readers never see a
+    # partially written file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+    pq.write_table(table, tmpPath, compression='zstd')
+    os.replace(tmpPath, path)
+
+def read_columnar_metadata(path):
+    _, pq = import_pyarrow()
+    schemaMetadata = pq.read_schema(path).metadata or {}
+    if METADATA_KEY in schemaMetadata:
+        return json.loads(schemaMetadata[METADATA_KEY])
+    else:
+        return {}
+
+def read_columnar(path, columns=None, filters=None):
+    # Returns (dict {name: 1D array}, metadata). Only the requested columns
+    # are read from disk.
+    _, pq = import_pyarrow()
+    table = pq.read_table(path, columns=columns, filters=filters)
+    data = {name: table.column(name).to_numpy()
+            for name in table.column_names}
+
+    return data, read_columnar_metadata(path)
+
+# %% Export.
+def export_markers(session_dir, trial_name, float32=False):
+    trcFilePath = get_source_path(session_dir, trial_name, 'markers')
+    trc_file = TRCMarkers(trcFilePath)
+    columns = {'time': trc_file.time}
+    for marker in trc_file.marker_names:
+        for i, c in enumerate(['x', 'y', 'z']):
+            columns['{}_{}'.format(marker, c)] = trc_file.marker(marker)[:, i]
+    metadata = {'marker_names': trc_file.marker_names,
+                'data_rate': trc_file.data_rate, 'units': trc_file.units}
+    write_columnar(get_columnar_path(session_dir, trial_name, 'markers'),
+                   columns, metadata, float32=float32)
+
+def export_coordinates(session_dir, trial_name, float32=False):
+    motionPath = get_source_path(session_dir, trial_name, 'coordinates')
+    table = utils.load_time_series_table(motionPath)
+    labels = list(table.getColumnLabels())
+    data = table.getMatrix().to_numpy()
+    columns = {'time': np.asarray(table.getIndependentColumn())}
+    for i, label in enumerate(labels):
+        columns[label] = data[:, i]
+    tableMetaData = {}
+    for key in table.getTableMetaDataKeys():
+        try:
+            tableMetaData[key] = table.getTableMetaDataString(key)
+        except Exception:
+            # Only string entries (eg, inDegrees) are exported.
+            pass
+    metadata = {'labels': labels, 'tableMetaData': tableMetaData}
+    write_columnar(get_columnar_path(session_dir, trial_name, 'coordinates'),
+                   columns, metadata, float32=float32)
+
+def export_center_of_mass(session_dir, trial_name, float32=False,
+                          modelName=None):
+    from utilsKinematics import kinematics
+    trial = kinematics(session_dir, trial_name, modelName=modelName)
+    com_values = trial.get_center_of_mass_values()
+    com_speeds = trial.get_center_of_mass_speeds()
+    columns = {'time': com_values['time'].to_numpy()}
+    for c in ['x', 'y', 'z']:
+        columns[c] = com_values[c].to_numpy()
+    for c in ['x', 'y', 'z']:
+        columns['speed_' + c] = com_speeds[c].to_numpy()
+    write_columnar(get_columnar_path(session_dir, trial_name, 'com'),
+                   columns, float32=float32)
+
+def export_gait_events(session_dir, trial_name, gaitEvents):
+    # gaitEvents is the output of gait_analysis.segment_walking.
+    columns = {}
+    for side, names in zip(['ipsilateral', 'contralateral'],
+                           [gaitEvents['eventNamesIpsilateral'],
+                            gaitEvents['eventNamesContralateral']]):
+        for i in range(len(names)):
+            columns['{}Idx_{}'.format(side, i)] = (
+                gaitEvents[side + 'Idx'][:, i])
+            columns['{}Time_{}'.format(side, i)] = (
+                gaitEvents[side + 'Time'][:, i])
+    metadata = {
+        'eventNamesIpsilateral': gaitEvents['eventNamesIpsilateral'],
+        'eventNamesContralateral': gaitEvents['eventNamesContralateral'],
+        'ipsilateralLeg': gaitEvents['ipsilateralLeg']}
+    write_columnar(get_columnar_path(session_dir, trial_name, 'gait_events'),
+                   columns, metadata)
+
+def export_dynamics(session_dir, trial_name, float32=False):
+    # trial_name is the name of the results folder in OpenSimData/Dynamics,
+    # eg <trial_name>_rep1 for repetitions.
+    # Numeric arrays of the results (see utilsResults) with one column per 
+    # time point (2-D) are stored as one column per row of the array, named
+    # <field>/<row>. Other numeric arrays (eg, 1-D or 3-D) are flattened and
+    # stored in one column, named <field>/flat. The shapes and dtypes are
+    # stored in the metadata, such that arrays are restored as they were.
+    # Other entries (eg, labels) are stored in the metadata.
+    optimaltrajectories = utilsResults.load_optimal_trajectories(
+        get_source_path(session_dir, trial_name, 'dynamics'))
+
+    def is_numeric(value):
+        return isinstance(value, np.ndarray) and value.dtype.kind in 'fiub'
+    
+    def get_nRows(value):
+        return value.shape[1] if value.ndim == 2 else value.size
+
+    cases = list(optimaltrajectories.keys())
+    nRows = {case: max([get_nRows(v) for v in result.values() if 
+                        is_numeric(v)] + [1])
+             for case, result in optimaltrajectories.items()}
+    nRowsAll = sum(nRows.values())
+    columns = {'case': np.concatenate(
+        [np.full(nRows[case], str(case)) for case in cases])}
+    metadata = {'cases': [str(case) for case in cases], 'fields': {}}
+    start = 0
+    for case in cases:
+        result = optimaltrajectories[case]
+        fields = {}
+        for field, value in result.items():
+            if is_numeric(value) and value.ndim == 2:
+                for i in range(value.shape[0]):
+                    name = '{}/{}'.format(field, i)
+                    if not name in columns:
+                        columns[name] = np.full(nRowsAll, np.nan)
+                    columns[name][start:start+value.shape[1]] = value[i, :]
+                fields[field] = {'shape': list(value.shape),
+                                 'dtype': value.dtype.str}
+            elif is_numeric(value):
+                name = '{}/flat'.format(field)
+                if not name in columns:
+                    columns[name] = np.full(nRowsAll, np.nan)
+                columns[name][start:start+value.size] = value.ravel()
+                fields[field] = {'shape': list(value.shape), 'flat': True,
+                                 'dtype': value.dtype.str}
+            elif isinstance(value, np.ndarray) and value.dtype.kind in 'US':
+                fields[field] = {'value': value.tolist(), 
+                                 'shape': list(value.shape),
+                                 'dtype': value.dtype.str}
+            elif isinstance(value, np.ndarray):
+                fields[field] = {'value': value.tolist()}
+            elif isinstance(value, np.generic):
+                fields[field] = {'value': value.item()}
+            else:
+                fields[field] = {'value': value}
+        metadata['fields'][str(case)] = fields
+        start += nRows[case]
+    write_columnar(get_columnar_path(session_dir, trial_name, 'dynamics'),
+                   columns, metadata, float32=float32)
+
+def export_session_columnar(session_dir, trial_names=None, float32=False,
+                            include_com=False, gait_trial_names=None,
+                            modelName=None):
+    """Exports the data of a downloaded session folder to Parquet files.
+
+    Parameters
+    ----------
+    session_dir : str
+        Path to the session folder (eg, Data/<session_id>).
+    trial_names : list of str, optional
+        Trials to export. All trials with marker or kinematic data are
+        exported if None.
+    float32 : bool
+        Store data in single precision (time is always in double precision).
+    include_com : bool
+        Also compute and export the center of mass position and velocity
+        (requires OpenSim, slower).
+    gait_trial_names : list of str, optional
+        Trials for which to compute and export gait events.
+    modelName : str, optional
+        Model used to compute the center of mass and gait events.
+
+    """
+
+    if trial_names is None:
+        trcFiles = glob.glob(os.path.join(session_dir, 'MarkerData', '*.trc'))
+        motFiles = glob.glob(os.path.join(session_dir, 'OpenSimData',
+                                          'Kinematics', '*.mot'))
+        trial_names = sorted(set(
+            [os.path.splitext(os.path.basename(f))[0]
+             for f in trcFiles + motFiles]))
+
+    for trial_name in trial_names:
+        if os.path.exists(get_source_path(session_dir, trial_name, 'markers')):
+            export_markers(session_dir, trial_name, float32=float32)
+        if os.path.exists(get_source_path(session_dir, trial_name,
+                                          'coordinates')):
+            export_coordinates(session_dir, trial_name, float32=float32)
+            if include_com:
+                export_center_of_mass(session_dir, trial_name,
+                                      float32=float32, modelName=modelName)
+
+    if gait_trial_names is not None:
+        import sys
+        sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'ActivityAnalyses'))
+        from gait_analysis import gait_analysis
+        for trial_name in gait_trial_names:
+            gait = gait_analysis(session_dir, trial_name)
+            export_gait_events(session_dir, trial_name, gait.gaitEvents)
+
+    # Dynamic simulations, one results folder per trial (and repetition).
+    for resultsPath in glob.glob(os.path.join(
+            session_dir, 'OpenSimData', 'Dynamics', '*', '')):
+        if utilsResults.get_results_cases(resultsPath):
+            export_dynamics(session_dir, os.path.basename(
+                os.path.normpath(resultsPath)), float32=float32)
+
+# %% Import.
+def load_markers(session_dir, trial_name, marker_names=None):
+    # Returns a dict with the same format as utilsTRC.trc_2_dict.
+    path = get_columnar_path(session_dir, trial_name, 'markers')
+    if marker_names is None:
+        marker_names = read_columnar_metadata(path)['marker_names']
+    columnNames = ['time'] + ['{}_{}'.format(marker, c)
+                              for marker in marker_names
+                              for c in ['x', 'y', 'z']]
+    data, _ = read_columnar(path, columns=columnNames)
+    markers = np.stack([data[name] for name in columnNames[1:]], axis=1)
+    markers = markers.reshape(markers.shape[0], len(marker_names), 3)
+    markerDict = {'time': data['time'], 'marker_names': list(marker_names),
+                  'markers': {marker: markers[:, i, :]
+                              for i, marker in enumerate(marker_names)}}
+
+    return markerDict
+
+def load_coordinates(session_dir, trial_name, coordinates=None):
+    # Returns a DataFrame with time and coordinate values (as in the .mot
+    # file, typically in degrees).
+    path = get_columnar_path(session_dir, trial_name, 'coordinates')
+    if coordinates is not None:
+        coordinates = ['time'] + list(coordinates)
+    data, _ = read_columnar(path, columns=coordinates)
+
+    return pd.DataFrame(data)
+
+def load_coordinates_table(session_dir, trial_name):
+    # Returns an OpenSim TimeSeriesTable, as opensim.TimeSeriesTable(<.mot>).
+    path = get_columnar_path(session_dir, trial_name, 'coordinates')
+    data, metadata = read_columnar(path)
+    table = utils.numpy_to_time_series_table(
+        data['time'],
+        np.stack([data[label] for label in metadata['labels']], axis=1),
+        metadata['labels'], metadata['tableMetaData'])
+
+    return table
+
+def load_center_of_mass(session_dir, trial_name):
+    # Returns a DataFrame with time, COM position (x, y, z), and COM velocity
+    # (speed_x, speed_y, speed_z).
+    path = get_columnar_path(session_dir, trial_name, 'com')
+    data, _ = read_columnar(path)
+
+    return pd.DataFrame(data)
+
+def load_gait_events(session_dir, trial_name):
+    # Returns a dict with the same format as gait_analysis.segment_walking.
+    path = get_columnar_path(session_dir, trial_name, 'gait_events')
+    data, metadata = read_columnar(path)
+    gaitEvents = {}
+    for side, key in zip(['ipsilateral', 'contralateral'],
+                         ['eventNamesIpsilateral', 'eventNamesContralateral']):
+        nEvents = len(metadata[key])
+        gaitEvents[side + 'Idx'] = np.stack(
+            [data['{}Idx_{}'.format(side, i)] for i in range(nEvents)], axis=1)
+        gaitEvents[side + 'Time'] = np.stack(
+            [data['{}Time_{}'.format(side, i)] for i in range(nEvents)],
+            axis=1)
+    gaitEvents.update(metadata)
+
+    return gaitEvents
+
+def get_dynamics_cases(session_dir, trial_name):
+    path = get_columnar_path(session_dir, trial_name, 'dynamics')
+
+    return read_columnar_metadata(path)['cases']
+
+def load_dynamics(session_dir, trial_name, case, fields=None):
+    # Returns a dict with the same format as
+    # utilsResults.load_optimal_trajectory.
+    # fields is a list of the entries to load, all entries if None.
+    path = get_columnar_path(session_dir, trial_name, 'dynamics')
+    caseFields = read_columnar_metadata(path)['fields'][str(case)]
+    if fields is None:
+        fields = list(caseFields.keys())
+    columnNames = []
+    for field in fields:
+        if caseFields[field].get('flat', False):
+            columnNames.append('{}/flat'.format(field))
+        elif 'shape' in caseFields[field] and not 'value' in caseFields[field]:
+            columnNames += ['{}/{}'.format(field, i) for 
+                            i in range(caseFields[field]['shape'][0])]
+    data, _ = read_columnar(path, columns=columnNames,
+                            filters=[('case', '==', str(case))])
+    result = {}
+    for field in fields:
+        fieldInfo = caseFields[field]
+        if 'value' in fieldInfo:
+            result[field] = fieldInfo['value']
+            if 'dtype' in fieldInfo:
+                # Arrays of strings.
+                result[field] = np.asarray(
+                    result[field], dtype=fieldInfo['dtype']).reshape(
+                        fieldInfo['shape'])
+        elif fieldInfo.get('flat', False):
+            shape = fieldInfo['shape']
+            result[field] = data['{}/flat'.format(field)][
+                :int(np.prod(shape))].reshape(shape)
+        else:
+            nRows, nColumns = fieldInfo['shape']
+            result[field] = np.stack(
+                [data['{}/{}'.format(field, i)][:nColumns]
+                 for i in range(nRows)], axis=0)
+        # Files exported before dtypes were stored are returned as float.
+        if 'dtype' in fieldInfo and isinstance(result[field], np.ndarray):
+            result[field] = result[field].astype(fieldInfo['dtype'])
+
+    return result
@@ -22,16 +22,80 @@ import os
 import opensim
 import copy
 import utils
+import utilsColumnar
 import numpy as np
 import pandas as pd
-import scipy.interpolate as interpolate
 
 
-from utilsProcessing import lowPassFilter
+from utilsProcessing import lowPassFilter, splineDerivatives
 from utilsTRC import trc_2_dict
 import numpy as np
 from scipy.spatial.transform import Rotation
 
+# %% States table.
+def get_states_table(model, time, Qs, Qds, labels, tableMetaData=None):
+    # Table with the coordinate values (Qs, labels are absolute state names,
+    # eg /jointset/hip_r/hip_flexion_r/value) and speeds (Qds), and with
+    # zeros for the other state variables of the model (eg, muscle states).
+    # Needed for StatesTrajectory.
+    speedLabels = [label[:-5] + 'speed' for label in labels]
+    
+    # Missing state variables.
+    stateVariableNames = model.getStateVariableNames()
+    stateVariableNamesStr = [
+        stateVariableNames.get(i) for i in range(
+            stateVariableNames.getSize())]
+    existingLabels = list(labels) + speedLabels
+    missingLabels = [stateVariableNameStr for stateVariableNameStr in 
+                     stateVariableNamesStr if 
+                     not stateVariableNameStr in existingLabels]
+    
+    # The table is built once with all columns, rather than appending the
+    # columns one at a time.
+    table = utils.numpy_to_time_series_table(
+        time, 
+        np.concatenate((Qs, Qds, np.zeros((Qs.shape[0], len(missingLabels)))),
+                       axis=1),
+        existingLabels + missingLabels, tableMetaData)
+    
+    return table
+
+# %% Muscle-tendon lengths and moment arms of a chunk of frames.
+# Worker of kinematics.compute_model_outputs when run in parallel: OpenSim
+# objects cannot be sent to other processes, so each worker loads the model
+# and creates the states of its frames.
+def get_muscle_outputs_chunk(modelPath, time, Qs, Qds, labels, tableMetaData,
+                             outputs, pairs):
+    
+    opensim.Logger.setLevelString('error')
+    model = opensim.Model(modelPath)
+    model.initSystem()
+    stateTrajectory = opensim.StatesTrajectory.createFromStatesTable(
+        model, get_states_table(model, time, Qs, Qds, labels, tableMetaData))
+    
+    # Muscles, as ordered in the model.
+    muscles = []
+    forceSet = model.getForceSet()
+    for m in range(forceSet.getSize()):        
+        c_force_elt = forceSet.get(m)  
+        if 'Muscle' in c_force_elt.getConcreteClassName():
+            muscles.append(opensim.Muscle.safeDownCast(c_force_elt))
+    coordinateSet = model.getCoordinateSet()
+    pairs = [(m, c, coordinateSet.get(c)) for m, c in pairs]
+    
+    lMT = np.zeros((len(time), len(muscles)))
+    dM = np.zeros((len(time), len(muscles), coordinateSet.getSize()))
+    for i in range(len(time)):
+        state = stateTrajectory[i]
+        model.realizePosition(state)
+        if 'muscle_tendon_lengths' in outputs:
+            for m, cObj in enumerate(muscles):
+                lMT[i, m] = cObj.getLength(state)
+        if 'moment_arms' in outputs:
+            for m, c, coordinate in pairs:
+                dM[i, m, c] = muscles[m].computeMomentArm(state, coordinate)
+                
+    return lMT, dM
 
 class kinematics:
     
@@ -58,6 +122,7 @@ class kinematics:
         if not os.path.exists(modelPath):
             raise Exception('Model path: ' + modelPath + ' does not exist.')
 
+        self.modelPath = modelPath
         self.model = opensim.Model(modelPath)
         self.model.initSystem()
         
@@ -65,8 +130,16 @@ class kinematics:
         motionPath = os.path.join(sessionDir, 'OpenSimData', 'Kinematics',
                                   '{}.mot'.format(trialName))
         
-        # Create time-series table with coordinate values.             
-        self.table = opensim.TimeSeriesTable(motionPath)        
+        # Create time-series table with coordinate values. The coordinate
+        # values are read from the columnar export of the session if
+        # available and exported in double precision (see
+        # utilsColumnar.export_session_columnar).
+        if utilsColumnar.is_columnar_available(sessionDir, trialName,
+                                               'coordinates', lossless=True):
+            self.table = utilsColumnar.load_coordinates_table(sessionDir,
+                                                              trialName)
+        else:
+            self.table = utils.load_time_series_table(motionPath)
         tableProcessor = opensim.TableProcessor(self.table)
         self.columnLabels = list(self.table.getColumnLabels())
         tableProcessor.append(opensim.TabOpUseAbsoluteStateNames())
@@ -92,37 +165,19 @@ class kinematics:
                 time_temp[self.table.getNearestRowIndexForTime(self.time[0])],
                 time_temp[self.table.getNearestRowIndexForTime(self.time[-1])])
                 
-        # Compute coordinate speeds and accelerations and add speeds to table.        
+        # Coordinate values. The coordinate speeds and accelerations, and the
+        # table with all the states, are only computed when needed (see
+        # Qds, Qdds, and statesTable), eg not when only the coordinate values
+        # or the markers are used.
         self.Qs = self.table.getMatrix().to_numpy()
-        self.Qds = np.zeros(self.Qs.shape)
-        self.Qdds = np.zeros(self.Qs.shape)
-        columnAbsoluteLabels = list(self.table.getColumnLabels())
-        for i, columnLabel in enumerate(columnAbsoluteLabels):
-            spline = interpolate.InterpolatedUnivariateSpline(
-                self.time, self.Qs[:,i], k=3)
-            # Coordinate speeds
-            splineD1 = spline.derivative(n=1)
-            self.Qds[:,i] = splineD1(self.time)
-            # Coordinate accelerations.
-            splineD2 = spline.derivative(n=2)
-            self.Qdds[:,i] = splineD2(self.time)            
-            # Add coordinate speeds to table.
-            columnLabel_speed = columnLabel[:-5] + 'speed'
-            self.table.appendColumn(
-                columnLabel_speed, 
-                opensim.Vector(self.Qds[:,i].flatten().tolist()))
-            
-        # Append missing muscle states to table.
-        # Needed for StatesTrajectory.
-        stateVariableNames = self.model.getStateVariableNames()
-        stateVariableNamesStr = [
-            stateVariableNames.get(i) for i in range(
-                stateVariableNames.getSize())]
-        existingLabels = self.table.getColumnLabels()
-        for stateVariableNameStr in stateVariableNamesStr:
-            if not stateVariableNameStr in existingLabels:
-                vec_0 = opensim.Vector([0] * self.table.getNumRows())            
-                self.table.appendColumn(stateVariableNameStr, vec_0)
+        self._Qds = None
+        self._Qdds = None
+        self._statesTable = None
+        
+        # Model outputs (eg, muscle-tendon lengths), computed on first use
+        # (see compute_model_outputs).
+        self._muscles = None
+        self._modelOutputs = {}
                        
         # Number of muscles.
         self.nMuscles = 0
@@ -159,22 +214,56 @@ class kinematics:
                                'arm_flex_l', 'arm_add_l', 'arm_rot_l', 
                                'elbow_flex_l', 'pro_sup_l']
     
+    # Coordinate speeds and accelerations, computed on first use. The splines
+    # of all coordinates are fitted at once.
+    def compute_coordinate_derivatives(self):
+        if self._Qds is None:
+            self._Qds, self._Qdds = splineDerivatives(self.time, self.Qs)
+    
+    @property
+    def Qds(self):
+        self.compute_coordinate_derivatives()
+        return self._Qds
+    
+    @property
+    def Qdds(self):
+        self.compute_coordinate_derivatives()
+        return self._Qdds
+    
+    # Table with the coordinate values and speeds, and with zeros for the
+    # other state variables (eg, muscle states). Needed for StatesTrajectory.
+    # Only set when needed because the model may have many muscle states.
+    def statesTable(self):
+        if self._statesTable is None:
+            self._statesTable = get_states_table(
+                self.model, np.asarray(self.table.getIndependentColumn()), 
+                self.Qs, self.Qds, list(self.table.getColumnLabels()),
+                utils.get_table_metadata_strings(self.table))
+        return self._statesTable
+    
     # Only set the state trajectory when needed because it is slow.
     def stateTrajectory(self):
         if self._stateTrajectory is None:
             self._stateTrajectory = (
                 opensim.StatesTrajectory.createFromStatesTable(
-                    self.model, self.table))
+                    self.model, self.statesTable()))
         return self._stateTrajectory
     
     def get_marker_dict(self, session_dir, trial_name, 
-                        lowpass_cutoff_frequency=-1):
+                        lowpass_cutoff_frequency=-1, marker_names=None):
         
+        # marker_names is a list of the markers to load; all markers are
+        # loaded if None.
         trcFilePath = os.path.join(session_dir,
                                    'MarkerData',
                                    '{}.trc'.format(trial_name))
         
-        markerDict = trc_2_dict(trcFilePath)
+        if utilsColumnar.is_columnar_available(session_dir, trial_name,
+                                               'markers', lossless=True):
+            markerDict = utilsColumnar.load_markers(
+                session_dir, trial_name, marker_names=marker_names)
+        else:
+            markerDict = trc_2_dict(trcFilePath, marker_names=marker_names)
         if lowpass_cutoff_frequency > 0:
             markerDict['markers'] = {
                 marker_name: lowPassFilter(self.time, data, lowpass_cutoff_frequency) 
@@ -292,21 +381,233 @@ class kinematics:
         
         return coordinate_accelerations
     
-    def get_muscle_tendon_lengths(self, lowpass_cutoff_frequency=-1):
-        
-        # Compute muscle-tendon lengths.
-        lMT = np.zeros((self.table.getNumRows(), self.nMuscles))
-        for i in range(self.table.getNumRows()):
-            self.model.realizePosition(self.stateTrajectory()[i])
-            if i == 0:
-                muscleNames = [] 
+    # Model outputs.
+    # Muscle-tendon lengths, moment arms, center of mass, and body angular
+    # velocities are computed in a single pass over the frames: each state is
+    # realized once, and all requested outputs are extracted from it. The
+    # (unfiltered) outputs are cached, such that they are only computed once.
+    modelOutputs = ['muscle_tendon_lengths', 'moment_arms', 'center_of_mass',
+                    'body_angular_velocities']
+    
+    def get_muscles(self):
+        # Muscles of the model, as a list of (name, muscle).
+        if self._muscles is None:
+            self._muscles = []
             for m in range(self.forceSet.getSize()):        
                 c_force_elt = self.forceSet.get(m)  
                 if 'Muscle' in c_force_elt.getConcreteClassName():
-                    cObj = opensim.Muscle.safeDownCast(c_force_elt)            
-                    lMT[i,m] = cObj.getLength(self.stateTrajectory()[i])
-                    if i == 0:
-                        muscleNames.append(c_force_elt.getName())
+                    self._muscles.append(
+                        (c_force_elt.getName(), 
+                         opensim.Muscle.safeDownCast(c_force_elt)))
+        return self._muscles
+    
+    def get_moment_arm_pairs(self):
+        # Pairs (muscle index, coordinate index) for which moment arms are 
+        # computed. We use prior knowledge to improve computation speed; we do
+        # not want to compute moment arms that are not relevant, eg for a
+        # muscle of the left side with respect to a coordinate of the right
+        # side, or with respect to the root, lumbar, and arm coordinates.
+        pairs = []
+        for m, (muscleName, _) in enumerate(self.get_muscles()):
+            for c, coord in enumerate(self.coordinates):
+                if muscleName[-2:] == '_l' and coord[-2:] == '_r':
+                    continue
+                elif muscleName[-2:] == '_r' and coord[-2:] == '_l':
+                    continue
+                elif (coord in self.rootCoordinates or 
+                      coord in self.lumbarCoordinates or 
+                      coord in self.armCoordinates):
+                    continue
+                pairs.append((m, c))
+                
+        return pairs
+    
+    def compute_model_outputs(self, outputs=None, body_names=None, 
+                              n_workers=1):
+        """Computes model outputs in a single pass over the frames.
+
+        Parameters
+        ----------
+        outputs : list of str, optional
+            Outputs to compute, among kinematics.modelOutputs. Defaults to all.
+        body_names : list of str, optional
+            Bodies for body_angular_velocities. Defaults to all bodies.
+        n_workers : int, optional
+            Number of processes computing muscle_tendon_lengths and
+            moment_arms, each on a chunk of the frames (see
+            compute_muscle_outputs_parallel). Defaults to 1 (no parallel
+            computing); None uses the number of CPUs minus 2.
+        Returns
+        -------
+        modelOutputs : dict
+            For each requested output, the cached (unfiltered) values:
+            muscle_tendon_lengths (frames x muscles), moment_arms (frames x
+            muscles x coordinates), center_of_mass (dict with values and
+            speeds, frames x 3), and body_angular_velocities (dict with, for
+            each body, a dict with ground and body, frames x 3).
+        """
+        
+        if outputs is None:
+            outputs = self.modelOutputs
+        for output in outputs:
+            if not output in self.modelOutputs:
+                raise ValueError(output + ' is not a valid model output.')
+        cache = self._modelOutputs
+        
+        body_set = self.model.getBodySet()
+        if body_names is None:
+            body_names = [body_set.get(i).getName() 
+                          for i in range(body_set.getSize())]
+        
+        # Outputs that are not cached yet.
+        toCompute = [output for output in outputs if not output in cache and
+                     output != 'body_angular_velocities']
+        if 'body_angular_velocities' in outputs:
+            cache.setdefault('body_angular_velocities', {})
+            bodiesToCompute = [
+                body_name for body_name in body_names if not body_name in 
+                cache['body_angular_velocities']]
+            if bodiesToCompute:
+                toCompute.append('body_angular_velocities')
+        
+        # Muscle-tendon lengths and moment arms are computed in parallel if
+        # requested, and the other outputs in the pass over the frames below.
+        frameOutputs = list(toCompute)
+        muscleOutputs = [output for output in toCompute if output in 
+                         ['muscle_tendon_lengths', 'moment_arms']]
+        if muscleOutputs:
+            lMT, dM = self.compute_muscle_outputs_parallel(muscleOutputs,
+                                                           n_workers)
+            if lMT is not None:
+                frameOutputs = [output for output in frameOutputs if 
+                                not output in muscleOutputs]
+        
+        if frameOutputs:
+            nFrames = self.table.getNumRows()
+            muscles = self.get_muscles()
+            if 'muscle_tendon_lengths' in frameOutputs:
+                lMT = np.zeros((nFrames, len(muscles)))
+            if 'moment_arms' in frameOutputs:
+                dM = np.zeros((nFrames, len(muscles), self.nCoordinates))
+                pairs = [(m, c, self.coordinateSet.get(c)) 
+                         for m, c in self.get_moment_arm_pairs()]
+            if 'center_of_mass' in frameOutputs:
+                com_values = np.zeros((nFrames, 3))
+                com_speeds = np.zeros((nFrames, 3))
+            if 'body_angular_velocities' in frameOutputs:
+                bodies = [body_set.get(body_name) 
+                          for body_name in bodiesToCompute]
+                ground = self.model.getGround()
+                angVelGround = np.zeros((nFrames, len(bodies), 3))
+                angVelBody = np.zeros((nFrames, len(bodies), 3))
+            # Velocity-level outputs require realizing the velocities, which
+            # also realizes the positions.
+            realizeVelocity = ('center_of_mass' in frameOutputs or 
+                               'body_angular_velocities' in frameOutputs)
+            
+            stateTrajectory = self.stateTrajectory()
+            for i in range(nFrames):
+                state = stateTrajectory[i]
+                if realizeVelocity:
+                    self.model.realizeVelocity(state)
+                else:
+                    self.model.realizePosition(state)
+                
+                if 'muscle_tendon_lengths' in frameOutputs:
+                    for m, (_, cObj) in enumerate(muscles):
+                        lMT[i, m] = cObj.getLength(state)
+                if 'moment_arms' in frameOutputs:
+                    for m, c, coordinate in pairs:
+                        dM[i, m, c] = muscles[m][1].computeMomentArm(
+                            state, coordinate)
+                if 'center_of_mass' in frameOutputs:
+                    com_values[i, :] = self.model.calcMassCenterPosition(
+                        state).to_numpy()
+                    com_speeds[i, :] = self.model.calcMassCenterVelocity(
+                        state).to_numpy()
+                if 'body_angular_velocities' in frameOutputs:
+                    for b, body in enumerate(bodies):
+                        ang_vel_in_ground = body.getAngularVelocityInGround(
+                            state)
+                        angVelGround[i, b, :] = ang_vel_in_ground.to_numpy()
+                        angVelBody[i, b, :] = (
+                            ground.expressVectorInAnotherFrame(
+                                state, ang_vel_in_ground, body).to_numpy())
+            
+        if 'muscle_tendon_lengths' in toCompute:
+            cache['muscle_tendon_lengths'] = lMT
+        if 'moment_arms' in toCompute:
+            # Clean numerical artefacts (ie, moment arms smaller than 1e-5 m).
+            dM[np.abs(dM) < 1e-5] = 0
+            cache['moment_arms'] = dM
+        if 'center_of_mass' in toCompute:
+            cache['center_of_mass'] = {'values': com_values, 
+                                       'speeds': com_speeds}
+        if 'body_angular_velocities' in toCompute:
+            for b, body_name in enumerate(bodiesToCompute):
+                cache['body_angular_velocities'][body_name] = {
+                    'ground': angVelGround[:, b, :],
+                    'body': angVelBody[:, b, :]}
+        
+        modelOutputs = {output: cache[output] for output in outputs}
+        if 'body_angular_velocities' in outputs:
+            modelOutputs['body_angular_velocities'] = {
+                body_name: cache['body_angular_velocities'][body_name] 
+                for body_name in body_names}
+                
+        return modelOutputs
+    
+    def compute_muscle_outputs_parallel(self, outputs, n_workers=None):
+        # Computes muscle_tendon_lengths and/or moment_arms (outputs) with
+        # n_workers processes, each on a chunk of the frames (see 
+        # get_muscle_outputs_chunk). Returns (lMT, dM), or (None, None) if
+        # the frames should be processed serially instead: n_workers is 1,
+        # the trial has too few frames, or joblib is not available.
+        # Note: parallel computing might not be leveraged in IDEs like Spyder;
+        # we recommend running the code in the terminal.
+        import multiprocessing
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()-2 # default
+        n_workers = min(max(n_workers, 1), multiprocessing.cpu_count())
+        # Each worker loads the model, which is only worth it with enough
+        # frames per worker.
+        nFrames = self.table.getNumRows()
+        n_workers = min(n_workers, nFrames // 10)
+        if n_workers <= 1:
+            return None, None
+        try:
+            from joblib import Parallel, delayed
+        except ImportError:
+            return None, None
+        
+        # The speeds come from the splines of the whole trial, such that the
+        # states of each chunk match those of the serial computation.
+        # The times are those of the (filtered and trimmed) table, as in
+        # statesTable.
+        time = np.asarray(self.table.getIndependentColumn())
+        labels = list(self.table.getColumnLabels())
+        tableMetaData = utils.get_table_metadata_strings(self.table)
+        pairs = self.get_moment_arm_pairs()
+        chunks = np.array_split(np.arange(nFrames), n_workers)
+        results = Parallel(n_jobs=n_workers)(
+            delayed(get_muscle_outputs_chunk)(
+                self.modelPath, time[idx], self.Qs[idx, :],
+                self.Qds[idx, :], labels, tableMetaData, outputs, pairs)
+            for idx in chunks)
+        
+        lMT = np.concatenate([result[0] for result in results], axis=0)
+        dM = np.concatenate([result[1] for result in results], axis=0)
+        
+        return lMT, dM
+    
+    def get_muscle_tendon_lengths(self, lowpass_cutoff_frequency=-1,
+                                  n_workers=1):
+        
+        # Compute muscle-tendon lengths.
+        lMT = self.compute_model_outputs(
+            ['muscle_tendon_lengths'], 
+            n_workers=n_workers)['muscle_tendon_lengths']
+        muscleNames = [muscleName for muscleName, _ in self.get_muscles()]
                         
         # Filter.
         if lowpass_cutoff_frequency > 0:
@@ -320,46 +621,17 @@ class kinematics:
         
         return muscle_tendon_lengths
     
-    def get_moment_arms(self, lowpass_cutoff_frequency=-1):
-        
-        # Compute moment arms.
-        dM =  np.zeros((self.table.getNumRows(), self.nMuscles, 
-                        self.nCoordinates))
-        for i in range(self.table.getNumRows()):            
-            self.model.realizePosition(self.stateTrajectory()[i])
-            if i == 0:
-                muscleNames = []
-            for m in range(self.forceSet.getSize()):        
-                c_force_elt = self.forceSet.get(m)  
-                if 'Muscle' in c_force_elt.getConcreteClassName():
-                    muscleName = c_force_elt.getName()
-                    cObj = opensim.Muscle.safeDownCast(c_force_elt)
-                    if i == 0:
-                        muscleNames.append(c_force_elt.getName())                    
-                    for c, coord in enumerate(self.coordinates):
-                        # We use prior knowledge to improve computation speed;
-                        # We do not want to compute moment arms that are not
-                        # relevant, eg for a muscle of the left side with 
-                        # respect to a coordinate of the right side.
-                        if muscleName[-2:] == '_l' and coord[-2:] == '_r':
-                            dM[i, m, c] = 0
-                        elif muscleName[-2:] == '_r' and coord[-2:] == '_l':
-                            dM[i, m, c] = 0
-                        elif (coord in self.rootCoordinates or 
-                              coord in self.lumbarCoordinates or 
-                              coord in self.armCoordinates):
-                            dM[i, m, c] = 0
-                        else:
-                            coordinate = self.coordinateSet.get(
-                                self.coordinates.index(coord))
-                            dM[i, m, c] = cObj.computeMomentArm(
-                                self.stateTrajectory()[i], coordinate)
-                            
-        # Clean numerical artefacts (ie, moment arms smaller than 1e-5 m).
-        dM[np.abs(dM) < 1e-5] = 0
+    def get_moment_arms(self, lowpass_cutoff_frequency=-1, n_workers=1):
+        
+        # Compute moment arms. n_workers > 1 computes them in parallel (see
+        # compute_muscle_outputs_parallel).
+        dM = self.compute_model_outputs(['moment_arms'], 
+                                        n_workers=n_workers)['moment_arms']
+        muscleNames = [muscleName for muscleName, _ in self.get_muscles()]
         
         # Filter.
-        if lowpass_cutoff_frequency > 0:            
+        if lowpass_cutoff_frequency > 0:
+            dM = dM.copy()
             for c, coord in enumerate(self.coordinates):
                 dM[:, :, c] = lowPassFilter(self.time, dM[:, :, c], 
                                             lowpass_cutoff_frequency)
@@ -374,17 +646,23 @@ class kinematics:
             
         return moment_arms
     
-    def compute_center_of_mass(self):        
-        
-        # Compute center of mass position and velocity.
-        self.com_values = np.zeros((self.table.getNumRows(),3))
-        self.com_speeds = np.zeros((self.table.getNumRows(),3))        
-        for i in range(self.table.getNumRows()):            
-            self.model.realizeVelocity(self.stateTrajectory()[i])
-            self.com_values[i,:] = self.model.calcMassCenterPosition(
-                self.stateTrajectory()[i]).to_numpy()
-            self.com_speeds[i,:] = self.model.calcMassCenterVelocity(
-                self.stateTrajectory()[i]).to_numpy()
+    def compute_center_of_mass(self, recompute=False):        
+        
+        # Compute center of mass position and velocity. The (unfiltered)
+        # values and speeds are cached, such that the getters below only
+        # filter or differentiate them; recompute=True realizes the states
+        # again.
+        if recompute:
+            self._modelOutputs.pop('center_of_mass', None)
+        com = self.compute_model_outputs(['center_of_mass'])['center_of_mass']
+        self.com_values = com['values']
+        self.com_speeds = com['speeds']
+        
+        # Accelerations are first time derivative of speeds.
+        if not 'accelerations' in com:
+            com['accelerations'], = splineDerivatives(self.time, com['speeds'],
+                                                      orders=(1,))
+        self.com_accelerations = com['accelerations']
             
     def get_center_of_mass_values(self, lowpass_cutoff_frequency=-1):
         
@@ -423,15 +701,7 @@ class kinematics:
     def get_center_of_mass_accelerations(self, lowpass_cutoff_frequency=-1):
         
         self.compute_center_of_mass()        
-        com_s = self.com_speeds
-        
-        # Accelerations are first time derivative of speeds.
-        com_a = np.zeros((com_s.shape))
-        for i in range(com_s.shape[1]):
-            spline = interpolate.InterpolatedUnivariateSpline(
-                self.time, com_s[:,i], k=3)
-            splineD1 = spline.derivative(n=1)
-            com_a[:,i] = splineD1(self.time)        
+        com_a = self.com_accelerations
         
         # Filter.
         if lowpass_cutoff_frequency > 0:
@@ -448,36 +718,21 @@ class kinematics:
     def get_body_angular_velocity(self, body_names=None, lowpass_cutoff_frequency=-1,
                                   expressed_in='body'):
         
+        if not expressed_in in ['body', 'ground']:
+            raise Exception (expressed_in + ' is not a valid frame to express angular' + 
+                             ' velocity.')
+        
         body_set = self.model.getBodySet()
         if body_names is None:
-            body_names = []
-            for i in range(body_set.getSize()):
-                print(i)
-                body = body_set.get(i)
-                body_names.append(body.getName())
-        
-        bodies = [body_set.get(body_name) for body_name in body_names]           
-        ground = self.model.getGround()
-
-        angular_velocity = np.ndarray((self.table.getNumRows(),
-                              len(body_names)*3)) # time x bodies x dim
-                        
-        for i_time in range(self.table.getNumRows()): # loop over time
-            state = self.stateTrajectory()[i_time]
-            self.model.realizeVelocity(state)
-            
-            
-            for i_body,body in enumerate(bodies):
-                ang_vel_in_ground = body.getAngularVelocityInGround(state)
-                if expressed_in == 'body':
-                    angular_velocity[i_time, i_body*3:i_body*3+3] = ground.expressVectorInAnotherFrame(
-                                                          state, ang_vel_in_ground, body
-                                                          ).to_numpy()
-                elif expressed_in == 'ground':
-                    angular_velocity[i_time, i_body*3:i_body*3+3] = ang_vel_in_ground.to_numpy()
-                else:
-                    raise Exception (expressed_in + ' is not a valid frame to express angular' + 
-                                     ' velocity.')
+            body_names = [body_set.get(i).getName() 
+                          for i in range(body_set.getSize())]
+        
+        angular_velocities = self.compute_model_outputs(
+            ['body_angular_velocities'], 
+            body_names=body_names)['body_angular_velocities']
+        angular_velocity = np.concatenate(
+            [angular_velocities[body_name][expressed_in] 
+             for body_name in body_names], axis=1) # time x bodies*dim
                     
         angular_velocity_filtered = lowPassFilter(self.time, angular_velocity, lowpass_cutoff_frequency)
         
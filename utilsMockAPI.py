@@ -0,0 +1,407 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsMockAPI.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Local stand-in for the OpenCap API, to test and benchmark the download
+# functions (eg, utils.download_session) without api.opencap.ai.
+# It serves synthetic sessions (calibration, neutral, and dynamic trials with
+# their results and videos), the media files of these sessions (with HTTP
+# Range support), and the model geometries. Latency, bandwidth, and failures
+# (errors and interrupted transfers) can be configured.
+#
+# Usage from the command line:
+#   python utilsMockAPI.py --port 8000 --sessions 2 --latency 0.05
+# then set API_URL=http://127.0.0.1:8000/ in the environment (.env) file (or
+# use utilsAPI.set_api_url), with any API_TOKEN, and GEOMETRY_URL of utils
+# to the printed geometry url. From Python, see benchmarkDownload.py:
+#   server = MockOpenCapAPI(n_sessions=2).start()
+#   ... # requests to server.url
+#   server.stop()
+
+import re
+import json
+import time
+import pickle
+import random
+import hashlib
+import argparse
+import threading
+import http.server
+
+# %% Synthetic data.
+def make_media(name, size):
+    # Deterministic content of size bytes for a file name.
+    block = hashlib.sha256(name.encode()).digest() * 32
+    return (block * (size // len(block) + 1))[:size]
+
+class MockData:
+    """Synthetic sessions, trials, and media files.
+
+    Sessions are named session<k>, with trials calibration, neutral, and
+    trial<j>; ids are uuid-like strings. Media files have file_size bytes,
+    except videos (video_size bytes). The n_linked_sessions sessions
+    (linked<k>) only have dynamic trials, and use the calibration and neutral
+    trials of session0 (meta sessionWithCalibration and neutral_trial).
+
+    """
+    def __init__(self, n_sessions=1, n_trials=3, n_cameras=2,
+                 file_size=200000, video_size=2000000, n_linked_sessions=0):
+        self.file_size = file_size
+        self.video_size = video_size
+        self.sessions = {}
+        self.trials = {}
+        self.media = {}
+        self.devices = ['{:08x}-0000-0000-0000-{:012x}'.format(k, k)
+                        for k in range(n_cameras)]
+        for s in range(n_sessions):
+            session_id = self.make_id('session', s)
+            trialNames = ['calibration', 'neutral'] + [
+                'trial{}'.format(j) for j in range(n_trials)]
+            trials = [self.make_trial(session_id, name, j)
+                      for j, name in enumerate(trialNames)]
+            self.sessions[session_id] = {
+                'id': session_id, 'name': 'session{}'.format(s),
+                'meta': {}, 'trials': [
+                    {key: trial[key] for key in
+                     ['id', 'name', 'status', 'created_at', 'updated_at']}
+                    for trial in trials]}
+        for s in range(n_linked_sessions):
+            session_id = self.make_id('linked', s)
+            trials = [self.make_trial(session_id, 'trial{}'.format(j), j + 2)
+                      for j in range(n_trials)]
+            session0 = list(self.sessions.values())[0]
+            neutral = [trial for trial in session0['trials'] 
+                       if trial['name'] == 'neutral'][0]
+            self.sessions[session_id] = {
+                'id': session_id, 'name': 'linked{}'.format(s),
+                'meta': {'sessionWithCalibration': {'id': session0['id']},
+                         'neutral_trial': {'id': neutral['id']}}, 
+                'trials': [
+                    {key: trial[key] for key in
+                     ['id', 'name', 'status', 'created_at', 'updated_at']}
+                    for trial in trials]}
+
+    def make_id(self, kind, k):
+        digest = hashlib.md5('{}{}'.format(kind, k).encode()).hexdigest()
+        return '{}-{}-{}-{}-{}'.format(digest[:8], digest[8:12],
+                                       digest[12:16], digest[16:20],
+                                       digest[20:])
+
+    def add_media(self, trial_id, tag, suffix, content=None, size=None):
+        # Returns the media path; the url is built per request (signature).
+        name = '{}_{}{}'.format(trial_id, tag, suffix)
+        self.media[name] = (content if content is not None else
+                            make_media(name, size or self.file_size))
+        return 'media/' + name
+
+    def make_trial(self, session_id, name, j):
+        trial_id = self.make_id(session_id + name, j)
+        results, videos = [], []
+        def add_result(tag, suffix, device_id=None, **kwargs):
+            results.append({
+                'id': len(results), 'trial': trial_id, 'tag': tag,
+                'device_id': device_id, 'meta': None,
+                'media': self.add_media(trial_id, tag, suffix, **kwargs)})
+        trial = {'id': trial_id, 'session': session_id, 'name': name,
+                 'status': 'done', 'meta': None, 'results': results,
+                 'videos': videos,
+                 'created_at': '2023-01-01T00:{:02d}:00Z'.format(j),
+                 'updated_at': '2023-01-01T00:{:02d}:00Z'.format(j)}
+
+        for k, device_id in enumerate(self.devices):
+            videos.append({
+                'id': len(videos), 'trial': trial_id, 'device_id': device_id,
+                'video': self.add_media(trial_id, 'video',
+                                        '_{}.mov'.format(k),
+                                        size=self.video_size)})
+        if name == 'calibration':
+            mapping = {d.replace('-', '').upper(): k
+                       for k, d in enumerate(self.devices)}
+            add_result('camera_mapping', '.pickle',
+                       content=pickle.dumps(mapping))
+            trial['meta'] = {'calibration': {}}
+            for k in range(len(self.devices)):
+                cam = 'Cam{}'.format(k)
+                trial['meta']['calibration'][cam] = 0
+                for soln, img in [('_soln0', ''), ('_soln1', '_altSoln')]:
+                    add_result('calibration_parameters_options',
+                               '{}{}.pickle'.format(cam, soln),
+                               device_id=cam + soln)
+                    add_result('calibration-img', '{}{}.png'.format(cam, img),
+                               device_id=cam + img)
+            self.trials[trial_id] = trial
+            return trial
+
+        if name == 'neutral':
+            add_result('session_metadata', '.yaml',
+                       content=b'openSimModel: LaiUhlrich2022\n')
+            # The model name follows the last '-' of the url.
+            add_result('opensim_model', '-LaiUhlrich2022_scaled.osim')
+        add_result('marker_data', '.trc')
+        add_result('ik_results', '.mot')
+        add_result('main_settings', '.yaml', content=b'filter: 12\n')
+        for k in range(len(self.devices)):
+            # The camera name follows the last '_' of the url.
+            add_result('video-sync', '_Cam{}.mp4'.format(k),
+                       size=self.video_size)
+        self.trials[trial_id] = trial
+
+        return trial
+
+# %% Server.
+class MockOpenCapAPI:
+    """Local HTTP server with the API endpoints used by utils.
+
+    Parameters
+    ----------
+    data : MockData, optional
+        Defaults to MockData(**kwargs).
+    host, port : str, int
+        port=0 picks a free port.
+    latency : float
+        Delay (s) before each response.
+    bandwidth : float, optional
+        Maximum transfer rate (bytes/s) of each media response.
+    failure_rate : float
+        Probability of a 503 response (any request).
+    truncate_rate : float
+        Probability of interrupting a media transfer halfway.
+    seed : int
+        Seed of the failure injection.
+
+    Counters of the requests and bytes served are in stats.
+
+    """
+    def __init__(self, data=None, host='127.0.0.1', port=0, latency=0,
+                 bandwidth=None, failure_rate=0, truncate_rate=0, seed=0,
+                 **kwargs):
+        self.data = data if data is not None else MockData(**kwargs)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.truncate_rate = truncate_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.server = http.server.ThreadingHTTPServer(
+            (host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    @property
+    def geometry_url(self):
+        # To use as utils.GEOMETRY_URL.
+        return self.url + 'geometries_vtp/{}/{}.vtp'
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'api_requests': 0, 'media_requests': 0,
+                          'media_bytes': 0, 'failures': 0, 'truncations': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def draw(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sign(self, path):
+        # Signed urls change for every response, like the storage urls of
+        # the API.
+        return '{}{}?signature={:x}'.format(self.url, path,
+                                            self.random.getrandbits(64))
+
+    def get_json(self, path):
+        # Returns the json of an API path, or None if not found.
+        data = self.data
+        match = re.fullmatch(r'(sessions|trials|subjects)/([^/]+)/', path)
+        if path == 'sessions/valid/' or path == 'sessions/':
+            return [{key: session[key] for key in ['id', 'name']}
+                    for session in data.sessions.values()]
+        elif path == 'subjects/':
+            return [{'id': 0, 'name': 'subject0'}]
+        elif match is None:
+            return None
+        kind, key = match.groups()
+        if kind == 'subjects':
+            return {'id': 0, 'sessions': list(data.sessions.values())}
+        elif kind == 'sessions' and key in data.sessions:
+            return data.sessions[key]
+        elif kind == 'trials' and key in data.trials:
+            trial = json.loads(json.dumps(data.trials[key]))
+            for result in trial['results']:
+                result['media'] = self.sign(result['media'])
+            for video in trial['videos']:
+                video['video'] = self.sign(video['video'])
+            return trial
+
+        return None
+
+    def get_media(self, path):
+        if path.startswith('media/'):
+            return self.data.media.get(path[len('media/'):])
+        elif path.startswith('geometries_vtp/'):
+            return make_media(path, 20000)
+
+        return None
+
+    def make_handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, headers={}):
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split('?')[0].lstrip('/')
+                if api.latency:
+                    time.sleep(api.latency)
+                if api.draw(api.failure_rate):
+                    api.count('failures')
+                    return self.send_body(503, b'Service unavailable')
+
+                content = api.get_media(path)
+                if content is not None:
+                    return self.send_media(content)
+                api.count('api_requests')
+                if not self.headers.get('Authorization', '').startswith(
+                        'Token '):
+                    return self.send_body(401, b'{"detail": "No token."}')
+                response = api.get_json(path)
+                if response is None:
+                    return self.send_body(404, b'{"detail": "Not found."}')
+                self.send_body(200, json.dumps(response).encode(),
+                               {'Content-Type': 'application/json'})
+
+            def do_POST(self):
+                # Logins, and uploads (accepted and discarded).
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                api.count('api_requests')
+                self.send_body(201, json.dumps({'token': 'mock'}).encode(),
+                               {'Content-Type': 'application/json'})
+
+            do_PATCH = do_POST
+
+            def do_DELETE(self):
+                api.count('api_requests')
+                self.send_body(204, b'')
+
+            def send_media(self, content):
+                api.count('media_requests')
+                start = 0
+                match = re.fullmatch(r'bytes=(\d+)-',
+                                     self.headers.get('Range', ''))
+                if match is not None:
+                    start = int(match.group(1))
+                    if start >= len(content):
+                        return self.send_body(416, b'', {
+                            'Content-Range': 'bytes */{}'.format(
+                                len(content))})
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, len(content) - 1, len(content)))
+                else:
+                    self.send_response(200)
+                body = content[start:]
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+
+                end = len(body)
+                if api.draw(api.truncate_rate):
+                    api.count('truncations')
+                    end = len(body) // 2
+                    self.close_connection = True
+                chunk = 65536
+                for k in range(0, end, chunk):
+                    data = body[k:min(k + chunk, end)]
+                    self.wfile.write(data)
+                    api.count('media_bytes', len(data))
+                    if api.bandwidth:
+                        time.sleep(len(data) / api.bandwidth)
+
+        return Handler
+
+# %% Command line.
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the OpenCap API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--linked-sessions', type=int, default=0,
+                        help='Sessions using the calibration and neutral '
+                             'trials of the first session.')
+    parser.add_argument('--trials', type=int, default=3,
+                        help='Dynamic trials per session.')
+    parser.add_argument('--cameras', type=int, default=2)
+    parser.add_argument('--file-size', type=int, default=200000)
+    parser.add_argument('--video-size', type=int, default=2000000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay before each response (s).')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Bytes/s per media response.')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--truncate-rate', type=float, default=0)
+    args = parser.parse_args(argv)
+
+    server = MockOpenCapAPI(
+        host=args.host, port=args.port, latency=args.latency,
+        bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+        truncate_rate=args.truncate_rate, n_sessions=args.sessions,
+        n_linked_sessions=args.linked_sessions,
+        n_trials=args.trials, n_cameras=args.cameras,
+        file_size=args.file_size, video_size=args.video_size)
+    print('API_URL={}'.format(server.url))
+    print('Geometry url: {}'.format(server.geometry_url))
+    print('Sessions: {}'.format(', '.join(server.data.sessions)))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
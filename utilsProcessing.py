@@ -27,8 +27,10 @@ import logging
 import opensim
 import numpy as np
 from scipy import signal
+from scipy import interpolate
 import matplotlib.pyplot as plt
 from utils import storage_to_dataframe, download_trial, get_trial_id
+from utilsWindows import window_to_arrays, arrays_to_window
 
 def lowPassFilter(time, data, lowpass_cutoff_frequency, order=4):
     
@@ -39,6 +41,55 @@ def lowPassFilter(time, data, lowpass_cutoff_frequency, order=4):
 
     return dataFilt
 
+# %% Low-pass filter, window by window.
+def lowPassFilterWindows(windows, lowpass_cutoff_frequency, overlap, order=4):
+    """Filters a signal provided window by window, eg from iter_storage_windows
+    or iter_trc_windows.
+    
+    windows is an iterable of windows with consecutive windows sharing
+    `overlap` frames: (time, data) tuples with data of shape (len(time), ...),
+    dicts from iter_trc_windows (the markers are filtered), or structured
+    arrays from iter_storage_windows (all fields but time are filtered), see
+    utilsWindows. Each window is filtered with lowPassFilter, and half of the
+    overlap is then dropped on each side, such that the yielded windows (same
+    type as the input windows) tile the trial without overlap. The overlap
+    should cover the transients of the filter (eg, a few periods of the cutoff
+    frequency); the result then matches filtering the whole trial at once,
+    while memory use does not depend on the length of the trial.
+    """
+    
+    trim_start = overlap // 2
+    trim_end = overlap - trim_start
+    
+    previous = None
+    for c_window, window in enumerate(windows):
+        # The previous window is not the last one, trim its end.
+        if previous is not None:
+            window_p, time_p, data_p, offset_p = previous
+            n = time_p.shape[0] - trim_end
+            yield arrays_to_window(window_p, time_p[:n], data_p[:n], offset_p)
+        time, data = window_to_arrays(window)
+        dataFilt = lowPassFilter(time, data, lowpass_cutoff_frequency, 
+                                 order=order)
+        offset = 0
+        if c_window > 0:
+            time, dataFilt = time[trim_start:], dataFilt[trim_start:]
+            offset = trim_start
+        previous = (window, time, dataFilt, offset)
+    # The last window is not trimmed at the end.
+    if previous is not None:
+        yield arrays_to_window(*previous)
+
+# %% Spline derivatives.
+def splineDerivatives(time, data, orders=(1, 2)):
+    # Derivatives of the cubic interpolating splines of the columns of data,
+    # evaluated at time. Same as InterpolatedUnivariateSpline(time, column, 
+    # k=3).derivative(n=order) column by column, with one spline fitted for
+    # all columns at once. Returns one array per order.
+    spline = interpolate.make_interp_spline(time, data, k=3, axis=0)
+    
+    return [spline.derivative(nu=order)(time) for order in orders]
+
 # %% Segment gait
 def segment_gait(session_id, trial_name, data_folder, gait_cycles_from_end=0):
     
@@ -0,0 +1,178 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsResults.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Store for the results of dynamic simulations (OpenSimAD).
+# Results used to be saved as one pickled dict {case: {field: value}} in
+# <pathResults>/optimaltrajectories.npy, which had to be fully loaded and
+# rewritten to add a case, and fully unpickled to read a single quantity.
+# Each case is now saved in its own file, <pathResults>/optimaltrajectories/
+# <case>.npz, with one (uncompressed) entry per array, and the other fields
+# (eg, labels) stored as json in a _metadata entry. Adding a case writes a
+# new file, and arrays are only read from disk when accessed.
+# Results saved in optimaltrajectories.npy are still read; cases saved in the
+# store take precedence over cases with the same name in the legacy file.
+
+import os
+import glob
+import json
+import numpy as np
+from collections.abc import Mapping
+
+STORE_FOLDER_NAME = 'optimaltrajectories'
+LEGACY_FILE_NAME = 'optimaltrajectories.npy'
+METADATA_ENTRY = '_metadata'
+
+class OptimalTrajectory(Mapping):
+    """Results of one case, as a read-only dict {field: value}.
+
+    Arrays are read from disk the first time they are accessed, and then kept
+    in memory. The file is not kept open between accesses.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with np.load(path, allow_pickle=False) as data:
+            self._arrayFields = [f for f in data.files if f != METADATA_ENTRY]
+            self._metadata = json.loads(str(data[METADATA_ENTRY]))
+        self._arrays = {}
+
+    def __getitem__(self, field):
+        if field in self._metadata:
+            return self._metadata[field]
+        if not field in self._arrayFields:
+            raise KeyError(field)
+        if not field in self._arrays:
+            with np.load(self.path, allow_pickle=False) as data:
+                self._arrays[field] = data[field]
+        return self._arrays[field]
+
+    def __iter__(self):
+        return iter(self._arrayFields + list(self._metadata.keys()))
+
+    def __len__(self):
+        return len(self._arrayFields) + len(self._metadata)
+
+    def __repr__(self):
+        return 'OptimalTrajectory({})'.format(self.path)
+
+def to_json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{} is not json serializable.'.format(type(value)))
+
+# %% Paths.
+def get_case_path(pathResults, case):
+    return os.path.join(pathResults, STORE_FOLDER_NAME, '{}.npz'.format(case))
+
+def get_results_cases(pathResults):
+    # Cases of the legacy file first, as they were saved before.
+    cases = []
+    legacyPath = os.path.join(pathResults, LEGACY_FILE_NAME)
+    if os.path.exists(legacyPath):
+        cases = [str(case) for case in np.load(
+            legacyPath, allow_pickle=True).item().keys()]
+    for path in sorted(glob.glob(os.path.join(
+            glob.escape(os.path.join(pathResults, STORE_FOLDER_NAME)),
+            '*.npz'))):
+        case = os.path.basename(path)[:-4]
+        if not case in cases:
+            cases.append(case)
+
+    return cases
+
+def get_results_mtime(pathResults):
+    # Time of the last change of the results, 0 if there are none.
+    paths = [os.path.join(pathResults, LEGACY_FILE_NAME)] + glob.glob(
+        os.path.join(glob.escape(os.path.join(
+            pathResults, STORE_FOLDER_NAME)), '*.npz'))
+
+    return max([os.path.getmtime(p) for p in paths if os.path.exists(p)],
+               default=0)
+
+# %% Save.
+def save_optimal_trajectory(pathResults, case, result):
+    """Saves the results of one case; results of other cases are untouched.
+
+    Parameters
+    ----------
+    pathResults : str
+        Results folder of the trial (eg, OpenSimData/Dynamics/<trial_name>).
+    case : str
+        Name of the case; existing results of that case are replaced.
+    result : dict
+        {field: value}. numpy arrays are stored as arrays, other values
+        (eg, lists of labels, number of iterations) must be json
+        serializable.
+
+    """
+
+    arrays, metadata = {}, {}
+    for field, value in result.items():
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            arrays[field] = value
+        else:
+            metadata[field] = value
+    arrays[METADATA_ENTRY] = np.array(json.dumps(metadata,
+                                                 default=to_json_value))
+
+    # Write to a temporary file and rename, such that readers never see a
+    # partially written file.
+    casePath = get_case_path(pathResults, case)
+    os.makedirs(os.path.dirname(casePath), exist_ok=True)
+    tmpPath = casePath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmpPath, casePath)
+
+# %% Load.
+def load_optimal_trajectory(pathResults, case):
+    # Returns a dict-like object {field: value} with the results of case.
+    casePath = get_case_path(pathResults, case)
+    if os.path.exists(casePath):
+        return OptimalTrajectory(casePath)
+
+    legacyPath = os.path.join(pathResults, LEGACY_FILE_NAME)
+    if os.path.exists(legacyPath):
+        optimaltrajectories = np.load(legacyPath, allow_pickle=True).item()
+        for c_case in optimaltrajectories:
+            if str(c_case) == str(case):
+                return optimaltrajectories[c_case]
+
+    raise Exception('No results for case {} in {}.'.format(case, pathResults))
+
+def load_optimal_trajectories(pathResults, cases=None):
+    # Returns {case: results}, for all cases if cases is None.
+    if cases is None:
+        cases = get_results_cases(pathResults)
+
+    return {case: load_optimal_trajectory(pathResults, case) for case in cases}
+
+# %% Convert legacy file.
+def convert_optimal_trajectories(pathResults, remove_legacy_file=False):
+    # Saves the cases of optimaltrajectories.npy in the store.
+    legacyPath = os.path.join(pathResults, LEGACY_FILE_NAME)
+    optimaltrajectories = np.load(legacyPath, allow_pickle=True).item()
+    for case, result in optimaltrajectories.items():
+        if not os.path.exists(get_case_path(pathResults, case)):
+            save_optimal_trajectory(pathResults, case, result)
+    if remove_legacy_file:
+        os.remove(legacyPath)
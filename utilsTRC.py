@@ -5,8 +5,65 @@ import warnings
 from scipy.spatial.transform import Rotation as R
 
 import numpy as np
+import pandas as pd
 from numpy.lib.recfunctions import append_fields
 
+import utilsCache
+from utilsWindows import iter_array_windows
+
+def read_trc_header(fpath):
+    """Reads the header lines / metadata of a TRC file.
+
+    Returns
+    -------
+    header : dict
+        path, data_rate, camera_rate, num_frames, num_markers, units,
+        orig_data_rate, orig_data_start_frame, orig_num_frames, and
+        marker_names.
+
+    """
+    header = {}
+    # Split by any whitespace.
+    # TODO may cause issues with paths that have spaces in them.
+    f = open(fpath)
+    # These are lists of each entry on the first few lines.
+    first_line = f.readline().split()
+    # Skip the 2nd line.
+    f.readline()
+    third_line = f.readline().split()
+    fourth_line = f.readline().split()
+    f.close()
+
+    # First line.
+    if len(first_line) > 3:
+        header['path'] = first_line[3]
+    else:
+        header['path'] = ''
+
+    # Third line.
+    header['data_rate'] = float(third_line[0])
+    header['camera_rate'] = float(third_line[1])
+    header['num_frames'] = int(third_line[2])
+    header['num_markers'] = int(third_line[3])
+    header['units'] = third_line[4]
+    header['orig_data_rate'] = float(third_line[5])
+    header['orig_data_start_frame'] = int(third_line[6])
+    header['orig_num_frames'] = int(third_line[7])
+
+    # Marker names.
+    # The first and second column names are 'Frame#' and 'Time'.
+    header['marker_names'] = fourth_line[2:]
+
+    len_marker_names = len(header['marker_names'])
+    if len_marker_names != header['num_markers']:
+        warnings.warn('Header entry NumMarkers, %i, does not '
+                'match actual number of markers, %i. Changing '
+                'NumMarkers to match actual number.' % (
+                    header['num_markers'], len_marker_names))
+        header['num_markers'] = len_marker_names
+
+    return header
+
 class TRCFile(object):
     """A plain-text file format for storing motion capture marker trajectories.
     TRC stands for Track Row Column.
@@ -48,44 +105,8 @@ class TRCFile(object):
     def read_from_file(self, fpath):
         # Read the header lines / metadata.
         # ---------------------------------
-        # Split by any whitespace.
-        # TODO may cause issues with paths that have spaces in them.
-        f = open(fpath)
-        # These are lists of each entry on the first few lines.
-        first_line = f.readline().split()
-        # Skip the 2nd line.
-        f.readline()
-        third_line = f.readline().split()
-        fourth_line = f.readline().split()
-        f.close()
-
-        # First line.
-        if len(first_line) > 3:
-            self.path = first_line[3]
-        else:
-            self.path = ''
-
-        # Third line.
-        self.data_rate = float(third_line[0])
-        self.camera_rate = float(third_line[1])
-        self.num_frames = int(third_line[2])
-        self.num_markers = int(third_line[3])
-        self.units = third_line[4]
-        self.orig_data_rate = float(third_line[5])
-        self.orig_data_start_frame = int(third_line[6])
-        self.orig_num_frames = int(third_line[7])
-
-        # Marker names.
-        # The first and second column names are 'Frame#' and 'Time'.
-        self.marker_names = fourth_line[2:]
-
-        len_marker_names = len(self.marker_names)
-        if len_marker_names != self.num_markers:
-            warnings.warn('Header entry NumMarkers, %i, does not '
-                    'match actual number of markers, %i. Changing '
-                    'NumMarkers to match actual number.' % (
-                        self.num_markers, len_marker_names))
-            self.num_markers = len_marker_names
+        for k, v in read_trc_header(fpath).items():
+            setattr(self, k, v)
 
         # Load the actual data.
         # ---------------------
@@ -97,8 +118,11 @@ class TRCFile(object):
         dtype = {'names': col_names,
                 'formats': ['int'] + ['float64'] * (3 * self.num_markers + 1)}
         usecols = [i for i in range(3 * self.num_markers + 1 + 1)]
-        self.data = np.loadtxt(fpath, delimiter='\t', skiprows=5, dtype=dtype,
-                               usecols=usecols)
+        # Parsed data is memory-mapped from the sidecar cache if enabled.
+        self.data, _ = utilsCache.load_cached(
+            fpath, lambda path: (np.loadtxt(path, delimiter='\t', skiprows=5,
+                                            dtype=dtype, usecols=usecols), {}),
+            tag='trc')
         self.time = self.data['time']
 
         # Check the number of rows.
@@ -281,10 +305,166 @@ class TRCFile(object):
             else:
                 raise ValueError("Axis not recognized")
                 
-def trc_2_dict(pathFile, rotation=None):
+class TRCMarkers(object):
+    """Marker trajectories of a TRC file, stored as one contiguous
+    `num_frames` x `num_markers` x 3 array (x, y, z) with a name to index map.
+
+    Only the requested markers are parsed, and `marker()` returns views into
+    the array rather than copies. The metadata of the file is stored in
+    attributes of this object, as for TRCFile.
+
+    """
+    def __init__(self, fpath, marker_names=None):
+        """
+        Parameters
+        ----------
+        fpath : str
+            Valid file path to a TRC (.trc) file.
+        marker_names : list of str, optional
+            Names of the markers to load. All markers are loaded if None.
+
+        """
+        for k, v in read_trc_header(fpath).items():
+            setattr(self, k, v)
+
+        # Markers to load, and their index in the file.
+        file_marker_names = self.marker_names
+        if marker_names is not None:
+            missing = [m for m in marker_names if not m in file_marker_names]
+            if missing:
+                raise ValueError('Markers {} not in {}.'.format(missing, fpath))
+            self.marker_names = list(marker_names)
+        self.num_markers = len(self.marker_names)
+        self.marker_index = {name: i for i, name in 
+                             enumerate(self.marker_names)}
+        idx_file = [file_marker_names.index(m) for m in self.marker_names]
+
+        if utilsCache.is_cache_enabled():
+            # Load all markers from the sidecar cache (memory-mapped), and
+            # select the requested ones.
+            data, metadata = utilsCache.load_cached(
+                fpath, lambda path: parse_trc_markers(
+                    path, list(range(len(file_marker_names)))), 
+                tag='trcmarkers')
+            self.time = np.asarray(metadata['time'])
+            if marker_names is None:
+                self.data = data
+            else:
+                self.data = np.ascontiguousarray(data[:, idx_file, :])
+        else:
+            self.data, metadata = parse_trc_markers(fpath, idx_file)
+            self.time = np.asarray(metadata['time'])
+
+        # Check the number of rows.
+        n_rows = self.time.shape[0]
+        if n_rows != self.num_frames:
+            warnings.warn('%s: Header entry NumFrames, %i, does not '
+                    'match actual number of frames, %i, Changing '
+                    'NumFrames to match actual number.' % (fpath,
+                        self.num_frames, n_rows))
+            self.num_frames = n_rows
+
+    def __getitem__(self, key):
+        """See `marker()`.
+
+        """
+        return self.marker(key)
+
+    def marker(self, name):
+        """The trajectory of marker `name`, given as a `self.num_frames` x 3
+        view. The order of the columns is x, y, z.
+
+        """
+        return self.data[:, self.marker_index[name], :]
+
+    def marker_exists(self, name):
+        """
+        Returns
+        -------
+        exists : bool
+            Is the marker in the TRCMarkers?
+
+        """
+        return name in self.marker_index
+
+    def rotate(self, axis, value):
+        """ rotate the data.
+
+            axis : rotation axis
+            value : angle in degree
+        """
+        r = R.from_euler(axis, value, degrees=True)
+        self.data = r.apply(self.data.reshape(-1, 3)).reshape(self.data.shape)
+
+def parse_trc_markers(fpath, idx_markers):
+    """Parses the columns of the markers with indices `idx_markers` (in the
+    file) from a TRC file. Returns a `num_frames` x `len(idx_markers)` x 3
+    array and a dict with the time vector.
+
+    """
+    usecols = trc_marker_columns(idx_markers)
+    data = pd.read_csv(fpath, sep='\t', header=None, skiprows=5,
+                       usecols=sorted(set(usecols)), engine='c')
+    data = data[usecols].to_numpy(dtype=float)
+    markers = np.ascontiguousarray(data[:, 1:]).reshape(
+        data.shape[0], len(idx_markers), 3)
+
+    return markers, {'time': data[:, 0].tolist()}
+
+def trc_marker_columns(idx_markers):
+    # Columns: Frame#, Time, then x, y, z for each marker.
+    return [1] + [2 + 3*i + j for i in idx_markers for j in range(3)]
+
+def iter_trc_windows(fpath, window_size, overlap=0, marker_names=None):
+    """Reads a TRC file window by window, such that memory use does not depend
+    on the length of the trial.
+
+    Parameters
+    ----------
+    fpath : str
+        Valid file path to a TRC (.trc) file.
+    window_size : int
+        Number of frames per window. The last window may be shorter.
+    overlap : int, optional
+        Number of frames shared by consecutive windows.
+    marker_names : list of str, optional
+        Names of the markers to load. All markers are loaded if None.
+
+    Yields
+    ------
+    window : dict
+        Same format as trc_2_dict, plus 'start_idx', the index of the first
+        frame of the window in the trial.
+
+    """
+    file_marker_names = read_trc_header(fpath)['marker_names']
+    if marker_names is None:
+        marker_names = file_marker_names
+    missing = [m for m in marker_names if not m in file_marker_names]
+    if missing:
+        raise ValueError('Markers {} not in {}.'.format(missing, fpath))
+    usecols = trc_marker_columns(
+        [file_marker_names.index(m) for m in marker_names])
+
+    with pd.read_csv(fpath, sep='\t', header=None, skiprows=5,
+                     usecols=sorted(set(usecols)), engine='c',
+                     chunksize=max(window_size - overlap, 1)) as reader:
+        chunks = (chunk[usecols].to_numpy(dtype=float) for chunk in reader)
+        for start_idx, window in iter_array_windows(chunks, window_size,
+                                                    overlap):
+            markers = np.ascontiguousarray(window[:, 1:]).reshape(
+                window.shape[0], len(marker_names), 3)
+            yield {'time': window[:, 0],
+                   'marker_names': list(marker_names),
+                   'markers': {m: markers[:, i, :] for i, m in 
+                               enumerate(marker_names)},
+                   'start_idx': start_idx}
+
+def trc_2_dict(pathFile, rotation=None, marker_names=None):
     # rotation is a dict, eg. {'y':90} with axis, angle for rotation
+    # marker_names is a list of the markers to load, all markers if None
     trc_dict = {}
-    trc_file = TRCFile(pathFile)
+    trc_file = TRCMarkers(pathFile, marker_names=marker_names)
     trc_dict['time'] = trc_file.time
     trc_dict['marker_names'] = trc_file.marker_names
     trc_dict['markers'] = {}
@@ -0,0 +1,90 @@
+'''
+    ---------------------------------------------------------------------------
+    OpenCap processing: utilsWindows.py
+    ---------------------------------------------------------------------------
+
+    Copyright 2023 Stanford University and the Authors
+
+    Author(s): Antoine Falisse, Scott Uhlrich
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you may not
+    use this file except in compliance with the License. You may obtain a copy
+    of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+'''
+
+# Windows of frames of long recordings.
+# Files are read window by window (see utilsTRC.iter_trc_windows and
+# utils.iter_storage_windows), such that memory use does not depend on the
+# length of the trial. Three types of windows are supported by the window
+# processing functions (eg, utilsProcessing.lowPassFilterWindows):
+#   - (time, data) tuples, with data of shape (len(time), ...),
+#   - dicts from iter_trc_windows (time, marker_names, markers, start_idx),
+#   - structured arrays from iter_storage_windows (with a time field).
+
+import numpy as np
+from numpy.lib import recfunctions
+
+def iter_array_windows(chunks, window_size, overlap=0):
+    """Regroups an iterable of arrays (chunks of consecutive rows) into
+    windows of `window_size` rows, consecutive windows sharing `overlap` rows.
+    Yields the index of the first row of each window and the window. The last
+    window contains the remaining rows and may be shorter.
+
+    """
+    if overlap < 0 or window_size <= overlap:
+        raise ValueError('Expected 0 <= overlap < window_size.')
+    step = window_size - overlap
+    start_idx = 0
+    buffer = None
+    for chunk in chunks:
+        buffer = chunk if buffer is None else np.concatenate((buffer, chunk))
+        while buffer.shape[0] >= window_size:
+            yield start_idx, buffer[:window_size]
+            buffer = buffer[step:]
+            start_idx += step
+    # Remaining rows, unless they were all part of the previous window.
+    if buffer is not None and (start_idx == 0 or buffer.shape[0] > overlap):
+        if buffer.shape[0] > 0:
+            yield start_idx, buffer
+
+def window_to_arrays(window):
+    # Returns the time vector and the data of a window, data being of shape
+    # (frames, ...): (frames, markers, 3) for TRC windows, and (frames,
+    # fields) for storage windows (all fields but time).
+    if isinstance(window, dict):
+        markers = np.stack([window['markers'][m] for m in 
+                            window['marker_names']], axis=1)
+        return np.asarray(window['time']), markers
+    elif isinstance(window, np.ndarray) and window.dtype.names is not None:
+        fields = [name for name in window.dtype.names if name != 'time']
+        data = recfunctions.structured_to_unstructured(window[fields])
+        return window['time'], data.astype(float)
+    else:
+        time, data = window
+        return np.asarray(time), np.asarray(data)
+
+def arrays_to_window(window, time, data, offset=0):
+    # Inverse of window_to_arrays: a window of the same type as window, with
+    # time and data. offset is the index of the first frame of time in
+    # window (eg, if frames were dropped at the start of the window).
+    if isinstance(window, dict):
+        return {'time': time,
+                'marker_names': list(window['marker_names']),
+                'markers': {m: data[:, i, :] for i, m in 
+                            enumerate(window['marker_names'])},
+                'start_idx': window['start_idx'] + offset}
+    elif isinstance(window, np.ndarray) and window.dtype.names is not None:
+        fields = [name for name in window.dtype.names if name != 'time']
+        out = np.zeros(time.shape[0], dtype=window.dtype)
+        out['time'] = time
+        for i, field in enumerate(fields):
+            out[field] = data[:, i]
+        return out
+    else:
+        return time, data